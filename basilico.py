@@ -1,5 +1,7 @@
 #!/usr/bin/env python
+import itertools
 import json
+import re
 import subprocess
 import stat
 import os
@@ -15,16 +17,30 @@ from io import StringIO
 from pytarallo.Errors import ValidationError, NotAuthorizedError
 from pytarallo.ItemToUpload import ItemToUpload
 from twisted.internet import reactor, protocol
-from twisted.protocols.basic import LineOnlyReceiver
+from twisted.protocols.basic import LineReceiver
 import threading
 import logging
-from datetime import datetime
+import queue
 
 from read_smartctl import extract_smart_data, smart_health_status, parse_single_disk
+from image_catalogue import ImageCatalogue
+from disk_events import DiskEventMonitor
+from tarallo_cache import CodeLookup
+from tarallo_outbox import TaralloOutbox
+from job_store import JobStore, FINISHED, FAILED, STOPPED
+from io_scheduler import IoScheduler
+from queue_notifier import QueueNotifier
+from outbound_queue import OutboundQueue, Backlog, Message
+from binary_protocol import FrameDecoder, ProtocolError, pack, VERSION as BINARY_VERSION
+from chunking import split as split_in_chunks, MIN_LINE_LENGTH
+from sysfs_disks import get_disks_sysfs, read_partition_number
+from disk_io import NativeEraser, ImageWriter, FanOut, ReadBackVerifier, BlockMap, compression_of, format_rate, optimal_chunk_size
 
 NAME = "basilico"
 # Use env vars, do not change the value here
 TEST_MODE = False
+# About smartctl itself and not the disk, never sent to clients (same as IGNORE_SMART_RESULTS in pinolo)
+SMARTCTL_IGNORED_SECTIONS = ("json_format_version", "smartctl", "local_time")
 
 
 class Disk:
@@ -38,6 +54,10 @@ class Disk:
 
         self._composite_id = Disk.make_composite_id(self._lsblk)
         self._code = None
+        # Why the last Tarallo lookup failed, reported to clients when they ask for disks
+        self._code_error: Optional[str] = None
+        # The last one that was raised, so that clients see each error once and not at every get_disks
+        self._reported_error: Optional[str] = None
         self._item = None
 
         self._update_lock = threading.Lock()
@@ -45,7 +65,10 @@ class Disk:
         self._commands_queue = deque()
 
         self._tarallo = tarallo
-        self._get_code(False)
+        # What smartctl said last time, without the summary that was sent to clients with it
+        self._smartctl: Optional[dict] = None
+        # Only from the cache, otherwise the code is filled in when Tarallo answers
+        self._get_code()
         self._get_item()
 
     def update_mountpoints(self):
@@ -61,6 +84,17 @@ class Disk:
                     #     del self._lsblk["mountpoint_map"]
                     break
 
+    def update_from_lsblk(self, lsblk: dict) -> bool:
+        """
+        Take mountpoints, size and so on from a new scan of the same disk. Returns True if anything changed.
+        """
+        with self._update_lock:
+            mountpoint_map = lsblk.pop("mountpoint_map", {})
+            changed = mountpoint_map != self._mountpoint_map or any(self._lsblk.get(key) != value for key, value in lsblk.items())
+            self._lsblk.update(lsblk)
+            self._mountpoint_map = mountpoint_map
+            return changed
+
     def get_mountpoints_map(self) -> dict:
         # Probably pointless lock
         with self._update_lock:
@@ -80,9 +114,11 @@ class Disk:
     def enqueue(self, cmd_runner):
         cmd_runner: CommandRunner
         with self._queue_lock:
-            self._commands_queue.append(cmd_runner)
-            if len(self._commands_queue) == 1:
+            self._insert_by_priority(cmd_runner)
+            if self._commands_queue[0] is cmd_runner:
                 cmd_runner.start()
+            renumbered = self._renumber()
+        self._notify_positions(renumbered)
 
     def dequeue(self, cmd_runner):
         cmd_runner: CommandRunner
@@ -90,8 +126,8 @@ class Disk:
             try:
                 self._commands_queue.remove(cmd_runner)
             except ValueError:
-                # TODO: This could be a return
-                pass
+                # Already out of the queue, nothing changed
+                return
             if len(self._commands_queue) > 0:
                 next_in_line: CommandRunner = self._commands_queue[0]
                 if not next_in_line.is_alive():
@@ -99,18 +135,150 @@ class Disk:
             else:
                 if cmd_runner.get_cmd() != "queued_sleep":
                     cmd_runner._call_hdparm_for_sleep(self._path)
+            renumbered = self._renumber()
+        self._notify_positions(renumbered)
+
+    def move(self, cmd_runner, where: str) -> bool:
+        """
+        Move a job that has not started yet to the "first", "last" place, "up" or "down" by one. Returns False if
+        it cannot be moved (running, or already there).
+        """
+        cmd_runner: CommandRunner
+        with self._queue_lock:
+            queue = self._commands_queue
+            if cmd_runner not in queue:
+                return False
+            index = queue.index(cmd_runner)
+            target = {"first": 0, "up": index - 1, "down": index + 1, "last": len(queue) - 1}[where]
+            target = max(0, min(target, len(queue) - 1))
+            # The head may be running, then nothing can go before it
+            if min(index, target) == 0 and not queue[0].unschedule():
+                if index == 0:
+                    return False
+                target = max(target, 1)
+            if target == index:
+                return False
+            del queue[index]
+            queue.insert(target, cmd_runner)
+            if not queue[0].started():
+                queue[0].start()
+            renumbered = self._renumber()
+        self._notify_positions(renumbered)
+        return True
+
+    def set_priority(self, cmd_runner, priority: int):
+        cmd_runner: CommandRunner
+        with self._queue_lock:
+            queue = self._commands_queue
+            if cmd_runner not in queue:
+                return
+            cmd_runner.priority = priority
+            if queue[0] is cmd_runner and not cmd_runner.unschedule():
+                # Running, the priority only matters to the scheduler from now on
+                return
+            queue.remove(cmd_runner)
+            self._insert_by_priority(cmd_runner)
+            if not queue[0].started():
+                queue[0].start()
+            renumbered = self._renumber()
+        self._notify_positions(renumbered)
+
+    def _insert_by_priority(self, cmd_runner):
+        # After every job with the same or a higher priority, and after whatever is running
+        queue = self._commands_queue
+        position = len(queue)
+        while position > 1 and queue[position - 1].priority > cmd_runner.priority:
+            position -= 1
+        if position == 1 and queue[0].priority > cmd_runner.priority:
+            # Only a head that has not started can make room, and it stops waiting for the scheduler if it does.
+            # Whoever calls this starts the new head.
+            if queue[0].unschedule():
+                position = 0
+        queue.insert(position, cmd_runner)
+
+    def _renumber(self) -> list:
+        """
+        Tell each job where it is now, returns those that moved.
+        """
+        renumbered = []
+        for position, runner in enumerate(self._commands_queue):
+            queued_command = runner.get_queued_command()
+            if queued_command and queued_command.position != position:
+                queued_command.position = position
+                renumbered.append(queued_command)
+        return renumbered
+
+    @staticmethod
+    def _notify_positions(renumbered: list):
+        for queued_command in renumbered:
+            queued_command.notify_position()
 
     def get_path(self):
         return self._path
 
-    def update_from_tarallo_if_needed(self) -> bool:
-        changes = False
+    def is_rotational(self) -> bool:
+        return bool(self._lsblk.get("rota"))
+
+    def get_identity(self) -> (Optional[str], Optional[str], Optional[str]):
+        """
+        Serial number, WWN and Tarallo code: what tells this disk apart from the next one at the same path.
+        """
+        return self._lsblk.get("serial"), self._lsblk.get("wwn"), self._code
+
+    def get_erase_checkpoint(self) -> Optional[dict]:
+        """
+        How far the last interrupted erase of this disk got, if it was interrupted. Checkpoints of a disk that has
+        changed size, or that are older than ERASE_CHECKPOINT_MAX_AGE (the disk may have been written to somewhere
+        else meanwhile), are discarded.
+        """
+        serial, wwn, _ = self.get_identity()
+        if not JOBS or not (serial or wwn):
+            return None
+        checkpoint = JOBS.checkpoint(serial, wwn)
+        if checkpoint is None:
+            return None
+        age = time.time() - checkpoint.get("saved", 0)
+        if checkpoint.get("size") != int(self._lsblk.get("size") or 0) or (ERASE_CHECKPOINT_MAX_AGE > 0 and age > ERASE_CHECKPOINT_MAX_AGE):
+            logging.info(f"Discarding erase checkpoint of {self._path}: saved {age / 3600:.1f} hours ago for {checkpoint.get('size')} bytes")
+            JOBS.clear_checkpoint(serial, wwn)
+            return None
+        return checkpoint
+
+    def save_erase_checkpoint(self, state: Optional[dict]):
+        """
+        None when the erase is done, or the disk has been written to and the checkpoint is not true anymore.
+        """
+        serial, wwn, _ = self.get_identity()
+        if not JOBS or not (serial or wwn):
+            # Not safe to tell this disk from another one
+            return
+        if state is None:
+            JOBS.clear_checkpoint(serial, wwn)
+        else:
+            JOBS.save_checkpoint(serial, wwn, {**state, "saved": time.time()})
+
+    def get_smartctl(self) -> Optional[dict]:
+        return self._smartctl
+
+    def set_smartctl(self, detail: Optional[dict]):
+        self._smartctl = detail
+
+    def update_from_tarallo_if_needed(self, refresh: bool = False) -> bool:
+        """
+        Ask Tarallo again for disks without a code, unless the cache knows they are not there (refresh skips it).
+        The answer is pushed to clients with disk_changed when it arrives, so this returns False, or raises the
+        error of the previous lookup: only the first time, unless asked to refresh.
+        """
+        error = self._code_error
         if not self._code:
-            old_code = self._code
-            self._get_code(True)
-            changes = self._code == old_code
+            self._get_code(refresh)
         self._get_item()
-        return changes
+        if error and (refresh or error != self._reported_error):
+            self._reported_error = error
+            raise ErrorThatCanBeManuallyFixed(error)
+        if not error:
+            self._reported_error = None
+        return False
 
     def serialize_disk(self):
         result = self._lsblk
@@ -122,11 +290,13 @@ class Disk:
                     critical = True
                     break
         result["has_critical_mounts"] = critical
+        checkpoint = self.get_erase_checkpoint()
+        result["erase_checkpoint"] = None if checkpoint is None else checkpoint["percent"]
         return result
 
     def update_status(self, status: str) -> bool:
         if self._tarallo and self._code:
-            self._tarallo.update_item_features(self._code, {"smart-data": status})
+            self._update_features({"smart-data": status})
             return True
         return False
 
@@ -141,7 +311,7 @@ class Disk:
                 data["software"] = None
 
             if len(data) > 0:
-                self._tarallo.update_item_features(self._code, data)
+                self._update_features(data)
             return True
         return False
 
@@ -149,11 +319,18 @@ class Disk:
         if self._tarallo and self._code:
             data = {"software": software}
 
-            self._tarallo.update_item_features(self._code, data)
+            self._update_features(data)
             return True
         return False
 
-    def _get_code(self, stop_on_error: bool = True):
+    def _update_features(self, data: dict):
+        if OUTBOX:
+            # Sent later by the outbox, jobs do not wait for tarallo
+            OUTBOX.enqueue(self._code, data)
+        else:
+            tarallo_session().update_item_features(self._code, data)
+
+    def _get_code(self, refresh: bool = False):
         if not self._tarallo:
             if TEST_MODE:
                 import binascii
@@ -166,45 +343,55 @@ class Disk:
             else:
                 self._code = None
             return
-        if "serial" not in self._lsblk:
+        if not self._lsblk.get("serial"):
             self._code = None
-            if stop_on_error:
-                raise ErrorThatCanBeManuallyFixed(f"Disk {self._path} has no serial number")
+            self._code_error = f"Disk {self._path} has no serial number"
+            return
 
+        sn = self._tarallo_serial()
+        codes = CODE_LOOKUP.get(sn, lambda found, error: self._code_found(sn, found, error), refresh)
+        if codes is not None:
+            self._set_code_from(sn, codes)
+
+    def _tarallo_serial(self) -> str:
         sn = self._lsblk["serial"]
         sn: str
-        if sn and sn.startswith("WD-"):
+        if sn.startswith("WD-"):
             sn = sn[3:]
+        return sn
 
-        try:
-            codes = self._tarallo.get_codes_by_feature("sn", sn)
-            if len(codes) <= 0:
-                self._code = None
-                logging.debug(f"Disk {sn} not found in tarallo")
-            elif len(codes) == 1:
-                self._code = codes[0]
-                logging.debug(f"Disk {sn} found as {self._code}")
-            else:
-                self._code = None
-                if stop_on_error:
-                    raise ErrorThatCanBeManuallyFixed(f"Duplicate codes for {self._path}: {' '.join(codes)}, S/N is {sn}")
-        except Errors.NoInternetConnectionError:
-            self._code = None
-            if stop_on_error:
-                raise ErrorThatCanBeManuallyFixed(f"Tarallo lookup for disk with S/N {sn} failed due to a connection error")
-        except Errors.ServerError:
+    def _code_found(self, sn: str, codes: Optional[List[str]], error: Optional[BaseException]):
+        old_code = self._code
+        if error is None:
+            self._set_code_from(sn, codes)
+        else:
             self._code = None
-            if stop_on_error:
-                raise ErrorThatCanBeManuallyFixed(f"Tarallo lookup for disk with S/N {sn} failed due to server error, try again later")
-        except Errors.AuthenticationError:
+            self._code_error = self._lookup_error_message(sn, error)
+        if self._code != old_code:
+            publish_disk_change(self)
+
+    def _set_code_from(self, sn: str, codes: List[str]):
+        self._code_error = None
+        if len(codes) <= 0:
             self._code = None
-            if stop_on_error:
-                raise ErrorThatCanBeManuallyFixed(f"Tarallo lookup for disk with S/N {sn} failed due to authentication error, check the token")
-        except (Errors.ValidationError, RuntimeError) as e:
+            logging.debug(f"Disk {sn} not found in tarallo")
+        elif len(codes) == 1:
+            self._code = codes[0]
+            logging.debug(f"Disk {sn} found as {self._code}")
+        else:
             self._code = None
-            logging.warning(f"Tarallo lookup failed unexpectedly for disk with S/N {sn}", exc_info=e)
-            if stop_on_error:
-                raise ErrorThatCanBeManuallyFixed(f"Tarallo lookup for disk with S/N {sn} failed, more info has been logged on the server")
+            self._code_error = f"Duplicate codes for {self._path}: {' '.join(codes)}, S/N is {sn}"
+
+    @staticmethod
+    def _lookup_error_message(sn: str, error: BaseException) -> str:
+        if isinstance(error, Errors.NoInternetConnectionError):
+            return f"Tarallo lookup for disk with S/N {sn} failed due to a connection error"
+        if isinstance(error, Errors.ServerError):
+            return f"Tarallo lookup for disk with S/N {sn} failed due to server error, try again later"
+        if isinstance(error, Errors.AuthenticationError):
+            return f"Tarallo lookup for disk with S/N {sn} failed due to authentication error, check the token"
+        logging.warning(f"Tarallo lookup failed unexpectedly for disk with S/N {sn}", exc_info=error)
+        return f"Tarallo lookup for disk with S/N {sn} failed, more info has been logged on the server"
 
     def _get_item(self):
         if self._tarallo and self._code:
@@ -222,14 +409,17 @@ class Disk:
             for f, v in features.items():
                 disk.features[f] = v
             disk.set_parent(loc)
-            success = self._tarallo.add_item(disk)
+            # Not bulk_add: Tarallo keeps bulk imports for someone to review, items (and their codes) do not exist until then
+            success = tarallo_session().add_item(disk)
             if success and isinstance(disk.code, str) and disk.code != "":
                 return disk.code
-            # success = self._tarallo.bulk_add(disk.serializable())
         return None
 
     def set_code(self, code: str):
         self._code = code
+        self._code_error = None
+        if CODE_LOOKUP and self._lsblk.get("serial"):
+            CODE_LOOKUP.remember(self._tarallo_serial(), [code])
 
 
 class SudoSessionKeeper(threading.Thread):
@@ -243,14 +433,198 @@ class ErrorThatCanBeManuallyFixed(BaseException):
     pass
 
 
-class CommandRunner(threading.Thread):
+class WorkerLane:
+    """
+    A fixed-size pool of worker threads with a bounded backlog.
+
+    Workers are spawned on demand up to max_workers and then reused, so the thread count stays flat
+    no matter how many commands are received. The backlog is served by priority, then in arrival order.
+    Jobs that wait in the queue of a disk are admitted first and count against the backlog until they are submitted.
+    """
+
+    def __init__(self, name: str, max_workers: int, max_backlog: int):
+        self.name = name
+        self._max_workers = max(1, max_workers)
+        self._max_backlog = max(0, max_backlog)
+        self._queue = queue.PriorityQueue()
+        # Tie breaker, runners cannot be compared
+        self._sequence = itertools.count()
+        self._lock = threading.Lock()
+        self._workers: List[threading.Thread] = []
+        self._idle = 0
+        self._pending = 0
+        # Admitted, still in the queue of their disk
+        self._admitted = 0
+
+    def admit(self, cmd: str) -> bool:
+        """
+        Make room in the backlog for a job that will wait in the queue of its disk. False if there is none.
+        """
+        with self._lock:
+            if self._pending + self._admitted >= self._max_backlog:
+                logging.warning(f"[{self.name}] Backlog full ({self._pending + self._admitted} commands waiting), rejecting {cmd}")
+                return False
+            self._admitted += 1
+            return True
+
+    def submit(self, runner, admitted: bool = False) -> bool:
+        """
+        Admitted jobs already have their place and are never rejected, or their disk would be stuck forever.
+        """
+        runner: CommandRunner
+        with self._lock:
+            if admitted:
+                self._admitted -= 1
+            elif self._pending + self._admitted >= self._max_backlog:
+                logging.warning(f"[{self.name}] Backlog full ({self._pending + self._admitted} commands waiting), rejecting {runner.get_cmd()}")
+                return False
+            self._pending += 1
+            if self._idle < self._pending and len(self._workers) < self._max_workers:
+                worker = threading.Thread(target=self._work, name=f"{self.name}-{len(self._workers)}", daemon=True)
+                self._workers.append(worker)
+                worker.start()
+            self._queue.put((runner.priority, next(self._sequence), runner))
+        return True
+
+    def shutdown(self):
+        with self._lock:
+            for _ in self._workers:
+                # After everything that is already waiting
+                self._queue.put((sys.maxsize, next(self._sequence), None))
+
+    def _work(self):
+        while True:
+            with self._lock:
+                self._idle += 1
+            _, _, runner = self._queue.get()
+            with self._lock:
+                self._idle -= 1
+                if runner is not None:
+                    self._pending -= 1
+            if runner is None:
+                return
+            runner: CommandRunner
+            runner.run()
+
+
+class CommandExecutor:
+    """
+    Runs commands on three separate lanes: long per-disk jobs (erase, imaging), other per-disk jobs (smartctl,
+    uploads, umount, sleep) and everything else, so a rack full of erases or uploads cannot starve pings and queue
+    updates.
+
+    The head of each disk queue gets a worker as soon as one is free: with more disks than workers in a lane, some
+    wait for another disk to finish.
+    """
+
+    def __init__(self, short_workers: int, short_backlog: int, long_workers: int, long_backlog: int, queued_workers: int, queued_backlog: int):
+        self._lanes = {
+            "short": WorkerLane("short", short_workers, short_backlog),
+            "queued": WorkerLane("queued", queued_workers, queued_backlog),
+            "long": WorkerLane("long", long_workers, long_backlog),
+        }
+
+    @staticmethod
+    def lane_for(cmd: str) -> str:
+        if cmd in LONG_COMMANDS:
+            return "long"
+        return "queued" if cmd.startswith("queued_") else "short"
+
+    def admit(self, cmd: str) -> bool:
+        return self._lanes[self.lane_for(cmd)].admit(cmd)
+
+    def submit(self, runner, admitted: bool = False) -> bool:
+        runner: CommandRunner
+        return self._lanes[self.lane_for(runner.get_cmd())].submit(runner, admitted)
+
+    def shutdown(self):
+        for lane in self._lanes.values():
+            lane.shutdown()
+
+
+class BadblocksProgressParser:
+    """
+    Incremental parser for the progress that badblocks -s prints on stderr.
+
+    badblocks rewrites its status line with backspaces, feed() accepts chunks of any size (from a blocking read
+    or from a ProcessProtocol in the reactor), splits them on \\b and \\r and returns the progress events found.
+    """
+
+    CHUNK_SIZE = 65536
+    _SEPARATORS = re.compile(rb"[\b\r\n]+")
+    _PROGRESS = re.compile(rb"(\d+(?:\.\d+)?)% done.*?\((\d+)/(\d+)/(\d+) errors\)")
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.reading_and_comparing = False
+        self.percent = 0.0
+        self.read_errors = 0
+        self.write_errors = 0
+        self.corruption_errors = 0
+        # -1 until badblocks prints its first totals
+        self.errors = -1
+
+    def feed(self, chunk: bytes) -> List[dict]:
+        self._buffer += chunk
+        segments = self._SEPARATORS.split(self._buffer)
+        # The last segment may still be incomplete, keep it for the next chunk
+        self._buffer = bytearray(segments.pop())
+        events = []
+        for segment in segments:
+            event = self._parse_segment(segment)
+            if event is not None:
+                events.append(event)
+        return events
+
+    def finish(self) -> List[dict]:
+        segment = bytes(self._buffer)
+        self._buffer.clear()
+        event = self._parse_segment(segment)
+        return [event] if event is not None else []
+
+    def _parse_segment(self, segment: bytes) -> Optional[dict]:
+        if not segment:
+            return None
+        if b"Reading and comparing" in segment:
+            self.reading_and_comparing = True
+        match = self._PROGRESS.search(segment)
+        if not match:
+            # Other messages are ignored
+            return None
+        # /2 due to the 0x00 test + read & compare
+        phase_percent = float(match.group(1))
+        self.percent = phase_percent / 2
+        if self.reading_and_comparing:
+            self.percent += 50
+        # The errors are read, write and corruption. badblocks prints the 3 totals every time.
+        self.read_errors = int(match.group(2))
+        self.write_errors = int(match.group(3))
+        self.corruption_errors = int(match.group(4))
+        self.errors = self.read_errors + self.write_errors + self.corruption_errors
+        return {
+            "percent": self.percent,
+            "phase_percent": phase_percent,
+            "reading_and_comparing": self.reading_and_comparing,
+            "read_errors": self.read_errors,
+            "write_errors": self.write_errors,
+            "corruption_errors": self.corruption_errors,
+            "errors": self.errors,
+        }
+
+
+class CommandRunner:
     def __init__(self, cmd: str, args: str, the_id: int):
-        threading.Thread.__init__(self)
         self._cmd = cmd
         self._args = args
         self._the_id = the_id
         self._go = True
         self._queued_command = None
+        self._started = False
+        # Lower runs first
+        self.priority = PRIORITIES[COMMAND_PRIORITIES.get(cmd, "interactive")]
+        # Waiting for room on the links of its disk, see IO_SCHEDULER
+        self._waiting = False
+        self._done = threading.Event()
 
         self._function, disk_for_queue = self.dispatch_command(cmd, args)
         if not self._function:
@@ -265,6 +639,11 @@ class CommandRunner(threading.Thread):
                 self.send_msg("error", {"message": f"{args} is not a disk"})
                 self._function = None
                 return
+            # Queued commands are admitted here, once they reach the head of the disk queue they always get a worker
+            if not EXECUTOR.admit(cmd):
+                self.send_msg("error", {"message": "Server busy, try again later", "command": cmd})
+                self._function = None
+                return
             # Do not start yet, just prepare the data structure
             self._queued_command = QueuedCommand(disk, self)
 
@@ -273,15 +652,61 @@ class CommandRunner(threading.Thread):
                 disk.enqueue(self)
         else:
             # Start immediately
-            self.start()
+            if not self.start():
+                self.send_msg("error", {"message": "Server busy, try again later", "command": cmd})
+
+    def start(self) -> bool:
+        if self._started or self._waiting:
+            return True
+        if IO_SCHEDULER and self._queued_command is not None and self._cmd in LONG_COMMANDS and self._go:
+            disk = self._queued_command.disk
+            bandwidth = IO_HDD_RATE if disk.is_rotational() else IO_SSD_RATE
+            if not IO_SCHEDULER.request(self, disk.get_path(), bandwidth, self._start_waiting, self.priority):
+                self._waiting = True
+                self._queued_command.notify_percentage(0.0, "Waiting for other disks on the same controller or hub")
+                return True
+        return self._submit()
+
+    def unschedule(self) -> bool:
+        """
+        Back to the disk queue if it was waiting for the scheduler. False if it has already started, or the
+        scheduler is starting it right now.
+        """
+        if self._started:
+            return False
+        if self._waiting:
+            if not IO_SCHEDULER.withdraw(self):
+                return False
+            self._waiting = False
+            self._queued_command.notify_percentage(0.0, "Queued")
+        return True
+
+    def _start_waiting(self):
+        self._waiting = False
+        self._submit()
+
+    def _submit(self) -> bool:
+        # Jobs in a disk queue were admitted when they were queued
+        if not EXECUTOR.submit(self, admitted=self._queued_command is not None):
+            return False
+        self._started = True
+        return True
 
-    # noinspection PyUnresolvedReferences
     def started(self) -> bool:
-        return self._started.is_set()
+        return self._started
+
+    def is_alive(self) -> bool:
+        return self._started and not self._done.is_set()
+
+    def join(self, timeout: Optional[float] = None):
+        self._done.wait(timeout)
 
     def get_cmd(self):
         return self._cmd
 
+    def get_args(self):
+        return self._args
+
     def get_queued_command(self):
         return self._queued_command
 
@@ -310,6 +735,9 @@ class CommandRunner(threading.Thread):
                 # Notify finish only if not already notified, as a catch all for errors
                 # that may prevent the actual function from notifying
                 self._queued_command.notify_finish_safe()
+                # Jobs on other disks have been waiting for longer than the next one on this disk
+                if IO_SCHEDULER:
+                    IO_SCHEDULER.release(self)
                 self._queued_command.disk.dequeue(self)
             # Not running anymore (in a few nanoseconds, anyway)
             with running_commands_lock:
@@ -318,27 +746,39 @@ class CommandRunner(threading.Thread):
                     running_commands.remove(self)
                 except KeyError:
                     pass
+            self._done.set()
 
     def stop_asap(self):
-        # This is completely pointless unless the command checks self._go
-        # (none of them does, for now)
+        # A running command only stops if it checks self._go, one that has not started returns as soon as it runs.
+        # A job waiting for the scheduler is given a worker right away, just to do that and leave the disk queue.
         self._go = False
+        if IO_SCHEDULER and IO_SCHEDULER.withdraw(self):
+            # Let it run, it will see that it has to stop and leave the disk queue
+            self._start_waiting()
 
     def dispatch_command(self, cmd: str, args: str) -> (Optional[Callable[[str, str], None]], Optional[str]):
         commands = {
             "sudo_password": self.sudo_password,
             "smartctl": self.get_smartctl,
             "queued_smartctl": self.queued_get_smartctl,
+            "smartctl_detail": self.get_smartctl_detail,
             "queued_badblocks": self.badblocks,
             "queued_cannolo": self.cannolo,
             "queued_sleep": self.sleep,
             "queued_umount": self.umount,
             "upload_to_tarallo": self.upload_to_tarallo,
             "queued_upload_to_tarallo": self.queued_upload_to_tarallo,
+            "upload_to_tarallo_bulk": self.upload_to_tarallo_bulk,
             "get_disks": self.get_disks,
             "ping": self.ping,
             "close_at_end": self.close_at_end,
             "get_queue": self.get_queue,
+            "queue_deltas": self.queue_deltas,
+            "tarallo_outbox": self.tarallo_outbox,
+            "outbound_stats": self.outbound_stats,
+            "job_history": self.job_history,
+            "move": self.move_in_queue,
+            "priority": self.set_priority,
             "remove": self.remove_one_from_queue,
             "remove_all": self.remove_all_from_queue,
             "remove_completed": self.remove_all_from_queue,
@@ -356,14 +796,37 @@ class CommandRunner(threading.Thread):
 
     # noinspection PyUnusedLocal
     def get_queue(self, cmd: str, args: str):
-        param = []
         with queued_commands_lock:
-            for queued_command in queued_commands:
-                queued_command.lock_notifications()
-                param.append(queued_command.serialize_me())
-            self.send_msg(cmd, param)
-            for queued_command in queued_commands:
-                queued_command.unlock_notifications()
+            job_ids = list(interrupted_jobs) + [queued_command.id() for queued_command in queued_commands]
+            QUEUE_NOTIFIER.send_queue(self._the_id, cmd, job_ids)
+
+    def queue_deltas(self, _cmd: str, args: str):
+        """
+        From now on, queue_status has only the id and the fields that changed since the last one. "0" goes back to
+        whole jobs.
+        """
+        QUEUE_NOTIFIER.send_changes_only(self._the_id, args.strip() != "0")
+
+    # noinspection PyUnusedLocal
+    def tarallo_outbox(self, cmd: str, args: str):
+        self.send_msg(cmd, OUTBOX.entries() if OUTBOX else [])
+
+    # noinspection PyUnusedLocal
+    def outbound_stats(self, cmd: str, args: str):
+        self.send_msg(cmd, OUTBOUND.stats())
+
+    def job_history(self, cmd: str, args: str):
+        """
+        A page of past and present jobs, newest first. Args are optional, JSON: {"before": id, "limit": 50, "serial": "..."}
+        """
+        try:
+            query = json.loads(args) if args else {}
+            before = query.get("before")
+            jobs = JOBS.history(None if before is None else int(before), min(int(query.get("limit", 50)), 500), query.get("serial"))
+        except (ValueError, TypeError, AttributeError) as e:
+            self.send_msg("error", {"message": f"Invalid job_history request: {e}", "command": cmd})
+            return
+        self.send_msg(cmd, jobs)
 
     @staticmethod
     def dev_from_args(args: str):
@@ -371,12 +834,8 @@ class CommandRunner(threading.Thread):
         return args.split(" ", 1)[0]
 
     def list_iso(self, cmd: str, iso_dir: str):
-        files = []
         try:
-            for file in os.listdir(iso_dir):
-                if file.startswith("."):
-                    continue
-                files.append(os.path.join(iso_dir, file))
+            images = CATALOGUE.list(iso_dir)
         except FileNotFoundError:
             self.send_msg(
                 "error",
@@ -401,7 +860,7 @@ class CommandRunner(threading.Thread):
                 {"message": f"Cannot list files in iso dir {iso_dir}: {str(e)}"},
             )
             return
-        self.send_msg(cmd, files)
+        self.send_msg(cmd, images)
 
     # noinspection PyMethodMayBeStatic
     def remove_all_from_queue(self, cmd: str, _unused: str):
@@ -431,24 +890,71 @@ class CommandRunner(threading.Thread):
 
                 for the_command in commands_to_remove:
                     queued_commands.remove(the_command)
+                    JOBS.removed(the_command.job_id())
+                    # Clients remove them on their own
+                    QUEUE_NOTIFIER.forget(the_command.id())
+
+                if remove_completed:
+                    # They will never run again, like completed ones
+                    for job_id in interrupted_jobs:
+                        JOBS.removed(int(job_id))
+                        QUEUE_NOTIFIER.forget(job_id)
+                    interrupted_jobs.clear()
                 logging.debug(f"Removed {len(commands_to_remove)} items from tasks list")
 
         return None
 
+    def move_in_queue(self, cmd: str, args: str):
+        """
+        "<id> first", "<id> last", "<id> up" or "<id> down", within the queue of its disk.
+        """
+        queue_id, _, where = args.partition(" ")
+        queued_command = find_queued_command(queue_id)
+        if queued_command is None or where not in ("first", "last", "up", "down"):
+            self.send_msg("error", {"message": f"Cannot move {args}", "command": cmd})
+            return
+        queued_command.disk.move(queued_command.command_runner, where)
+
+    def set_priority(self, cmd: str, args: str):
+        """
+        "<id> interactive", "<id> normal" or "<id> bulk". Jobs that have not started yet are placed again.
+        """
+        queue_id, _, priority = args.partition(" ")
+        queued_command = find_queued_command(queue_id)
+        if queued_command is None or priority not in PRIORITIES:
+            self.send_msg("error", {"message": f"Cannot set priority {args}", "command": cmd})
+            return
+        queued_command.disk.set_priority(queued_command.command_runner, PRIORITIES[priority])
+        # The priority is shown even if the place does not change
+        queued_command.notify_position()
+
     # noinspection PyMethodMayBeStatic
     def remove_one_from_queue(self, _cmd: str, queue_id: str):
+        with queued_commands_lock:
+            interrupted = interrupted_jobs.pop(queue_id, None)
+        if interrupted is not None:
+            JOBS.removed(int(queue_id))
+            QUEUE_NOTIFIER.remove(queue_id)
+            return None
         for the_cmd in queued_commands:
             if the_cmd.id_is(queue_id):
                 the_cmd.delete_when_done()
                 break
         return None
 
-    def badblocks(self, _cmd: str, dev: str):
+    def badblocks(self, _cmd: str, args: str):
+        # Options after the disk are optional: "native" to use the built-in engine, "verify" to read back, "resume" to
+        # continue from the last checkpoint (only the native engine makes them)
+        dev, *options = args.split(" ")
+        resume = "resume" in options
+        engine = "native" if "native" in options or resume else "badblocks" if "badblocks" in options else ERASE_ENGINE
+        verify = "verify" in options or ERASE_VERIFY
+
         go_ahead = self._unswap()
         if not go_ahead:
             return
 
-        self._queued_command.notify_start("Running badblocks")
+        self._queued_command.notify_start("Running badblocks" if engine == "badblocks" else "Erasing")
         if TEST_MODE:
             final_message = ""
             for progress in range(0, 100, 10):
@@ -463,81 +969,17 @@ class CommandRunner(threading.Thread):
             completed = True
             all_ok = False
         else:
-            custom_env = os.environ.copy()
-            custom_env["LC_ALL"] = "C"
-
-            pipe = subprocess.Popen(
-                (
-                    "sudo",
-                    "-n",
-                    "badblocks",
-                    "-w",
-                    "-s",
-                    "-p",
-                    "0",
-                    "-t",
-                    "0x00",
-                    "-b",
-                    "4096",
-                    dev,
-                ),
-                stderr=subprocess.PIPE,
-                env=custom_env,
-            )  # , stdout=subprocess.PIPE)
-
-            percent = 0.0
-            reading_and_comparing = False
-            errors = -1
-            deleting = False
-            buffer = bytearray()
-            for char in iter(lambda: pipe.stderr.read(1), b""):
-                if not self._go:
-                    pipe.kill()
-                    pipe.wait()
-                    print(f"Killed badblocks process {self.get_queued_command().id()}")
-                    self._queued_command.notify_finish_with_error("Process terminated by user.")
+            if engine == "native":
+                completed, errors, final_message = self._native_erase(dev, verify, resume)
+                if completed is None:
                     return
-                if char == b"":
-                    if pipe.poll() is not None:
-                        break
-                elif char == b"\b":
-                    if not deleting:
-                        result = buffer.decode("utf-8")
-                        errors_print = "?"
-
-                        reading_and_comparing = reading_and_comparing or ("Reading and comparing" in result)
-
-                        # If other messages are printed, ignore them
-                        i = result.index("% done")
-                        if i >= 0:
-                            # /2 due to the 0x00 test + read & compare
-                            percent = float(result[i - 6 : i]) / 2
-                            if reading_and_comparing:
-                                percent += 50
-                            i = result.index("(", i)
-                            if i >= 0:
-                                # errors_str = result[i+1:].split(")", 1)[0]
-                                errors_str = result[i + 1 :].split(" ", 1)[0]
-                                # The errors are read, write and corruption
-                                errors_str = errors_str.split("/")
-                                errors = 0  # badblocks prints the 3 totals every time
-                                for error in errors_str:
-                                    errors += int(error)
-                                errors_print = str(errors)
-                            self._queued_command.notify_percentage(percent, f"{errors_print} errors")
-                        buffer.clear()
-                        deleting = True
-                # elif char == b'\n':
-                #     # Skip the first lines (total number of blocks)
-                #     buffer.clear()
-                else:
-                    if deleting:
-                        deleting = False
-                    buffer += char
-
-            # TODO: was this needed? Why were we doing it twice?
-            # pipe.wait()
-            exitcode = pipe.wait()
+            else:
+                completed, errors, final_message = self._badblocks_erase(dev)
+                if completed is None:
+                    return
+                # Erased from the start anyway, a checkpoint from an interrupted native erase means nothing now
+                if completed:
+                    disks[dev].save_erase_checkpoint(None)
 
             if errors <= -1:
                 all_ok = None
@@ -548,19 +990,7 @@ class CommandRunner(threading.Thread):
             else:
                 all_ok = False
                 errors_print = str(errors)
-            final_message = f"Finished with {errors_print} errors"
-
-            if exitcode == 0:
-                # self._queued_command.notify_finish(final_message)
-                completed = True
-            else:
-                self._queued_command.notify_error()
-                final_message += f" and badblocks exited with status {exitcode}"
-                # self._queued_command.notify_finish(final_message)
-                completed = False
-
-            # print(pipe.stdout.readline().decode('utf-8'))
-            # print(pipe.stderr.readline().decode('utf-8'))
+            final_message = f"Finished with {errors_print} errors{final_message}"
 
         with disks_lock:
             update_disks_if_needed(self)
@@ -578,6 +1008,98 @@ class CommandRunner(threading.Thread):
             )
         self._queued_command.notify_finish(final_message)
 
+    def _native_erase(self, dev: str, verify: bool, resume: bool) -> (Optional[bool], int, str):
+        """
+        Returns whether the erase completed, the number of errors and a suffix for the final message.
+        None means that the command has already been finished with an error.
+        Progress is saved as an erase checkpoint of the disk, errors in the part that was done before are counted.
+        """
+
+        def progress(percent: float, rate: float, eraser: NativeEraser):
+            text = f"{eraser.errors} errors, {format_rate(rate)}"
+            if eraser.bad_lbas:
+                text += f" (LBA {', '.join(str(lba) for lba in eraser.bad_lbas)})"
+            self._queued_command.notify_percentage(percent, text)
+
+        with disks_lock:
+            disk_ref = disks[dev]
+        checkpoint = disk_ref.get_erase_checkpoint() if resume else None
+        if resume and checkpoint is None:
+            self._queued_command.notify_percentage(0.0, "Nothing to resume, erasing from the start")
+        eraser = NativeEraser(dev, verify, progress, lambda: not self._go, checkpoint=disk_ref.save_erase_checkpoint, resume=checkpoint)
+        try:
+            completed = eraser.run()
+        except OSError as e:
+            logging.warning(f"[{self._the_id}] Native erase of {dev} failed", exc_info=e)
+            self._queued_command.notify_finish_with_error(f"Cannot erase {dev}: {e.strerror}")
+            # Clients can offer to resume now
+            publish_disk_change(disk_ref)
+            return None, -1, ""
+        if eraser.stopped:
+            self._queued_command.notify_finish_with_error("Process terminated by user.")
+            publish_disk_change(disk_ref)
+            return None, -1, ""
+        suffix = ""
+        if eraser.bad_lbas:
+            suffix = f" (LBA {', '.join(str(lba) for lba in eraser.bad_lbas)}{', ...' if eraser.errors > len(eraser.bad_lbas) else ''})"
+        if not verify:
+            suffix += ", not verified"
+        if eraser.resumed_at > 0:
+            suffix += f", resumed at {eraser.resumed_at:.1f}%"
+        disk_ref.save_erase_checkpoint(None)
+        return completed, eraser.errors, suffix
+
+    def _badblocks_erase(self, dev: str) -> (Optional[bool], int, str):
+        custom_env = os.environ.copy()
+        custom_env["LC_ALL"] = "C"
+
+        pipe = subprocess.Popen(
+            (
+                "sudo",
+                "-n",
+                "badblocks",
+                "-w",
+                "-s",
+                "-p",
+                "0",
+                "-t",
+                "0x00",
+                "-b",
+                "4096",
+                dev,
+            ),
+            stderr=subprocess.PIPE,
+            env=custom_env,
+        )  # , stdout=subprocess.PIPE)
+
+        parser = BadblocksProgressParser()
+        stderr_fd = pipe.stderr.fileno()
+        while True:
+            if not self._go:
+                pipe.kill()
+                pipe.wait()
+                logging.info(f"[{self._the_id}] Killed badblocks process {self.get_queued_command().id()}")
+                self._queued_command.notify_finish_with_error("Process terminated by user.")
+                return None, -1, ""
+            chunk = os.read(stderr_fd, BadblocksProgressParser.CHUNK_SIZE)
+            if not chunk:
+                break
+            events = parser.feed(chunk)
+            # Intermediate updates in the same chunk are already stale, send only the last one
+            if len(events) > 0:
+                self._queued_command.notify_percentage(events[-1]["percent"], f"{events[-1]['errors']} errors")
+        parser.finish()
+        errors = parser.errors
+
+        # TODO: was this needed? Why were we doing it twice?
+        # pipe.wait()
+        exitcode = pipe.wait()
+
+        if exitcode == 0:
+            return True, errors, ""
+        self._queued_command.notify_error()
+        return False, errors, f" and badblocks exited with status {exitcode}"
+
     def ping(self, _cmd: str, _nothing: str):
         self.send_msg("pong", None)
 
@@ -595,12 +1117,8 @@ class CommandRunner(threading.Thread):
 
     @staticmethod
     def _get_last_linux_partition_path_and_number(dev: str) -> tuple[str, str] | tuple[None, None]:
-        # Use PTTYPE to get MBR/GPT (dos/gpt are the possible values)
-        # PARTTYPENAME could be useful, too
-        output = subprocess.getoutput(f"lsblk -o PATH,PARTN,PARTTYPE -J {dev}")
-        jsonized = json.loads(output)
-        for entry in reversed(jsonized["blockdevices"]):
-            if entry["partn"] and entry["path"]:  # lsblk also returns the device itself, which has no partitions
+        for disk in get_disks(dev):
+            for entry in reversed(disk["partitions"]):
                 # GPT or MBR Linux partition ID
                 if entry["parttype"] == "0fc63daf-8483-4772-8e79-3d69d8477de4" or entry["parttype"] == "0x83":
                     return entry["path"], entry["partn"]
@@ -650,7 +1168,15 @@ class CommandRunner(threading.Thread):
             self._queued_command.notify_percentage(90)
             threading.Event().wait(2)
         else:
-            success = self.dd(iso, dev)
+            with disks_lock:
+                # What was erased before is not zeros anymore
+                disks[dev].save_erase_checkpoint(None)
+            hashes = [] if IMAGING_VERIFY else None
+            success = self.dd(iso, dev, hashes)
+            if not success:
+                self._queued_command.notify_error(f"Disk imaging failed")
+            elif hashes is not None:
+                success = self._verify_image(dev, hashes)
             if success:
                 part_path, part_number = self._get_last_linux_partition_path_and_number(dev)
 
@@ -667,8 +1193,6 @@ class CommandRunner(threading.Thread):
                         self._queued_command.notify_error(f"e2fsck failed")
                 else:
                     self._queued_command.notify_error(f"growpart failed")
-            else:
-                self._queued_command.notify_error(f"Disk imaging failed")
 
         if success:
             with disks_lock:
@@ -678,7 +1202,7 @@ class CommandRunner(threading.Thread):
             pretty_iso = self._pretty_print_iso(iso)
             self._queued_command.notify_percentage(100.0, f"{pretty_iso} installed!")
 
-            final_message = f"{pretty_iso} installed, Tarallo updated"
+            final_message = f"{pretty_iso} installed, Tarallo {'update queued' if OUTBOX else 'updated'}"
             # noinspection PyBroadException
             try:
                 disk_ref.update_software(pretty_iso)
@@ -704,21 +1228,14 @@ class CommandRunner(threading.Thread):
 
     def _umount_internal(self, dev):
         try:
-            result = subprocess.run(["lsblk", "-J", dev], capture_output=True, text=True)
-
-            if result.returncode != 0:
+            found = get_disks(dev)
+            if not found:
                 return False
 
-            lsblk_output = json.loads(result.stdout)
-
             partitions_to_unmount = []
-            blockdevices = lsblk_output.get("blockdevices", [])
-            for device in blockdevices:
-                if "children" in device:
-                    for partition in device["children"]:
-                        if "mountpoints" in partition and len(partition["mountpoints"]) > 0:
-                            partitions_to_unmount.append(f"/dev/{partition['name']}")
-                    break
+            for partition in found[0]["partitions"]:
+                if partition["mountpoint"] is not None and partition["mountpoint"] != "[SWAP]":
+                    partitions_to_unmount.append(partition["path"])
 
             if not partitions_to_unmount:
                 return True
@@ -795,16 +1312,37 @@ class CommandRunner(threading.Thread):
         return self._call_shell_command(("sudo", "hdparm", "-Y", dev))
 
     def get_smartctl(self, cmd: str, args: str):
-        params = self._get_smartctl(args, False)
+        params, _ = self._get_smartctl(args, False)
         if params:
             self.send_msg(cmd, params)
 
     def queued_get_smartctl(self, cmd: str, args: str):
-        params = self._get_smartctl(args, True)
+        params, _ = self._get_smartctl(args, True)
         if params:
             self.send_msg(cmd, params)
 
-    def _get_smartctl(self, dev: str, queued: bool):
+    def get_smartctl_detail(self, cmd: str, args: str):
+        """
+        Everything smartctl said about a disk, from the last smartctl or queued_smartctl, or from a new one if there
+        was none.
+        """
+        with disks_lock:
+            disk_ref = disks.get(args)
+        detail = disk_ref.get_smartctl() if disk_ref else None
+        if detail is None:
+            params, detail = self._get_smartctl(args, False)
+            status = params["status"]
+        else:
+            status = detail["summary"]["status"]
+        if detail is None:
+            self.send_msg("error", {"message": f"No smartctl output for {args}", "command": cmd})
+            return
+        self.send_msg(cmd, {"disk": args, "status": status, "detail": detail["smartctl"]})
+
+    def _get_smartctl(self, dev: str, queued: bool) -> (dict, Optional[dict]):
+        """
+        The message for clients, with the summary only, and everything else smartctl said (None if it failed).
+        """
         if queued:
             self._queued_command.notify_start("Getting smarter")
 
@@ -829,32 +1367,26 @@ class CommandRunner(threading.Thread):
                 smartctl_returned_valid = True
 
         updated = False
-        status = None
+        detail = None
+        summary = {"status": None, "failing_now": None, "attributes": None}
 
         if smartctl_returned_valid:
-            status = get_smartctl_status(output)
+            detail = parse_smartctl(output)
+            if detail:
+                summary = detail["summary"]
+                with disks_lock:
+                    disk_ref = disks.get(dev)
+                if disk_ref:
+                    disk_ref.set_smartctl(detail)
+            status = summary["status"]
             if queued:
                 if not status:
                     self._queued_command.notify_error("Error while parsing smartctl status")
-                    return {
-                        "disk": dev,
-                        "status": status,
-                        "updated": updated,
-                        "exitcode": exitcode,
-                        "output": output,
-                        "stderr": stderr,
-                    }
+                    return {"disk": dev, **summary, "updated": updated, "exitcode": exitcode, "stderr": stderr}, detail
         else:
             if queued:
                 self._queued_command.notify_error("smartctl failed")
-            return {
-                "disk": dev,
-                "status": status,
-                "updated": updated,
-                "exitcode": exitcode,
-                "output": output,
-                "stderr": stderr,
-            }
+            return {"disk": dev, **summary, "updated": updated, "exitcode": exitcode, "stderr": stderr}, detail
 
         if queued and status:
             self._queued_command.notify_percentage(50.0, "Updating tarallo if needed")
@@ -873,14 +1405,7 @@ class CommandRunner(threading.Thread):
                     exc_info=e,
                 )
             self._queued_command.notify_finish(f"Disk is {status}")
-        return {
-            "disk": dev,
-            "status": status,
-            "updated": updated,
-            "exitcode": exitcode,
-            "output": output,
-            "stderr": stderr,
-        }
+        return {"disk": dev, **summary, "updated": updated, "exitcode": exitcode, "stderr": stderr}, detail
 
     # noinspection PyUnusedLocal
     def queued_upload_to_tarallo(self, cmd: str, args: str):
@@ -890,6 +1415,20 @@ class CommandRunner(threading.Thread):
     def upload_to_tarallo(self, cmd: str, args: str):
         self._upload_to_tarallo(args, False)
 
+    # noinspection PyUnusedLocal
+    def upload_to_tarallo_bulk(self, cmd: str, args: str):
+        """
+        Location followed by any number of disks. Each disk gets its own queued_upload_to_tarallo, so they all run at
+        the same time (each on its own disk queue, with its own Tarallo session) and report on their own queue entry.
+        """
+        loc, *devs = args.split(" ")
+        if not loc or not devs:
+            self.send_msg("error", {"message": "Specify a location and at least one disk", "command": cmd})
+            return
+        logging.info(f"[{self._the_id}] Uploading {len(devs)} disks to tarallo in {loc}")
+        for dev in devs:
+            CommandRunner("queued_upload_to_tarallo", f"{dev} {loc}", self._the_id)
+
     def _upload_to_tarallo(self, dev: str, queued: bool):
         list_dev = dev.split(" ")
         dev = list_dev[0]
@@ -901,27 +1440,19 @@ class CommandRunner(threading.Thread):
         if queued:
             self._queued_command.notify_start("Preparing to upload")
 
-        # return {
-        #     "disk": dev,
-        #     "status": status,
-        #     "updated": updated,
-        #     "exitcode": exitcode,
-        #     "output": output,
-        #     "stderr": stderr,
-        # }
-        smartctl = self._get_smartctl(dev, False)
+        smartctl, detail = self._get_smartctl(dev, False)
 
         if queued:
             self._queued_command.notify_percentage(50.0, "smartctl output obtained")
 
-        if queued and not smartctl.get("output"):
+        if queued and not detail:
             self._queued_command.notify_finish_with_error("Could not get smartctl output")
             return
 
         if queued and not smartctl.get("status"):
             self._queued_command.notify_error("Could not determine disk status")
 
-        features = parse_single_disk(json.loads(smartctl.get("output", "")))
+        features = parse_single_disk(detail["smartctl"])
 
         if queued:
             self._queued_command.notify_percentage(75.0, "Parsing done")
@@ -954,7 +1485,8 @@ class CommandRunner(threading.Thread):
                 disk_ref.set_code(code)
 
             try:
-                disk_ref.update_from_tarallo_if_needed()
+                # It has just been added, "not found" in the cache is wrong
+                disk_ref.update_from_tarallo_if_needed(True)
             except ErrorThatCanBeManuallyFixed as e:
                 if queued:
                     self.send_msg(
@@ -968,10 +1500,6 @@ class CommandRunner(threading.Thread):
         if queued:
             self._queued_command.notify_finish("Upload done")
 
-    @staticmethod
-    def _encode_param(param):
-        return json.dumps(param, separators=(",", ":"), indent=None)
-
     def send_msg(self, cmd: str, param=None, the_id: Optional[int] = None):
         logging.debug(f"[{self._the_id}] Sending {cmd}{ ' with args' if param else ''} to client")
         the_id = the_id or self._the_id
@@ -982,14 +1510,7 @@ class CommandRunner(threading.Thread):
             thread: TurboProtocol
             # noinspection PyBroadException
             try:
-                if param is None:
-                    response_string = cmd
-                else:
-                    j_param = self._encode_param(param)
-                    response_string = f"{cmd} {j_param}"
-                # It's there but pycharm doesn't believe it
-                # noinspection PyUnresolvedReferences
-                reactor.callFromThread(TurboProtocol.send_msg, thread, response_string)
+                OUTBOUND.put([thread], Message(cmd, param))
             except BaseException:
                 logging.warning(f"[{the_id}] Something blew up while trying to send {cmd} (connection already closed?)")
 
@@ -1009,41 +1530,97 @@ class CommandRunner(threading.Thread):
         filename = filename.replace("-", " ").replace("_", " ")
         return filename
 
-    def dd(self, inputf: str, outputf: str, bs: int = 4096, output_delay: float = 1.0):
-        if os.path.exists(inputf):
-            try:
-                with open(inputf, "rb") as fin:
-                    print("Input file opened successfully!")
-                    with open(outputf, "wb") as fout:
-                        print("Output file opened successfully!")
-                        s = os.stat(inputf).st_mode
-                        is_special = stat.S_ISBLK(s) or stat.S_ISCHR(s)
-                        total_size = get_block_size(outputf) if is_special else os.path.getsize(inputf)
-                        completed_size = 0
-                        elapsed_time = 0
-                        actual_time = time.time()
-                        while True:
-                            if fout.write(fin.read(bs)) == 0:
-                                break
-                            completed_size += bs
-                            if elapsed_time > output_delay:
-                                percentage = (completed_size / total_size) * 100
-                                self._queued_command.notify_percentage(percentage)
-                                elapsed_time = 0
-                            else:
-                                elapsed_time += time.time() - actual_time
-                                actual_time = time.time()
-                        return True
-            except KeyboardInterrupt:
-                print("\nInterrupted!")
-                os.system("sync")
-                return False
-        else:
+    def dd(self, inputf: str, outputf: str, hashes: Optional[List[tuple]] = None) -> bool:
+        """
+        Write an image to a disk. If hashes is a list, it is filled with the hashes of what has been written.
+        """
+        if not os.path.exists(inputf):
             return False
 
+        def progress(percent: float, rate: float, stages: Optional[str]):
+            text = f"Cannoling, {format_rate(rate)}"
+            if stages:
+                text += f" ({stages})"
+            self._queued_command.notify_percentage(percent, text)
+
+        fan_out, writer_id = self._join_fan_out(inputf, outputf)
+        try:
+            if fan_out:
+                completed = fan_out.write_to(writer_id, outputf, progress, lambda: not self._go, hashes)
+                method = f"fan-out to {fan_out.targets()} disks"
+            else:
+                block_map = None if compression_of(inputf) else BlockMap.for_image(inputf)
+                writer = ImageWriter(inputf, outputf, IMAGING_BLOCK_SIZE, progress, lambda: not self._go, block_map=block_map, gaps=IMAGING_GAPS, hashes=hashes)
+                completed = writer.run()
+                method = writer.method
+        except OSError as e:
+            logging.warning(f"[{self._the_id}] Writing {inputf} to {outputf} failed", exc_info=e)
+            return False
+        logging.debug(f"[{self._the_id}] Wrote {inputf} to {outputf} with {method}")
+        return completed
+
+    def _verify_image(self, dev: str, hashes: List[tuple]) -> bool:
+        """
+        Read back the disk and compare it with the hashes taken by dd. Errors are notified here.
+        """
+
+        def progress(percent: float, rate: float, _stages: Optional[str]):
+            self._queued_command.notify_percentage(percent, f"Verifying, {format_rate(rate)}")
+
+        verifier = ReadBackVerifier(dev, hashes, progress, lambda: not self._go)
+        try:
+            mismatches = verifier.run()
+        except OSError as e:
+            logging.warning(f"[{self._the_id}] Reading back {dev} failed", exc_info=e)
+            self._queued_command.notify_error(f"Verification failed, cannot read {dev}: {e}")
+            return False
+        if verifier.stopped:
+            self._queued_command.notify_error(f"Verification stopped")
+            return False
+        if mismatches:
+            regions = ", ".join(f"{offset // 1048576}-{-(-(offset + length) // 1048576)} MiB" for offset, length in mismatches[:5])
+            if len(mismatches) > 5:
+                regions += f" and {len(mismatches) - 5} more"
+            self._queued_command.notify_error(f"Verification failed, {dev} differs from the image at {regions}")
+            return False
+        logging.info(f"[{self._the_id}] {dev} matches the image ({verifier.verified} bytes)")
+        return True
+
+    @staticmethod
+    def _join_fan_out(inputf: str, outputf: str) -> (Optional[FanOut], Optional[int]):
+        """
+        Cannolo jobs for the same image that start within FANOUT_WINDOW seconds share a single reader.
+        The first one waits for the others, then starts reading. Returns None if it turns out to be alone.
+        """
+        if FANOUT_WINDOW <= 0:
+            return None, None
+        with fan_outs_lock:
+            fan_out = fan_outs.get(inputf)
+            leader = fan_out is None
+            if leader:
+                block_map = None if compression_of(inputf) else BlockMap.for_image(inputf)
+                fan_out = FanOut(inputf, IMAGING_BLOCK_SIZE or optimal_chunk_size(outputf), block_map=block_map, gaps=IMAGING_GAPS, hash_chunks=IMAGING_VERIFY)
+                fan_outs[inputf] = fan_out
+            writer_id = fan_out.add_target()
+        if not leader:
+            return fan_out, writer_id
+
+        threading.Event().wait(FANOUT_WINDOW)
+        with fan_outs_lock:
+            # Too late to join from now on
+            del fan_outs[inputf]
+        if fan_out.targets() <= 1:
+            return None, None
+        logging.info(f"Writing {inputf} to {fan_out.targets()} disks at once")
+        fan_out.start()
+        return fan_out, writer_id
+
     def stop_process(self, cmd: str, args: str):
         logging.debug(f"Received stop request for {args}")
         thread = find_thread_from_pid(args)
+        if thread is None:
+            logging.debug(f"No command with id {args}")
+            return
         thread.stop_asap()
 
     def _call_shell_command(self, command: tuple):
@@ -1082,9 +1659,12 @@ class QueuedCommand:
         self._text = "Queued"
         self._to_delete = False
         self._deleted = False
-        date = datetime.today().strftime("%Y%m%d%H%M")
+        # Place in the queue of the disk, 0 is running or next to run. Set by the disk.
+        self.position: Optional[int] = None
+        serial, wwn, code = disk.get_identity()
+        self._job_id = JOBS.add(command_runner.get_cmd(), command_runner.get_args(), self._target, serial, wwn, code)
+        self._id = str(self._job_id)
         with queued_commands_lock:
-            self._id = f"{date}-{str(len(queued_commands))}"
             queued_commands.append(self)
         with self._notifications_lock:
             self.send_to_all_clients()
@@ -1095,11 +1675,8 @@ class QueuedCommand:
     def id(self):
         return self._id
 
-    def lock_notifications(self):
-        self._notifications_lock.acquire()
-
-    def unlock_notifications(self):
-        self._notifications_lock.release()
+    def job_id(self) -> int:
+        return self._job_id
 
     def notify_start(self, text: Optional[str] = None):
         with self._notifications_lock:
@@ -1107,6 +1684,7 @@ class QueuedCommand:
                 self._text = text
             self._started = True
             self._percentage = 0.0
+            JOBS.started(self._job_id, text)
             self.send_to_all_clients()
 
     def notify_finish_safe(self, text: Optional[str] = None):
@@ -1122,6 +1700,7 @@ class QueuedCommand:
                 self._text = text
             self._finished = True
             self._percentage = 100.0
+            JOBS.finished(self._job_id, self._final_state(), self._text)
             self.send_to_all_clients()
 
             if self._to_delete:
@@ -1134,6 +1713,7 @@ class QueuedCommand:
             self._finished = True
             self._error = True
             self._percentage = 100.0
+            JOBS.finished(self._job_id, self._final_state(), self._text)
             self.send_to_all_clients()
 
             if self._to_delete:
@@ -1144,6 +1724,7 @@ class QueuedCommand:
             if text is not None:
                 self._text = text
             self._error = True
+            JOBS.failed(self._job_id, text)
             self.send_to_all_clients()
 
     def notify_stopped(self, text: Optional[str] = None):
@@ -1158,8 +1739,18 @@ class QueuedCommand:
             if text is not None:
                 self._text = text
             self._percentage = percent
+            # Progress can wait a bit, it is coalesced with the next ticks
+            self.send_to_all_clients(now=False)
+
+    def notify_position(self):
+        with self._notifications_lock:
             self.send_to_all_clients()
 
+    def _final_state(self) -> str:
+        if self._stopped:
+            return STOPPED
+        return FAILED if self._error else FINISHED
+
     def delete_when_done(self):
         self._to_delete = True
         # Locking is pointless, notify_delete must be called after releasing the lock anyway
@@ -1175,6 +1766,7 @@ class QueuedCommand:
                 try:
                     queued_commands.remove(self)
                     self._deleted = True
+                    JOBS.removed(self._job_id)
                 except ValueError:
                     # Already deleted, do not send anything
                     pass
@@ -1183,24 +1775,17 @@ class QueuedCommand:
             if self._deleted:
                 self.delete_from_all_clients()
 
-    def send_to_all_clients(self):
+    def send_to_all_clients(self, now: bool = True):
         # For added safety, do not send updates of deleted rows (the reference may still exist)
         if self._deleted:
             return
 
-        param = self.serialize_me()
-        # logging.debug(f"[ALL] Sending queue update for {self.command_runner.get_cmd()}")
-        for client in clients:
-            # send_msg calls reactor.callFromThread and reactor is single threaded, so no risk here
-            # send_all is always called with a lock, so all status updates are sent in the expected order
-            self.command_runner.send_msg("queue_status", param, client)
+        # Always called with the lock, so the notifier gets the updates in the expected order and sends them in that order
+        QUEUE_NOTIFIER.update(self.serialize_me(), now)
 
     def delete_from_all_clients(self):
-        param = {
-            "id": self._id,
-        }
-        for client in clients:
-            self.command_runner.send_msg("remove", param, client)
+        # Also drops any progress that has not been sent yet
+        QUEUE_NOTIFIER.remove(self._id)
 
     def serialize_me(self) -> dict:
         return {
@@ -1214,15 +1799,32 @@ class QueuedCommand:
             "error": self._error,
             "stale": self._stale,
             "stopped": self._stopped,
+            "priority": PRIORITY_NAMES[self.command_runner.priority],
+            "position": self.position,
         }
 
 
-class TurboProtocol(LineOnlyReceiver):
+class TurboProtocol(LineReceiver):
     def __init__(self):
         global needs_sudo
         self._id = -1
         self.delimiter = b"\n"
         self._delimiter_found = False
+        # Frames instead of lines, after the client asks with "protocol 2"
+        self.binary = False
+        self._decoder: Optional[FrameDecoder] = None
+        # Lines waiting for the client to read what it already has, None if it is keeping up
+        self._backlog: Optional[Backlog] = None
+        self._stall_timer = None
+        # Longest message the client accepts in one piece, None if it does not know about chunks
+        self._chunk_length: Optional[int] = None
+        self._chunk_zlib = False
+        self._transfer_ids = itertools.count(1)
+        # Chunks of large messages, and the messages that came after them, sent one at a time: (message, job ids in it)
+        self._transfers = deque()
+        self._transfer_call = None
+        # Job id -> how many messages in _transfers carry it, updates to these jobs cannot overtake them
+        self._held_jobs: Dict[str, int] = {}
         needs_sudo = self.sudo_needs_password()
 
     def connectionMade(self):
@@ -1230,12 +1832,65 @@ class TurboProtocol(LineOnlyReceiver):
         self.factory.conn_id += 1
         with clients_lock:
             clients[self._id] = self
+        # Twisted calls pauseProducing when the client is not reading and too much is waiting to be sent
+        self.transport.registerProducer(self, True)
         logging.debug(f"[{str(self._id)}] Client connected")
 
     def connectionLost(self, reason=protocol.connectionDone):
         logging.debug(f"[{str(self._id)}] Client disconnected")
         with clients_lock:
             del clients[self._id]
+        QUEUE_NOTIFIER.client_gone(self._id)
+        self.stopProducing()
+        self._transfers.clear()
+        self._held_jobs.clear()
+        if self._transfer_call is not None and self._transfer_call.active():
+            self._transfer_call.cancel()
+
+    def pauseProducing(self):
+        if self._backlog is not None:
+            return
+        logging.debug(f"[{str(self._id)}] Client is not keeping up, sending only the latest state of each job")
+        self._backlog = Backlog()
+        OUTBOUND.client_paused()
+        if SLOW_CLIENT_TIMEOUT > 0:
+            # noinspection PyUnresolvedReferences
+            self._stall_timer = reactor.callLater(SLOW_CLIENT_TIMEOUT, self._too_slow, f"behind for {SLOW_CLIENT_TIMEOUT} s")
+
+    def resumeProducing(self):
+        if self._backlog is None:
+            return
+        backlog = self._backlog
+        self._backlog = None
+        self._cancel_stall_timer()
+        OUTBOUND.client_resumed(backlog.dropped)
+        logging.debug(f"[{str(self._id)}] Client caught up, {backlog.dropped} updates were dropped")
+        messages = backlog.messages()
+        if messages:
+            self.send_messages(messages)
+        self._schedule_transfer()
+
+    def stopProducing(self):
+        if self._backlog is not None:
+            OUTBOUND.client_resumed(self._backlog.dropped)
+            self._backlog = None
+        self._cancel_stall_timer()
+
+    def _too_slow(self, why: str):
+        # The timer is still pending when the backlog overflows first
+        self._cancel_stall_timer()
+        if self._backlog is None:
+            return
+        logging.warning(f"[{str(self._id)}] Disconnecting client, {why}")
+        OUTBOUND.client_disconnected(self._backlog.dropped)
+        self._backlog = None
+        # Not loseConnection, that waits for the client to read everything
+        self.transport.abortConnection()
+
+    def _cancel_stall_timer(self):
+        if self._stall_timer is not None and self._stall_timer.active():
+            self._stall_timer.cancel()
+        self._stall_timer = None
 
     def lineReceived(self, line):
         try:
@@ -1259,34 +1914,204 @@ class TurboProtocol(LineOnlyReceiver):
 
         # Strip \r on first message (if \r\n) and any trailing whitespace
         line = line.strip()
-        if line.startswith("exit"):
+        parts = line.split(" ", 1)
+        self._command_received(parts[0].lower(), parts[1] if len(parts) > 1 else "")
+
+    def rawDataReceived(self, data: bytes):
+        try:
+            messages = self._decoder.feed(data)
+        except ProtocolError as e:
+            logging.warning(f"[{str(self._id)}] Invalid frame, closing connection: {e}")
+            self.transport.loseConnection()
+            return
+        for cmd, args in messages:
+            if self.transport.disconnecting:
+                return
+            self._command_received(cmd.lower(), "" if args is None else str(args))
+
+    def _command_received(self, cmd: str, args: str):
+        if cmd.startswith("exit"):
             logging.debug(f"[{str(self._id)}] Client sent exit, closing connection")
             self.transport.loseConnection()
+        elif cmd == "protocol":
+            # Here and not in a thread: whatever comes after this line may already be frames
+            self._negotiate(args)
+        elif cmd == "chunked":
+            # Same, the answer to the next command may already need chunks
+            self._set_chunking(args)
         else:
-            parts = line.split(" ", 1)
-            cmd = parts[0].lower()
-            args = parts[1] if len(parts) > 1 else ""
-
             # Create the thread. It will enqueue and/or start itself.
             CommandRunner(cmd, args, self._id)
 
+    def _negotiate(self, version: str):
+        if self.binary:
+            return
+        try:
+            wanted = int(version)
+        except ValueError:
+            wanted = 1
+        if BINARY_PROTOCOL and wanted >= BINARY_VERSION:
+            # The answer is the last line, messages still in OUTBOUND are sent as frames
+            self.sendLine(f"protocol {BINARY_VERSION}".encode("utf-8"))
+            self.binary = True
+            self._decoder = FrameDecoder(self.MAX_LENGTH)
+            self.setRawMode()
+            logging.debug(f"[{str(self._id)}] Client switched to protocol {BINARY_VERSION}")
+        else:
+            self.sendLine(b"protocol 1")
+
     def send_msg(self, response: str):
         if self._delimiter_found:
             self.sendLine(response.encode("utf-8"))
         else:
             logging.warning(f"[{str(self._id)}] Cannot send command to client due to unknown delimiter: {response}")
 
+    def _set_chunking(self, args: str):
+        """
+        "<max line length> [zlib]": messages longer than that are split in chunks, see chunking.py.
+        """
+        parts = args.split()
+        try:
+            length = int(parts[0])
+        except (IndexError, ValueError):
+            logging.warning(f"[{str(self._id)}] Invalid chunked request: {args}")
+            return
+        self._chunk_length = max(min(length, CHUNK_LENGTH), MIN_LINE_LENGTH)
+        self._chunk_zlib = "zlib" in parts[1:]
+
+    def send_messages(self, messages: List[Message]):
+        # Like send_msg for many messages at once, in a single write. Messages are shared with other clients.
+        if self._backlog is not None:
+            for message in messages:
+                self._backlog.add(message)
+            if SLOW_CLIENT_BACKLOG > 0 and len(self._backlog) > SLOW_CLIENT_BACKLOG:
+                self._too_slow(f"more than {SLOW_CLIENT_BACKLOG} messages waiting")
+            return
+        now = []
+        for message in messages:
+            too_long = self._chunk_length is not None and len(message.encoded(self.binary)) > self._chunk_length
+            if too_long:
+                *chunks, last = self._chunks_of(message)
+                for chunk in chunks:
+                    self._hold(chunk, set())
+                # Jobs in it (e.g. a long get_queue) are held until the client has all of it
+                self._hold(last, self._job_ids(message))
+            elif self._transfers and (message.cmd not in ("queue_status", "remove") or self._job_ids(message) & self._held_jobs.keys()):
+                # Behind the large message, to keep the order. Progress of other jobs can go first: if the client
+                # does not know them yet, they are not in there and it will get them whole.
+                self._hold(message, self._job_ids(message))
+            else:
+                now.append(message)
+        if now:
+            self._write(now)
+        self._schedule_transfer()
+
+    def _chunks_of(self, message: Message) -> List[Message]:
+        if self.binary:
+            payload = pack(message.param)
+        else:
+            payload = message.encoded(False)[len(message.cmd) + 1 :]
+        chunks = split_in_chunks(message.cmd, payload, next(self._transfer_ids), self._chunk_length, self._chunk_zlib, self.binary)
+        logging.debug(f"[{str(self._id)}] Sending {message.cmd} in {len(chunks)} chunks")
+        return [Message("chunk", chunk) for chunk in chunks]
+
+    def _schedule_transfer(self):
+        if self._transfers and self._backlog is None and (self._transfer_call is None or not self._transfer_call.active()):
+            # Next reactor iteration, so anything else that is ready gets sent in between
+            # noinspection PyUnresolvedReferences
+            self._transfer_call = reactor.callLater(0, self._send_transfer)
+
+    def _send_transfer(self):
+        # A client that is not reading gets the rest when it catches up, see resumeProducing
+        if not self._transfers or self._backlog is not None:
+            return
+        message, job_ids = self._transfers.popleft()
+        self._write([message])
+        for job_id in job_ids:
+            self._held_jobs[job_id] -= 1
+            if self._held_jobs[job_id] <= 0:
+                del self._held_jobs[job_id]
+        self._schedule_transfer()
+
+    def _hold(self, message: Message, job_ids: Set[str]):
+        self._transfers.append((message, job_ids))
+        for job_id in job_ids:
+            self._held_jobs[job_id] = self._held_jobs.get(job_id, 0) + 1
+
+    @staticmethod
+    def _job_ids(message: Message) -> Set[str]:
+        if message.cmd in ("queue_status", "remove") and isinstance(message.param, dict) and "id" in message.param:
+            return {message.param["id"]}
+        if message.cmd == "get_queue" and isinstance(message.param, list):
+            return {job["id"] for job in message.param if isinstance(job, dict) and "id" in job}
+        return set()
+
+    def _write(self, messages: List[Message]):
+        if self.binary:
+            self.transport.write(b"".join(message.encoded(True) for message in messages))
+        elif self._delimiter_found:
+            self.transport.write(self.delimiter.join(message.encoded(False) for message in messages) + self.delimiter)
+        else:
+            logging.warning(f"[{str(self._id)}] Cannot send {len(messages)} messages to client due to unknown delimiter")
+
     def sudo_needs_password(self):
         exitcode = subprocess.run(["sudo", "-nv"])
         return exitcode.returncode != 0
 
 
+def tarallo_session() -> Tarallo.Tarallo:
+    """
+    A Tarallo session for the calling thread, with the same URL and token as TARALLO. pytarallo keeps the last response
+    in the object, so threads that upload at the same time cannot share one.
+    """
+    session = getattr(tarallo_sessions, "tarallo", None)
+    if session is None:
+        session = tarallo_sessions.tarallo = Tarallo.Tarallo(TARALLO.url, TARALLO.token)
+    return session
+
+
 def update_disks_if_needed(this_thread: Optional[CommandRunner], send: bool = True):  # , disk: Optional[str] = None):
+    with disks_lock:
+        added = []
+        changes = False
+        if DISK_MONITOR is None:
+            added, removed, changed = rescan_disks()
+            changes = bool(added or removed or changed)
+        # Otherwise the list of disks is kept up to date by kernel events, only Tarallo needs to be asked again
+
+        for path in disks:
+            if path in added:
+                continue
+            try:
+                more_changes = disks[path].update_from_tarallo_if_needed()
+                changes = changes or more_changes
+            except ErrorThatCanBeManuallyFixed as e:
+                if this_thread:
+                    this_thread.send_msg(
+                        "error_that_can_be_manually_fixed",
+                        {"message": str(e), "disk": path},
+                    )
+
+        if send and changes and this_thread:
+            result = []
+            with disks_lock:
+                for disk in disks:
+                    result.append(disks[disk].serialize_disk())
+            this_thread.send_msg("get_disks", result)
+
+
+def rescan_disks() -> (List[str], List[str], List[str]):
+    """
+    Compare lsblk with the known disks and apply the differences.
+    Returns the paths of added, removed and changed disks. A different disk in the same path is removed and added.
+    """
     with disks_lock:
         disks_lsblk = get_disks()
         found_disks = set()
+        added = []
+        removed = []
+        changed = []
 
-        changes = False
         for lsblk in disks_lsblk:
             path = lsblk.get("path")
             if path:
@@ -1299,19 +2124,12 @@ def update_disks_if_needed(this_thread: Optional[CommandRunner], send: bool = Tr
             add = False
             if path in disks:
                 if disks[path].compare_composite_id(lsblk):
-                    try:
-                        more_changes = disks[path].update_from_tarallo_if_needed()
-                        changes = changes or more_changes
-                    except ErrorThatCanBeManuallyFixed as e:
-                        if this_thread:
-                            this_thread.send_msg(
-                                "error_that_can_be_manually_fixed",
-                                {"message": str(e), "disk": path},
-                            )
-
+                    if disks[path].update_from_lsblk(lsblk):
+                        changed.append(path)
                 else:
                     logging.info(f"Disk {path} has changed")
                     del disks[path]
+                    removed.append(path)
                     add = True
             else:
                 logging.info(f"Disk {path} is new")
@@ -1321,7 +2139,7 @@ def update_disks_if_needed(this_thread: Optional[CommandRunner], send: bool = Tr
                 try:
                     global TARALLO
                     disks[path] = Disk(lsblk, TARALLO)
-                    changes = True
+                    added.append(path)
                 except BaseException as e:
                     logging.warning("Exception while re-scanning for disks, skipping", exc_info=e)
 
@@ -1336,14 +2154,55 @@ def update_disks_if_needed(this_thread: Optional[CommandRunner], send: bool = Tr
 
         for path in to_delete:
             del disks[path]
-            changes = True
+            removed.append(path)
 
-        if send and changes and this_thread:
-            result = []
-            with disks_lock:
-                for disk in disks:
-                    result.append(disks[disk].serialize_disk())
-            this_thread.send_msg("get_disks", result)
+        return added, removed, changed
+
+
+def on_disk_events(events: List[str]):
+    """
+    Called by DISK_MONITOR, pushes what changed to every client.
+    """
+    logging.debug(f"Disk events: {', '.join(events)}")
+    with disks_lock:
+        added, removed, changed = rescan_disks()
+        for path in removed:
+            send_to_all_clients("disk_removed", {"path": path})
+        for path in added:
+            send_to_all_clients("disk_added", disks[path].serialize_disk())
+        for path in changed:
+            send_to_all_clients("disk_changed", disks[path].serialize_disk())
+
+
+def publish_disk_change(disk: Disk):
+    """
+    Send a disk again to every client, if it is still there.
+    """
+    with disks_lock:
+        if disks.get(disk.get_path()) is not disk:
+            return
+        send_to_all_clients("disk_changed", disk.serialize_disk())
+
+
+def send_to_clients(the_ids: Optional[List[int]], cmd: str, param=None):
+    """
+    Queue a message for some clients (all of them if the_ids is None), encoded once for each protocol. The caller
+    keeps messages in order, like send_to_all_clients.
+    """
+    with clients_lock:
+        if the_ids is None:
+            targets = list(clients.values())
+        else:
+            targets = [clients[the_id] for the_id in the_ids if the_id in clients]
+    if targets:
+        OUTBOUND.put(targets, Message(cmd, param))
+
+
+def send_to_all_clients(cmd: str, param=None):
+    """
+    For messages that do not come from a command. The lock on disks (or whatever is being sent) keeps them in order.
+    """
+    send_to_clients(None, cmd, param)
 
 
 def scan_for_disks():
@@ -1366,21 +2225,104 @@ def scan_for_disks():
 
 
 def get_disks(path: Optional[str] = None):
-    disks_lsblk = get_disks_linux(path)
-    return disks_lsblk
+    if DISK_SCAN == "lsblk":
+        return get_disks_linux(path)
+    return get_disks_sysfs(path)
 
 
-def find_thread_from_pid(pinolo_pid: str) -> CommandRunner:
-    for thread in threading.enumerate():
-        if isinstance(thread, CommandRunner):
-            command = thread.get_queued_command()
-            if command is None:
-                continue
+def connected_clients() -> List[int]:
+    with clients_lock:
+        return list(clients)
+
+
+def find_thread_from_pid(pinolo_pid: str) -> Optional[CommandRunner]:
+    command = find_queued_command(pinolo_pid)
+    return command.command_runner if command else None
+
+
+def find_queued_command(pinolo_pid: str) -> Optional[QueuedCommand]:
+    with queued_commands_lock:
+        for command in queued_commands:
             if command.id() == pinolo_pid:
-                return thread
+                return command
+    return None
+
+
+def restore_interrupted_jobs():
+    """
+    Jobs that were queued or running when basilico stopped go back in the queue as stale, so clients see what did not
+    finish. Nothing runs them again, they stay there until removed.
+    """
+    with queued_commands_lock:
+        for job in JOBS.interrupted():
+            state = {
+                "id": job["id"],
+                "command": job["command"],
+                "text": f"Interrupted by a restart: {job['text']}" if job["text"] else "Interrupted by a restart",
+                "target": job["target"],
+                "percentage": 0.0,
+                "started": job["started"] is not None,
+                "finished": True,
+                "error": job["error"],
+                "stale": True,
+                "stopped": False,
+                "priority": COMMAND_PRIORITIES.get(job["command"], "interactive"),
+                "position": None,
+            }
+            interrupted_jobs[state["id"]] = state
+            # No clients yet, the notifier only keeps it for get_queue
+            QUEUE_NOTIFIER.update(state, now=True)
+    if interrupted_jobs:
+        logging.info(f"{len(interrupted_jobs)} interrupted jobs are back in the queue")
 
 
 def main():
+    global OUTBOUND
+    # noinspection PyUnresolvedReferences
+    OUTBOUND = OutboundQueue(reactor.callFromThread)
+    global EXECUTOR
+    EXECUTOR = CommandExecutor(
+        int(os.getenv("SHORT_WORKERS", 8)),
+        int(os.getenv("SHORT_BACKLOG", 256)),
+        int(os.getenv("LONG_WORKERS", 64)),
+        int(os.getenv("LONG_BACKLOG", 64)),
+        int(os.getenv("QUEUED_WORKERS", 16)),
+        int(os.getenv("QUEUED_BACKLOG", 256)),
+    )
+    global DISK_MONITOR
+    if bool(int(os.getenv("DISK_EVENTS", True))):
+        monitor = DiskEventMonitor(on_disk_events, float(os.getenv("DISK_EVENTS_DEBOUNCE", 0.5)))
+        # Before scanning, so that nothing happens unnoticed in between
+        if monitor.start():
+            DISK_MONITOR = monitor
+    global IO_SCHEDULER, IO_HDD_RATE, IO_SSD_RATE
+    if bool(int(os.getenv("IO_SCHEDULER", True))):
+        overrides = {}
+        for override in os.getenv("IO_LINK_BANDWIDTH", "").split(","):
+            if "=" in override:
+                name, rate = override.rsplit("=", 1)
+                overrides[name.strip()] = float(rate) * 1e6
+        IO_SCHEDULER = IoScheduler(int(os.getenv("IO_JOBS_PER_LINK", 0)), overrides)
+        IO_HDD_RATE = float(os.getenv("IO_HDD_RATE", 200)) * 1e6
+        IO_SSD_RATE = float(os.getenv("IO_SSD_RATE", 500)) * 1e6
+    global QUEUE_NOTIFIER
+    QUEUE_NOTIFIER = QueueNotifier(send_to_clients, connected_clients, float(os.getenv("QUEUE_STATUS_INTERVAL", 0.5)))
+    QUEUE_NOTIFIER.start()
+    global JOBS
+    # Before any client can queue something
+    JOBS = JobStore(os.path.expanduser(os.getenv("JOB_STORE", "~/.local/share/WEEE-Open/basilico_jobs.sqlite")) or ":memory:")
+    restore_interrupted_jobs()
+    global CATALOGUE
+    CATALOGUE = ImageCatalogue(
+        os.path.expanduser(os.getenv("IMAGE_CATALOGUE", "~/.cache/WEEE-Open/basilico_images.json")) or None,
+        float(os.getenv("IMAGE_SCAN_INTERVAL", 60)),
+    )
+    for image_dir in os.getenv("IMAGE_DIRS", "").split(":"):
+        if image_dir:
+            CATALOGUE.watch(image_dir)
+    CATALOGUE.start()
+    if OUTBOX:
+        OUTBOX.start()
     scan_for_disks()
     ip = os.getenv("IP")
     port = os.getenv("PORT")
@@ -1414,6 +2356,16 @@ def main():
             thread_to_stop: CommandRunner
             thread_to_stop.stop_asap()
             thread_to_stop.join()
+        EXECUTOR.shutdown()
+        QUEUE_NOTIFIER.stop()
+        CATALOGUE.stop()
+        JOBS.close()
+        if DISK_MONITOR:
+            DISK_MONITOR.stop()
+        if CODE_LOOKUP:
+            CODE_LOOKUP.shutdown()
+        if OUTBOX:
+            OUTBOX.stop()
 
 
 def load_settings():
@@ -1428,6 +2380,46 @@ def load_settings():
 
     logging.basicConfig(format="%(message)s", level=getattr(logging, os.getenv("LOGLEVEL").upper()))
 
+    global ERASE_ENGINE, ERASE_VERIFY
+    ERASE_ENGINE = os.getenv("ERASE_ENGINE", ERASE_ENGINE).lower()
+    if ERASE_ENGINE not in ("badblocks", "native"):
+        logging.warning(f"Unknown ERASE_ENGINE {ERASE_ENGINE}, using badblocks")
+        ERASE_ENGINE = "badblocks"
+    ERASE_VERIFY = bool(int(os.getenv("ERASE_VERIFY", ERASE_VERIFY)))
+    global ERASE_CHECKPOINT_MAX_AGE
+    ERASE_CHECKPOINT_MAX_AGE = float(os.getenv("ERASE_CHECKPOINT_MAX_AGE", ERASE_CHECKPOINT_MAX_AGE))
+
+    global IMAGING_BLOCK_SIZE
+    IMAGING_BLOCK_SIZE = int(os.getenv("IMAGING_BLOCK_SIZE", 0)) or None
+
+    global IMAGING_GAPS
+    IMAGING_GAPS = os.getenv("IMAGING_GAPS", IMAGING_GAPS).lower()
+    if IMAGING_GAPS not in ("none", "discard", "zero"):
+        logging.warning(f"Unknown IMAGING_GAPS {IMAGING_GAPS}, using none")
+        IMAGING_GAPS = "none"
+
+    global DISK_SCAN
+    DISK_SCAN = os.getenv("DISK_SCAN", DISK_SCAN).lower()
+    if DISK_SCAN not in ("sysfs", "lsblk"):
+        logging.warning(f"Unknown DISK_SCAN {DISK_SCAN}, using sysfs")
+        DISK_SCAN = "sysfs"
+
+    global IMAGING_VERIFY
+    IMAGING_VERIFY = bool(int(os.getenv("IMAGING_VERIFY", IMAGING_VERIFY)))
+
+    global FANOUT_WINDOW
+    FANOUT_WINDOW = float(os.getenv("FANOUT_WINDOW", FANOUT_WINDOW))
+
+    global BINARY_PROTOCOL
+    BINARY_PROTOCOL = bool(int(os.getenv("BINARY_PROTOCOL", BINARY_PROTOCOL)))
+
+    global CHUNK_LENGTH
+    CHUNK_LENGTH = int(os.getenv("CHUNK_LENGTH", CHUNK_LENGTH))
+
+    global SLOW_CLIENT_TIMEOUT, SLOW_CLIENT_BACKLOG
+    SLOW_CLIENT_TIMEOUT = float(os.getenv("SLOW_CLIENT_TIMEOUT", SLOW_CLIENT_TIMEOUT))
+    SLOW_CLIENT_BACKLOG = int(os.getenv("SLOW_CLIENT_BACKLOG", SLOW_CLIENT_BACKLOG))
+
     if os.getenv("CLOSE_AT_END_TIMER") is not None:
         global CLOSE_AT_END_TIMER
         CLOSE_AT_END_TIMER = int(os.getenv("CLOSE_AT_END_TIMER"))
@@ -1436,20 +2428,52 @@ def load_settings():
     token = os.getenv("TARALLO_TOKEN") or logging.warning("TARALLO_TOKEN is not set, tarallo will be unavailable")
 
     if url and token:
-        global TARALLO
+        global TARALLO, CODE_LOOKUP, OUTBOX
         TARALLO = Tarallo.Tarallo(url, token)
+        CODE_LOOKUP = CodeLookup(
+            url,
+            token,
+            os.path.expanduser(os.getenv("TARALLO_CACHE", "~/.cache/WEEE-Open/basilico_tarallo.json")) or None,
+            float(os.getenv("TARALLO_CACHE_TTL", 86400)),
+            float(os.getenv("TARALLO_CACHE_NEGATIVE_TTL", 600)),
+            int(os.getenv("TARALLO_WORKERS", 8)),
+        )
+        OUTBOX = TaralloOutbox(
+            url,
+            token,
+            os.path.expanduser(os.getenv("TARALLO_OUTBOX", "~/.local/share/WEEE-Open/basilico_outbox.sqlite")) or ":memory:",
+            lambda entry: send_to_all_clients("tarallo_outbox", [entry]),
+            float(os.getenv("TARALLO_RETRY_MIN", 5)),
+            float(os.getenv("TARALLO_RETRY_MAX", 600)),
+        )
 
 
-def get_smartctl_status(smartctl_output: str) -> Optional[str]:
+def parse_smartctl(smartctl_output: str) -> Optional[dict]:
+    """
+    smartctl -j output, parsed once: "summary" is what clients get with every smartctl, "smartctl" is everything else
+    that is about the disk, for smartctl_detail and for Tarallo. None if it cannot be parsed.
+    """
     # noinspection PyBroadException
     try:
         smartctl = json.loads(smartctl_output)
         smart, failing_now = extract_smart_data(smartctl)
         status = smart_health_status(smart, failing_now)
-        return status
     except BaseException as e:
         logging.error("Failed to parse smartctl output", exc_info=e)
         return None
+    # Errors from smartctl are the only part of these sections that tells something about the disk
+    messages = smartctl.get("smartctl", {}).get("messages")
+    for section in SMARTCTL_IGNORED_SECTIONS:
+        smartctl.pop(section, None)
+    if messages:
+        smartctl["messages"] = messages
+    for attribute in smartctl.get("ata_smart_attributes", {}).get("table", []):
+        flags = attribute.get("flags")
+        if isinstance(flags, dict):
+            # The same booleans again, as a number and as a string
+            flags.pop("value", None)
+            flags.pop("string", None)
+    return {"summary": {"status": status, "failing_now": failing_now, "attributes": smart}, "smartctl": smartctl}
 
 
 def find_mounts(el: dict):
@@ -1469,18 +2493,27 @@ def get_disks_linux(path: Optional[str] = None) -> list:
     # To filter out loop devices, ODDs, tape drives and network devices: --exclude 7,9,11,43
     # See: https://www.kernel.org/doc/Documentation/admin-guide/devices.txt
     # Also: https://unix.stackexchange.com/a/610634
-    output = subprocess.getoutput(f"lsblk --exclude 7,9,11,43 -b -o NAME,PATH,VENDOR,MODEL,SERIAL,HOTPLUG,ROTA,MOUNTPOINT,SIZE -J {path if path else ''}")
+    output = subprocess.getoutput(
+        f"lsblk --exclude 7,9,11,43 -b -o NAME,PATH,VENDOR,MODEL,SERIAL,WWN,HOTPLUG,ROTA,MOUNTPOINT,SIZE,PARTTYPE -J {path if path else ''}"
+    )
     jsonized = json.loads(output)
     if "blockdevices" in jsonized:
-        result = jsonized["blockdevices"]
+        # Skip empty disks (empty SD card reader)
+        result = [el for el in jsonized["blockdevices"] if el["size"] != 0]
     else:
         result = []
     for el in result:
-        # Skip empty disks (empty SD card reader)
-        if el["size"] == 0:
-            continue
-
         mounts = find_mounts(el)
+        el["partitions"] = []
+        for child in el.get("children", []):
+            # PARTN needs a recent lsblk
+            partn = read_partition_number(child["name"])
+            if partn is not None:
+                el["partitions"].append(
+                    {"path": child["path"], "partn": partn, "parttype": child["parttype"], "size": child["size"], "mountpoint": child["mountpoint"]}
+                )
+        if "parttype" in el:
+            del el["parttype"]
         if "children" in el:
             del el["children"]
         if "name" in el:
@@ -1514,12 +2547,6 @@ def try_stop_at_end():
         reactor.callLater(CLOSE_AT_END_TIMER, try_stop_at_end)
 
 
-def get_block_size(path):
-    """Return device size in bytes."""
-    with open(path, "rb") as f:
-        return f.seek(0, 2) or f.tell()
-
-
 def run_command_on_partition(dev: str, cmd: str) -> bool:
     s = os.stat(dev).st_mode
     if stat.S_ISBLK(s):
@@ -1553,6 +2580,59 @@ def user_groups_checks():
 
 
 TARALLO = None
+# Serial to code lookups, set together with TARALLO
+CODE_LOOKUP: Optional[CodeLookup] = None
+# Feature updates waiting to be sent to tarallo, set together with TARALLO
+OUTBOX: Optional[TaralloOutbox] = None
+EXECUTOR: Optional[CommandExecutor] = None
+CATALOGUE: Optional[ImageCatalogue] = None
+# Queued jobs and their history
+JOBS: Optional[JobStore] = None
+# Messages from job threads to clients, handed to the reactor in batches
+OUTBOUND: Optional[OutboundQueue] = None
+# Allow clients to switch to length prefixed binary frames, see binary_protocol.py
+BINARY_PROTOCOL = True
+# Messages longer than this (or than what the client asks for) are sent in chunks, to clients that ask for chunks
+CHUNK_LENGTH = 65536
+# Seconds a client can go without reading before it is disconnected, and messages that can wait for it meanwhile
+# (progress of the same job counts once). 0 for no limit.
+SLOW_CLIENT_TIMEOUT = 120.0
+SLOW_CLIENT_BACKLOG = 10000
+# Sends queue updates to clients, progress at most once every QUEUE_STATUS_INTERVAL seconds
+QUEUE_NOTIFIER: Optional[QueueNotifier] = None
+# sysfs, or lsblk to go back to running it every time
+DISK_SCAN = "sysfs"
+# None if uevents are not available, then disks are rescanned when clients ask for them
+DISK_MONITOR: Optional[DiskEventMonitor] = None
+# Starts long commands when the controller, hubs and expanders of their disk have room, None to start them at once
+IO_SCHEDULER: Optional[IoScheduler] = None
+# Bandwidth that a long command is expected to use on rotational disks and on SSDs, in bytes per second
+IO_HDD_RATE = 200e6
+IO_SSD_RATE = 500e6
+# Commands that hold a disk for minutes or hours, they get their own lane
+LONG_COMMANDS = {"queued_badblocks", "queued_cannolo"}
+# Lower runs first: in the queue of each disk, in the worker lanes and in IO_SCHEDULER
+PRIORITIES = {"interactive": 0, "normal": 1, "bulk": 2}
+PRIORITY_NAMES = {value: name for name, value in PRIORITIES.items()}
+# Anything else is interactive: short, read only, someone is waiting for it
+COMMAND_PRIORITIES = {
+    "queued_upload_to_tarallo": "normal",
+    "queued_badblocks": "bulk",
+    "queued_cannolo": "bulk",
+}
+# Default for queued_badblocks, can be overridden per job
+ERASE_ENGINE = "badblocks"
+ERASE_VERIFY = False
+# Seconds after which an erase checkpoint is not trusted anymore, 0 for never
+ERASE_CHECKPOINT_MAX_AGE = 86400.0
+# None means "ask the target disk"
+IMAGING_BLOCK_SIZE = None
+# What to do with the parts of the disk that the block map of an image leaves out
+IMAGING_GAPS = "none"
+# Hash images while writing them, then read the disk back and compare
+IMAGING_VERIFY = False
+# Seconds to wait for other cannolo jobs with the same image before starting to read it
+FANOUT_WINDOW = 3.0
 CLOSE_AT_END = False
 CLOSE_AT_END_LOCK = threading.Lock()
 CLOSE_AT_END_TIMER = 5
@@ -1570,6 +2650,14 @@ running_commands_lock = threading.Lock()
 
 queued_commands: List[QueuedCommand] = []
 queued_commands_lock = threading.Lock()
+# Jobs left in the queue by the last shutdown, id -> what clients see. They only wait to be removed, with the same lock.
+interrupted_jobs: Dict[str, dict] = {}
+
+# Image path to the fan-out that is still accepting targets
+fan_outs: Dict[str, FanOut] = {}
+fan_outs_lock = threading.Lock()
+# Workers are reused, so each one keeps its connection to tarallo alive
+tarallo_sessions = threading.local()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+"""
+Version 2 of the protocol between basilico and its clients: length prefixed frames instead of lines, negotiated when
+the client connects.
+
+A client that wants it sends the text line "protocol 2" and waits for the server to answer with a text line. After
+"protocol 2" both sides only send frames. After "protocol 1", or an error from older servers, nothing changes.
+Clients that never ask (older pinolos, nc) keep the text protocol.
+
+A frame is the length of the rest (4 bytes, big endian) followed by an array of two items in MessagePack: command and
+param. The command is its index in COMMANDS, or its name if it is not there. From clients the param is the same
+string that follows the command in the text protocol, from the server it is whatever would have been sent as JSON,
+and strings in it are not escaped. Only a subset of MessagePack is used (nil, booleans, integers, floats, strings,
+binary, arrays and maps), any MessagePack library can read it.
+"""
+
+import json
+import struct
+from typing import List, Tuple
+
+VERSION = 2
+# Only add at the end, clients and servers of different ages must agree on these
+COMMANDS = [
+    "protocol",
+    "exit",
+    "error",
+    "error_that_can_be_manually_fixed",
+    "sudo_password",
+    "ping",
+    "pong",
+    "get_disks",
+    "disk_added",
+    "disk_removed",
+    "disk_changed",
+    "get_queue",
+    "queue_deltas",
+    "queue_status",
+    "remove",
+    "remove_all",
+    "remove_completed",
+    "remove_queued",
+    "move",
+    "priority",
+    "stop",
+    "smartctl",
+    "queued_smartctl",
+    "queued_badblocks",
+    "queued_cannolo",
+    "queued_sleep",
+    "queued_umount",
+    "upload_to_tarallo",
+    "queued_upload_to_tarallo",
+    "upload_to_tarallo_bulk",
+    "close_at_end",
+    "queued_close_at_end",
+    "list_iso",
+    "tarallo_outbox",
+    "job_history",
+    "outbound_stats",
+    "smartctl_detail",
+]
+COMMAND_IDS = {name: number for number, name in enumerate(COMMANDS)}
+LENGTH = struct.Struct(">I")
+# Longest frame accepted by default, same as the longest line (LineReceiver.MAX_LENGTH)
+MAX_FRAME = 16384
+
+
+class ProtocolError(ValueError):
+    pass
+
+
+def encode_frame(cmd: str, param=None) -> bytes:
+    payload = pack([COMMAND_IDS.get(cmd, cmd), param])
+    return LENGTH.pack(len(payload)) + payload
+
+
+class FrameDecoder:
+    """
+    Bytes in, (command, param) out, as frames are completed. Frames longer than max_frame are an error, before
+    waiting for the rest of them.
+    """
+
+    def __init__(self, max_frame: int = MAX_FRAME):
+        self._buffer = bytearray()
+        self._max_frame = max_frame
+
+    def feed(self, data: bytes) -> List[Tuple[str, object]]:
+        self._buffer += data
+        messages = []
+        while len(self._buffer) >= LENGTH.size:
+            (length,) = LENGTH.unpack_from(self._buffer)
+            if length > self._max_frame:
+                raise ProtocolError(f"Frame of {length} bytes, the limit is {self._max_frame}")
+            end = LENGTH.size + length
+            if len(self._buffer) < end:
+                break
+            payload = bytes(self._buffer[LENGTH.size : end])
+            del self._buffer[:end]
+            message = unpack(payload)
+            if not isinstance(message, list) or len(message) != 2:
+                raise ProtocolError("A frame must contain a command and its param")
+            cmd, param = message
+            if isinstance(cmd, int) and 0 <= cmd < len(COMMANDS):
+                cmd = COMMANDS[cmd]
+            elif not isinstance(cmd, str):
+                raise ProtocolError(f"Unknown command {cmd}")
+            messages.append((cmd, param))
+        return messages
+
+
+def pack(value) -> bytes:
+    out = bytearray()
+    _pack(value, out)
+    return bytes(out)
+
+
+def unpack(data: bytes):
+    value, end = _unpack(memoryview(data), 0)
+    if end != len(data):
+        raise ProtocolError("Garbage after the end of a frame")
+    return value
+
+
+def _pack(value, out: bytearray):
+    if value is None:
+        out.append(0xC0)
+    elif value is True:
+        out.append(0xC3)
+    elif value is False:
+        out.append(0xC2)
+    elif isinstance(value, int):
+        _pack_int(value, out)
+    elif isinstance(value, float):
+        out.append(0xCB)
+        out += struct.pack(">d", value)
+    elif isinstance(value, str):
+        encoded = value.encode("utf-8")
+        _pack_header(len(encoded), out, 0xA0, 32, 0xD9, 0xDA, 0xDB)
+        out += encoded
+    elif isinstance(value, (bytes, bytearray)):
+        _pack_header(len(value), out, None, 0, 0xC4, 0xC5, 0xC6)
+        out += value
+    elif isinstance(value, (list, tuple)):
+        _pack_header(len(value), out, 0x90, 16, None, 0xDC, 0xDD)
+        for item in value:
+            _pack(item, out)
+    elif isinstance(value, dict):
+        _pack_header(len(value), out, 0x80, 16, None, 0xDE, 0xDF)
+        for key, item in value.items():
+            # Same keys as JSON would have, so clients get the same data with both protocols
+            _pack(key if isinstance(key, str) else json.dumps(key), out)
+            _pack(item, out)
+    else:
+        raise TypeError(f"Cannot encode {type(value).__name__}")
+
+
+def _pack_int(value: int, out: bytearray):
+    if 0 <= value < 0x80 or -0x20 <= value < 0:
+        out += struct.pack(">b" if value < 0 else ">B", value)
+    elif value >= 0:
+        for code, fmt, limit in ((0xCC, ">B", 1 << 8), (0xCD, ">H", 1 << 16), (0xCE, ">I", 1 << 32), (0xCF, ">Q", 1 << 64)):
+            if value < limit:
+                out.append(code)
+                out += struct.pack(fmt, value)
+                return
+        raise OverflowError(f"{value} does not fit in 64 bits")
+    else:
+        for code, fmt, limit in ((0xD0, ">b", 1 << 7), (0xD1, ">h", 1 << 15), (0xD2, ">i", 1 << 31), (0xD3, ">q", 1 << 63)):
+            if value >= -limit:
+                out.append(code)
+                out += struct.pack(fmt, value)
+                return
+        raise OverflowError(f"{value} does not fit in 64 bits")
+
+
+def _pack_header(length: int, out: bytearray, fix_code, fix_limit: int, code8, code16: int, code32: int):
+    if fix_code is not None and length < fix_limit:
+        out.append(fix_code | length)
+    elif code8 is not None and length < 1 << 8:
+        out.append(code8)
+        out.append(length)
+    elif length < 1 << 16:
+        out.append(code16)
+        out += struct.pack(">H", length)
+    elif length < 1 << 32:
+        out.append(code32)
+        out += struct.pack(">I", length)
+    else:
+        raise OverflowError("Too long for a frame")
+
+
+# Code -> (struct format, size) for numbers
+_NUMBERS = {
+    0xCA: (">f", 4),
+    0xCB: (">d", 8),
+    0xCC: (">B", 1),
+    0xCD: (">H", 2),
+    0xCE: (">I", 4),
+    0xCF: (">Q", 8),
+    0xD0: (">b", 1),
+    0xD1: (">h", 2),
+    0xD2: (">i", 4),
+    0xD3: (">q", 8),
+}
+# Code -> size of the length that follows, for strings, binary, arrays and maps
+_LENGTHS = {0xD9: 1, 0xDA: 2, 0xDB: 4, 0xC4: 1, 0xC5: 2, 0xC6: 4, 0xDC: 2, 0xDD: 4, 0xDE: 2, 0xDF: 4}
+_LENGTH_FORMATS = {1: ">B", 2: ">H", 4: ">I"}
+
+
+def _unpack(data: memoryview, offset: int):
+    try:
+        code = data[offset]
+    except IndexError:
+        raise ProtocolError("Frame ends in the middle of a value")
+    offset += 1
+    if code <= 0x7F:
+        return code, offset
+    if code >= 0xE0:
+        return code - 0x100, offset
+    if 0xA0 <= code <= 0xBF:
+        return _unpack_str(data, offset, code & 0x1F)
+    if 0x90 <= code <= 0x9F:
+        return _unpack_array(data, offset, code & 0x0F)
+    if 0x80 <= code <= 0x8F:
+        return _unpack_map(data, offset, code & 0x0F)
+    if code == 0xC0:
+        return None, offset
+    if code == 0xC2:
+        return False, offset
+    if code == 0xC3:
+        return True, offset
+    if code in _NUMBERS:
+        fmt, size = _NUMBERS[code]
+        _check(data, offset, size)
+        return struct.unpack_from(fmt, data, offset)[0], offset + size
+    if code in _LENGTHS:
+        size = _LENGTHS[code]
+        _check(data, offset, size)
+        length = struct.unpack_from(_LENGTH_FORMATS[size], data, offset)[0]
+        offset += size
+        if code in (0xD9, 0xDA, 0xDB):
+            return _unpack_str(data, offset, length)
+        if code in (0xC4, 0xC5, 0xC6):
+            _check(data, offset, length)
+            return bytes(data[offset : offset + length]), offset + length
+        if code in (0xDC, 0xDD):
+            return _unpack_array(data, offset, length)
+        return _unpack_map(data, offset, length)
+    raise ProtocolError(f"Unsupported MessagePack type 0x{code:02x}")
+
+
+def _unpack_str(data: memoryview, offset: int, length: int):
+    _check(data, offset, length)
+    try:
+        return str(data[offset : offset + length], "utf-8"), offset + length
+    except UnicodeDecodeError as e:
+        raise ProtocolError(f"Invalid string: {e}")
+
+
+def _unpack_array(data: memoryview, offset: int, length: int):
+    items = []
+    for _ in range(length):
+        item, offset = _unpack(data, offset)
+        items.append(item)
+    return items, offset
+
+
+def _unpack_map(data: memoryview, offset: int, length: int):
+    items = {}
+    for _ in range(length):
+        key, offset = _unpack(data, offset)
+        value, offset = _unpack(data, offset)
+        try:
+            items[key] = value
+        except TypeError:
+            raise ProtocolError("Map keys must be strings or numbers")
+    return items, offset
+
+
+def _check(data: memoryview, offset: int, size: int):
+    if offset + size > len(data):
+        raise ProtocolError("Frame ends in the middle of a value")
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+Large messages split into chunks, so that no line is longer than what the client accepts and a big transfer does not
+keep progress updates waiting behind it.
+
+Clients ask for it with "chunked <max line length> [zlib]". Then any message longer than that becomes a sequence of
+"chunk" messages, each with:
+
+- id: same for all the chunks of a message, different for each message on the same connection
+- seq and total: position of the chunk, from 0, and number of chunks
+- cmd: the command of the original message
+- zlib: whether the data is compressed, only if the client said zlib
+- data: a piece of the param of the original message, encoded as it would have been (JSON with text lines,
+  MessagePack with binary frames). In base64 with text lines, raw bytes with binary frames
+
+Chunks of a message are sent in order. Other messages can be sent between them.
+"""
+
+import base64
+import zlib
+from typing import Optional, Tuple, Dict, List
+
+# More than the length of everything in a chunk except the data
+ENVELOPE = 256
+# Smaller makes no sense, and would make many tiny chunks
+MIN_LINE_LENGTH = 1024
+
+
+def split(cmd: str, payload: bytes, transfer_id: int, max_length: int, compress: bool, binary: bool) -> List[dict]:
+    """
+    Params of the chunk messages for an encoded param, each one encoded no longer than max_length.
+    """
+    if compress:
+        compressed = zlib.compress(payload)
+        # Already compressed data (or very short data) may grow
+        compress = len(compressed) < len(payload)
+        if compress:
+            payload = compressed
+    room = max(max_length, MIN_LINE_LENGTH) - ENVELOPE - len(cmd)
+    if not binary:
+        # Every 3 bytes become 4 in base64
+        room = room // 4 * 3
+    pieces = [payload[start : start + room] for start in range(0, len(payload), room)] or [b""]
+    return [
+        {
+            "id": transfer_id,
+            "seq": seq,
+            "total": len(pieces),
+            "cmd": cmd,
+            "zlib": compress,
+            "data": piece if binary else base64.b64encode(piece).decode("ascii"),
+        }
+        for seq, piece in enumerate(pieces)
+    ]
+
+
+class Reassembler:
+    """
+    Chunks in, original messages out: (cmd, encoded param) when the last chunk of a message arrives.
+    """
+
+    def __init__(self):
+        # Id -> (cmd, pieces so far)
+        self._transfers: Dict[int, Tuple[str, List[bytes]]] = {}
+
+    def feed(self, chunk: dict) -> Optional[Tuple[str, bytes]]:
+        try:
+            transfer_id = chunk["id"]
+            seq = chunk["seq"]
+            data = chunk["data"]
+            piece = base64.b64decode(data) if isinstance(data, str) else bytes(data)
+            if seq == 0:
+                self._transfers[transfer_id] = (chunk["cmd"], [])
+            cmd, pieces = self._transfers[transfer_id]
+            if seq != len(pieces):
+                raise ValueError(f"chunk {seq} after {len(pieces)} chunks")
+            pieces.append(piece)
+            if len(pieces) < chunk["total"]:
+                return None
+            del self._transfers[transfer_id]
+            payload = b"".join(pieces)
+            return cmd, zlib.decompress(payload) if chunk.get("zlib") else payload
+        except (KeyError, TypeError, ValueError, zlib.error) as e:
+            self._transfers.pop(chunk.get("id") if isinstance(chunk, dict) else None, None)
+            raise ValueError(f"Invalid chunk: {e}")
@@ -3,16 +3,26 @@ from twisted.internet.interfaces import IAddress
 from twisted.internet.protocol import Protocol, ClientFactory
 import json
 
-from twisted.protocols.basic import LineOnlyReceiver
+from twisted.protocols.basic import LineReceiver
 
+from binary_protocol import FrameDecoder, ProtocolError, encode_frame, unpack, VERSION as BINARY_VERSION
+from chunking import Reassembler
 
-class ClientProtocol(LineOnlyReceiver):
+
+class ClientProtocol(LineReceiver):
 
     MAX_LENGTH = 32768  # value in bytes - Increased to avoid connection drop due to smartctl message lengths
 
     def __init__(self, message_received: pyqtSignal, factory):
         self.message_received = message_received
         self.factory: ConnectionFactory = factory
+        # Frames instead of lines, if the server agrees
+        self.binary = False
+        self._decoder = FrameDecoder(self.MAX_LENGTH)
+        # Messages to send when the server has answered "protocol", None when it has
+        self._waiting_for_protocol = None
+        # Large messages arrive in chunks, so that no line is longer than MAX_LENGTH
+        self._reassembler = Reassembler()
 
     def connectionMade(self):
         """Called when a connection is made to the server.
@@ -38,6 +48,10 @@ class ClientProtocol(LineOnlyReceiver):
         """
 
         try:
+            # Nothing else is sent until the server answers, see lineReceived
+            self.sendLine(f"protocol {BINARY_VERSION}".encode("utf-8"))
+            # Room for the envelope of a chunk, and then some
+            self._waiting_for_protocol = [f"chunked {self.MAX_LENGTH // 2} zlib"]
             self.factory.on_connection(self)
             peer = self.transport.getPeer()
             self.factory.update_host(f"connection_made {peer.host} {peer.port}")
@@ -78,10 +92,90 @@ class ClientProtocol(LineOnlyReceiver):
 
         try:
             line = line.decode("utf-8")
-            self.factory.update_host(line)
         except UnicodeDecodeError:
             print(f"CLIENT: Oh no, UnicodeDecodeError!")
             return
+        if self._waiting_for_protocol is not None and self._protocol_answer(line):
+            return
+        if line.startswith("chunk "):
+            message = self._reassemble(line[6:])
+            if message is not None:
+                self.factory.update_host(f"{message[0]} {message[1].decode('utf-8')}")
+            return
+        self.factory.update_host(line)
+
+    def rawDataReceived(self, data):
+        """Called with data from the server after switching to binary frames.
+
+        Frames are limited to MAX_LENGTH like lines, longer messages arrive in chunks. Each complete frame
+        is passed to the factory's `update_decoded` method.
+
+        Args:
+            data (bytes): Whatever arrived, it may contain many frames or part of one.
+        """
+        try:
+            messages = self._decoder.feed(data)
+        except ProtocolError as e:
+            print(f"CLIENT-ERROR: Invalid frame ({e}), dropping connection.")
+            self.disconnect()
+            return
+        for cmd, param in messages:
+            if cmd == "chunk":
+                message = self._reassemble(param)
+                if message is None:
+                    continue
+                try:
+                    cmd, param = message[0], unpack(message[1])
+                except ProtocolError as e:
+                    print(f"CLIENT-ERROR: Invalid chunked {message[0]} ({e}), ignoring it.")
+                    continue
+            self.factory.update_decoded(cmd, param)
+
+    def _reassemble(self, chunk):
+        """Collects a chunk of a large message.
+
+        Args:
+            chunk (Union[dict, str]): The param of a "chunk" message, see chunking.py. JSON from text lines.
+
+        Returns:
+            tuple: Command and encoded param (JSON or MessagePack, like the rest of the connection) of the whole
+            message when this was its last chunk, None otherwise or if the chunk is invalid.
+        """
+        try:
+            return self._reassembler.feed(json.loads(chunk) if isinstance(chunk, str) else chunk)
+        except ValueError as e:
+            print(f"CLIENT-ERROR: {e}")
+            return None
+
+    def _protocol_answer(self, line: str) -> bool:
+        """Handles the answer to "protocol", sent when connecting.
+
+        "protocol 2" switches to binary frames. "protocol 1", or an error from servers that do not know the command,
+        means text lines as before. Then the messages that were waiting are sent.
+
+        Args:
+            line (str): A line from the server, it may be something else (e.g. sudo_password).
+
+        Returns:
+            bool: True if the line was the answer and must not be processed further.
+        """
+        if line.startswith("protocol "):
+            self.binary = line.split(" ", 1)[1].strip() == str(BINARY_VERSION)
+        elif line.startswith("error ") and '"command":"protocol"' in line.replace(" ", ""):
+            self.binary = False
+            # Older servers do not know about chunks either
+            self._waiting_for_protocol = [msg for msg in self._waiting_for_protocol if not msg.startswith("chunked ")]
+        else:
+            return False
+        waiting = self._waiting_for_protocol
+        self._waiting_for_protocol = None
+        for msg in waiting:
+            self.send_msg(msg)
+        if self.binary:
+            print("CLIENT_PROTOCOL: Using binary frames.")
+            # Everything after this line is frames
+            self.setRawMode()
+        return True
 
     def send_msg(self, msg):
         """Sends a message to the server.
@@ -112,12 +206,16 @@ class ClientProtocol(LineOnlyReceiver):
 
         if self is None:
             print("CLIENT: Cannot send message to server. No connection.")
+        elif self._waiting_for_protocol is not None:
+            self._waiting_for_protocol.append(msg)
         else:
-            if msg == "queued_close_at_end":
-                self.sendLine(msg.encode("utf-8"))
-                self.disconnect()
+            if self.binary:
+                parts = msg.split(" ", 1)
+                self.transport.write(encode_frame(parts[0], parts[1] if len(parts) > 1 else ""))
             else:
                 self.sendLine(msg.encode("utf-8"))
+            if msg == "queued_close_at_end":
+                self.disconnect()
 
     def lineLengthExceeded(self, line):
         """Handles the situation when the received line exceeds the allowed length.
@@ -166,7 +264,8 @@ class ClientProtocol(LineOnlyReceiver):
 
 
 class ConnectionFactory(ClientFactory, QObject):
-    data_received = pyqtSignal(str, str)
+    # Command and JSON string from text lines, or command and the param already decoded from binary frames
+    data_received = pyqtSignal(str, object)
 
     protocol = ClientProtocol
 
@@ -241,3 +340,13 @@ class ConnectionFactory(ClientFactory, QObject):
                 args = ""
 
         self.data_received.emit(cmd, args)
+
+    def update_decoded(self, cmd: str, param):
+        """Emits a message that arrived in a binary frame.
+
+        Args:
+            cmd (str): The command.
+            param: Whatever the server sent, already decoded. None is emitted as "", like a text line without
+            arguments.
+        """
+        self.data_received.emit(cmd, "" if param is None else param)
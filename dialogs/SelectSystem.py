@@ -1,7 +1,7 @@
-import os.path
+from datetime import datetime
 
 from PyQt5.QtCore import QObject
-from PyQt5.QtWidgets import QDialog
+from PyQt5.QtWidgets import QDialog, QListWidgetItem
 
 from ui.SelectSystemDialog import Ui_SelectSystemDialog
 
@@ -22,13 +22,19 @@ class SelectSystemDialog(QDialog, Ui_SelectSystemDialog):
         self.cancelButton.clicked.connect(self.close)
 
     def load_images(self, images: list):
-        for path in images:
-            if not os.path.isfile(path):
+        """
+        images is the server's image catalogue: name, size, format and hash of each image.
+        """
+        for image in images:
+            if image["format"] == "unknown":
                 continue
 
-            file_extension = os.path.splitext(path)[1]
-            if file_extension == ".iso" or file_extension == ".img":
-                self.isoList.addItem(os.path.basename(path))
+            item = QListWidgetItem(image["name"])
+            tooltip = f"{image['format']}, {image['size'] / 1024 ** 3:.1f} GiB, modified {datetime.fromtimestamp(image['mtime']):%Y-%m-%d %H:%M}"
+            if image["hash"] is not None:
+                tooltip += f"\nsha256 {image['hash']}"
+            item.setToolTip(tooltip)
+            self.isoList.addItem(item)
 
     def select(self):
         """
@@ -18,7 +18,7 @@ class SmartDialog(QDialog, Ui_SmartDataDialog):
 
         self.parent = parent
         self.drive = drive
-        self.smart_results = json.loads(smart_results["output"])
+        self.smart_results = smart_results["detail"]
         self.smart_status = smart_results["status"]
 
         self.setup()
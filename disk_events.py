@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+"""
+Kernel events about disks, so that basilico knows when they come and go without running lsblk all the time.
+
+Block device uevents come from a netlink socket (the same ones udev gets), mounts and umounts from polling
+/proc/self/mountinfo. Plugging in a whole cage of disks makes a burst of events, so nothing is reported until
+things calm down a bit.
+"""
+
+import errno
+import logging
+import os
+import select
+import socket
+import threading
+import time
+from typing import Optional, Callable, List
+
+NETLINK_KOBJECT_UEVENT = 15
+# Multicast group of events sent by the kernel, group 2 is for messages from udev
+UEVENT_KERNEL_GROUP = 1
+UEVENT_BUFFER_SIZE = 64 * 1024
+MOUNTINFO = "/proc/self/mountinfo"
+
+
+def parse_uevent(data: bytes) -> Optional[dict]:
+    """
+    "ACTION@DEVPATH\\0KEY=VALUE\\0..." to a dict of the KEY=VALUE part, None if it is not a kernel uevent.
+    """
+    parts = data.split(b"\0")
+    if b"@" not in parts[0]:
+        return None
+    event = {}
+    for part in parts[1:]:
+        key, equals, value = part.partition(b"=")
+        if equals:
+            event[key.decode("utf-8", "replace")] = value.decode("utf-8", "replace")
+    return event
+
+
+class DiskEventMonitor:
+    """
+    Calls on_change with a list of what happened (e.g. "add sdb", "mounts") from its own thread, once no event
+    has arrived for debounce seconds, or max_delay seconds after the first one if they never stop.
+    """
+
+    def __init__(self, on_change: Callable[[List[str]], None], debounce: float = 0.5, max_delay: float = 5.0):
+        self._on_change = on_change
+        self._debounce = debounce
+        self._max_delay = max_delay
+        self._socket: Optional[socket.socket] = None
+        self._mountinfo: Optional[int] = None
+        self._wake_read, self._wake_write = -1, -1
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self) -> bool:
+        """
+        Returns False if the kernel does not let us listen to uevents, the caller has to poll instead.
+        """
+        try:
+            self._socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+            self._socket.bind((0, UEVENT_KERNEL_GROUP))
+        except (OSError, AttributeError) as e:
+            logging.warning(f"Cannot listen to uevents, disks will be rescanned on every request: {e}")
+            if self._socket:
+                self._socket.close()
+                self._socket = None
+            return False
+        try:
+            self._mountinfo = os.open(MOUNTINFO, os.O_RDONLY)
+        except OSError as e:
+            logging.warning(f"Cannot watch {MOUNTINFO}, mountpoints will only be updated on disk events: {e}")
+        self._wake_read, self._wake_write = os.pipe()
+        self._thread = threading.Thread(target=self._run, name="disk-events", daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        if self._thread is None:
+            return
+        os.write(self._wake_write, b"x")
+        self._thread.join()
+        self._thread = None
+        self._socket.close()
+        if self._mountinfo is not None:
+            os.close(self._mountinfo)
+        os.close(self._wake_read)
+        os.close(self._wake_write)
+
+    def _run(self):
+        poller = select.poll()
+        poller.register(self._socket.fileno(), select.POLLIN)
+        poller.register(self._wake_read, select.POLLIN)
+        if self._mountinfo is not None:
+            # The mount table signals changes with POLLPRI, there is nothing to read
+            poller.register(self._mountinfo, select.POLLPRI)
+
+        pending: List[str] = []
+        first = last = 0.0
+        while True:
+            timeout = None
+            if pending:
+                deadline = min(last + self._debounce, first + self._max_delay)
+                timeout = max(deadline - time.monotonic(), 0) * 1000
+            for fd, _ in poller.poll(timeout):
+                if fd == self._wake_read:
+                    return
+                if fd == self._mountinfo:
+                    happened = "mounts"
+                else:
+                    happened = self._receive()
+                if happened is None:
+                    continue
+                last = time.monotonic()
+                if not pending:
+                    first = last
+                pending.append(happened)
+
+            now = time.monotonic()
+            if pending and (now - last >= self._debounce or now - first >= self._max_delay):
+                events, pending = pending, []
+                # noinspection PyBroadException
+                try:
+                    self._on_change(events)
+                except BaseException as e:
+                    logging.warning("Exception while handling disk events", exc_info=e)
+
+    def _receive(self) -> Optional[str]:
+        try:
+            data = self._socket.recv(UEVENT_BUFFER_SIZE)
+        except OSError as e:
+            if e.errno == errno.ENOBUFS:
+                # Too many events at once and some were lost, only a full rescan can tell what happened
+                return "overflow"
+            raise
+        event = parse_uevent(data)
+        if event is None or event.get("SUBSYSTEM") != "block":
+            return None
+        return f"{event.get('ACTION', '?')} {event.get('DEVNAME', event.get('DEVPATH', '?'))}"
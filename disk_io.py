@@ -0,0 +1,1228 @@
+#!/usr/bin/env python
+"""
+Low level disk I/O used by basilico: erasing and imaging without shelling out to badblocks and dd.
+
+Nothing in here knows about clients or queues, progress is reported through callbacks.
+"""
+
+import errno
+import fcntl
+import hashlib
+import logging
+import mmap
+import os
+import queue
+import shutil
+import stat
+import struct
+import subprocess
+import threading
+import time
+from xml.etree import ElementTree
+from typing import Optional, Callable, Dict, List
+
+# Used when sysfs does not say anything useful (regular files, weird USB bridges)
+DEFAULT_CHUNK_SIZE = 4 * 1024 * 1024
+MIN_CHUNK_SIZE = 1024 * 1024
+MAX_CHUNK_SIZE = 16 * 1024 * 1024
+DEFAULT_LOGICAL_BLOCK_SIZE = 512
+PROGRESS_INTERVAL = 1.0
+# How often NativeEraser saves how far it got
+CHECKPOINT_INTERVAL = 30.0
+# Do not send thousands of LBAs to clients if a disk is dying
+MAX_REPORTED_LBAS = 10
+# From linux/fs.h: _IO(0x12, 119) and _IO(0x12, 127)
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127F
+# Compressed images are piped through the first of these that is installed
+DECOMPRESSORS = {
+    ".img.gz": (("pigz", "-dc"), ("gzip", "-dc")),
+    ".img.xz": (("xz", "-dc", "-T0"),),
+    ".img.zst": (("zstd", "-dc"),),
+}
+
+
+def sysfs_block_name(dev: str) -> str:
+    # /dev/disk/by-id/... and similar are symlinks to /dev/sdX
+    return os.path.basename(os.path.realpath(dev))
+
+
+def sysfs_queue_attribute(dev: str, attribute: str) -> Optional[int]:
+    try:
+        with open(f"/sys/class/block/{sysfs_block_name(dev)}/queue/{attribute}", "r") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return None
+
+
+def logical_block_size(dev: str) -> int:
+    size = sysfs_queue_attribute(dev, "logical_block_size")
+    return size if size else DEFAULT_LOGICAL_BLOCK_SIZE
+
+
+def optimal_chunk_size(dev: str) -> int:
+    """
+    Size of each I/O request, based on what the device says it likes.
+
+    optimal_io_size is 0 for most HDDs, max_sectors_kb is always there for real block devices.
+    The result is a multiple of both the preferred size and the logical block size, at least MIN_CHUNK_SIZE
+    so that syscall overhead does not matter.
+    """
+    preferred = sysfs_queue_attribute(dev, "optimal_io_size")
+    if not preferred:
+        max_sectors_kb = sysfs_queue_attribute(dev, "max_sectors_kb")
+        preferred = max_sectors_kb * 1024 if max_sectors_kb else None
+    if not preferred:
+        return DEFAULT_CHUNK_SIZE
+    lbs = logical_block_size(dev)
+    preferred = max(lbs, preferred - preferred % lbs)
+    chunk = preferred * -(-MIN_CHUNK_SIZE // preferred)
+    if chunk > MAX_CHUNK_SIZE:
+        chunk = max(preferred, MAX_CHUNK_SIZE - MAX_CHUNK_SIZE % preferred)
+    return chunk
+
+
+def aligned_buffer(size: int) -> mmap.mmap:
+    # Anonymous mappings are page aligned and zero filled, which is exactly what O_DIRECT needs
+    return mmap.mmap(-1, size)
+
+
+def open_direct(path: str, flags: int) -> (int, bool):
+    """
+    Open with O_DIRECT if possible. Returns the fd and whether O_DIRECT is in use.
+    """
+    direct = getattr(os, "O_DIRECT", 0)
+    if direct:
+        try:
+            return os.open(path, flags | direct), True
+        except OSError as e:
+            # tmpfs and some filesystems do not support it
+            if e.errno != errno.EINVAL:
+                raise
+    return os.open(path, flags), False
+
+
+def device_size(fd: int) -> int:
+    return os.lseek(fd, 0, os.SEEK_END)
+
+
+def format_rate(bytes_per_second: float) -> str:
+    return f"{bytes_per_second / 1000 / 1000:.1f} MB/s"
+
+
+class NativeEraser:
+    """
+    Erase a disk by writing zeros with large aligned O_DIRECT writes, optionally reading everything back.
+
+    The same two buffers are used for the whole disk. A chunk that fails is retried one logical block at a time
+    to find the exact LBAs, like badblocks does.
+
+    Every CHECKPOINT_INTERVAL seconds, and when stopped, checkpoint is called with a dict of how far the erase got
+    (flushed to the disk first, during the write pass). Passing that dict back as resume continues from there, errors
+    included, if the disk still has the same size.
+    """
+
+    def __init__(
+        self,
+        dev: str,
+        verify: bool = False,
+        progress: Optional[Callable[[float, float, "NativeEraser"], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+        chunk_size: Optional[int] = None,
+        checkpoint: Optional[Callable[[dict], None]] = None,
+        resume: Optional[dict] = None,
+    ):
+        self.dev = dev
+        self.verify = verify
+        self._checkpoint = checkpoint
+        self._resume = resume
+        self._progress = progress
+        self._should_stop = should_stop or (lambda: False)
+        self.chunk_size = chunk_size or optimal_chunk_size(dev)
+        self.block_size = logical_block_size(dev)
+        self.read_errors = 0
+        self.write_errors = 0
+        self.corruption_errors = 0
+        self.bad_lbas: List[int] = []
+        self.stopped = False
+        self.size = 0
+        # Percentage where this run started, 0 unless resumed
+        self.resumed_at = 0.0
+
+    @property
+    def errors(self) -> int:
+        return self.read_errors + self.write_errors + self.corruption_errors
+
+    def run(self) -> bool:
+        """
+        Returns True if every pass completed (even with bad blocks), False if stopped.
+        Errors opening the device are raised.
+        """
+        fd, direct = open_direct(self.dev, os.O_RDWR)
+        try:
+            self.size = device_size(fd)
+            logging.debug(f"Erasing {self.dev}: {self.size} bytes, chunks of {self.chunk_size}, O_DIRECT {'on' if direct else 'off'}")
+            passes = 2 if self.verify else 1
+            start_pass, start_offset = self._resume_point(passes)
+            if start_pass == 0:
+                pattern = aligned_buffer(self.chunk_size)
+                if not self._write_pass(fd, pattern, start_offset, passes):
+                    return False
+                os.fsync(fd)
+            if self.verify:
+                if not self._verify_pass(fd, start_offset if start_pass == 1 else 0, passes):
+                    return False
+            return True
+        finally:
+            os.close(fd)
+
+    def state(self, pass_number: int, offset: int, passes: int) -> dict:
+        """
+        Everything needed to resume from offset in that pass (0 is writing, 1 is verifying).
+        """
+        return {
+            "size": self.size,
+            "pass": pass_number,
+            "offset": offset,
+            "percent": (pass_number + offset / self.size) / passes * 100,
+            "read_errors": self.read_errors,
+            "write_errors": self.write_errors,
+            "corruption_errors": self.corruption_errors,
+            "bad_lbas": self.bad_lbas,
+        }
+
+    def _resume_point(self, passes: int) -> (int, int):
+        resume = self._resume
+        if not resume:
+            return 0, 0
+        if resume["size"] != self.size:
+            logging.warning(f"Not resuming erase of {self.dev}: it was {resume['size']} bytes, now it is {self.size}")
+            return 0, 0
+        self.read_errors = resume["read_errors"]
+        self.write_errors = resume["write_errors"]
+        self.corruption_errors = resume["corruption_errors"]
+        self.bad_lbas = list(resume["bad_lbas"])
+        if resume["pass"] >= passes:
+            # Only the verify pass was left, and it is not wanted anymore
+            self.resumed_at = 100.0
+            return resume["pass"], 0
+        self.resumed_at = (resume["pass"] + resume["offset"] / self.size) / passes * 100
+        logging.info(f"Resuming erase of {self.dev} from {self.resumed_at:.1f}%")
+        return resume["pass"], resume["offset"]
+
+    def _write_pass(self, fd: int, pattern: mmap.mmap, start_offset: int, passes: int) -> bool:
+        view = memoryview(pattern)
+        return self._pass(fd, 0, start_offset, passes, lambda offset, length: self._write_chunk(fd, view, offset, length))
+
+    def _verify_pass(self, fd: int, start_offset: int, passes: int) -> bool:
+        buffer = aligned_buffer(self.chunk_size)
+        view = memoryview(buffer)
+        expected = bytes(self.chunk_size)
+        return self._pass(fd, 1, start_offset, passes, lambda offset, length: self._verify_chunk(fd, view, expected, offset, length))
+
+    def _pass(self, fd: int, pass_number: int, start_offset: int, passes: int, do_chunk: Callable[[int, int], None]) -> bool:
+        offset = start_offset
+        start = last_report = last_checkpoint = time.monotonic()
+        last_offset = offset
+        while offset < self.size:
+            if self._should_stop():
+                self.stopped = True
+                self._save_checkpoint(fd, pass_number, offset, passes)
+                return False
+            length = min(self.chunk_size, self.size - offset)
+            do_chunk(offset, length)
+            offset += length
+
+            now = time.monotonic()
+            if self._progress and (now - last_report >= PROGRESS_INTERVAL or offset >= self.size):
+                rate = (offset - last_offset) / (now - last_report) if now > last_report else 0.0
+                if offset >= self.size:
+                    rate = (offset - start_offset) / (now - start) if now > start else 0.0
+                percent = (pass_number + offset / self.size) / passes * 100
+                self._progress(percent, rate, self)
+                last_report = now
+                last_offset = offset
+            if now - last_checkpoint >= CHECKPOINT_INTERVAL and offset < self.size:
+                self._save_checkpoint(fd, pass_number, offset, passes)
+                last_checkpoint = now
+        return True
+
+    def _save_checkpoint(self, fd: int, pass_number: int, offset: int, passes: int):
+        if not self._checkpoint:
+            return
+        if pass_number == 0:
+            # Zeros still in the disk cache are not erased yet
+            os.fdatasync(fd)
+        self._checkpoint(self.state(pass_number, offset, passes))
+
+    def _write_chunk(self, fd: int, view: memoryview, offset: int, length: int):
+        try:
+            written = os.pwrite(fd, view[:length], offset)
+            if written == length:
+                return
+        except OSError as e:
+            if e.errno != errno.EIO:
+                raise
+        # Find out which blocks are broken
+        for block in range(offset, offset + length, self.block_size):
+            try:
+                os.pwrite(fd, view[: self.block_size], block)
+            except OSError as e:
+                if e.errno != errno.EIO:
+                    raise
+                self.write_errors += 1
+                self._add_bad_lba(block)
+
+    def _verify_chunk(self, fd: int, view: memoryview, expected: bytes, offset: int, length: int):
+        try:
+            read = os.preadv(fd, [view[:length]], offset)
+        except OSError as e:
+            if e.errno != errno.EIO:
+                raise
+            read = -1
+        # startswith compares the buffer in place with memcmp: no copy like tobytes, and much faster than memoryview ==,
+        # which compares one item at a time
+        if read == length and expected.startswith(view[:length]):
+            return
+        # Something is wrong in this chunk, find out where
+        for block in range(offset, offset + length, self.block_size):
+            block_view = view[: self.block_size]
+            try:
+                os.preadv(fd, [block_view], block)
+            except OSError as e:
+                if e.errno != errno.EIO:
+                    raise
+                self.read_errors += 1
+                self._add_bad_lba(block)
+                continue
+            if not expected.startswith(block_view):
+                self.corruption_errors += 1
+                self._add_bad_lba(block)
+
+    def _add_bad_lba(self, offset: int):
+        lba = offset // self.block_size
+        logging.warning(f"Bad block on {self.dev} at LBA {lba}")
+        if len(self.bad_lbas) < MAX_REPORTED_LBAS:
+            self.bad_lbas.append(lba)
+
+
+class BufferRing:
+    """
+    A fixed set of aligned buffers passed between a reader thread and a writer.
+
+    The reader takes free slots and hands over filled ones, the writer does the opposite. Nothing is allocated
+    after construction, and the number of slots bounds how far the reader can get ahead.
+    """
+
+    def __init__(self, slots: int, slot_size: int):
+        self.slot_size = slot_size
+        self._buffers = [aligned_buffer(slot_size) for _ in range(slots)]
+        self.views = [memoryview(buffer) for buffer in self._buffers]
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        for i in range(slots):
+            self._free.put(i)
+
+    def get_free(self) -> int:
+        return self._free.get()
+
+    def put_free(self, slot: int):
+        self._free.put(slot)
+
+    def get_filled(self) -> Optional[tuple]:
+        return self._filled.get()
+
+    def put_filled(self, item: Optional[tuple]):
+        # None means end of stream
+        self._filled.put(item)
+
+
+class ImageWriter:
+    """
+    Copy an image to a disk as fast as the disk allows.
+
+    When the kernel can do it, data never goes through userspace (copy_file_range, then sendfile). Otherwise a
+    reader thread fills a ring of aligned buffers with readinto and the calling thread writes them with O_DIRECT.
+    Compressed images always take the ring path, with a DecompressedStream as the source.
+
+    If a list is passed as hashes, the reader thread hashes each piece before it is written (see ReadBackVerifier).
+    Pages of the image that have already been written are dropped from the page cache, so imaging a disk does not
+    evict everything else.
+    """
+
+    RING_SLOTS = 4
+    # How often the page cache is trimmed on the zero copy path
+    DROP_CACHE_EVERY = 256 * 1024 * 1024
+
+    def __init__(
+        self,
+        source: str,
+        target: str,
+        block_size: Optional[int] = None,
+        progress: Optional[Callable[[float, float, Optional[str]], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+        zero_copy: bool = True,
+        block_map: Optional["BlockMap"] = None,
+        gaps: str = "none",
+        hashes: Optional[List[tuple]] = None,
+    ):
+        self.source = source
+        self.target = target
+        self.block_size = block_size or optimal_chunk_size(target)
+        self._progress = progress
+        self._should_stop = should_stop or (lambda: False)
+        # Data has to go through userspace to be hashed
+        self.zero_copy = zero_copy and hashes is None
+        self.hashes = hashes
+        self.block_map = block_map
+        self.gaps = gaps
+        self.stopped = False
+        self.written = 0
+        # Seconds spent writing to the disk, only on the ring path
+        self.write_time = 0.0
+        self.total_size = 0
+        self.method = None
+        self._meter: Optional[ProgressMeter] = None
+        self._extents: Optional[List[tuple]] = []
+
+    def run(self) -> bool:
+        """
+        Returns True if the whole image has been written, False if stopped. I/O errors are raised.
+        """
+        if compression_of(self.source):
+            return self._run_compressed()
+        self._extents = self.block_map.extents() if self.block_map else [(0, source_size(self.source))]
+        self.total_size = sum(length for _, length in self._extents)
+        self._meter = ProgressMeter(self.total_size, self._progress)
+        src = open(self.source, "rb", buffering=0)
+        try:
+            _fadvise(src.fileno(), 0, 0, "POSIX_FADV_SEQUENTIAL")
+            completed = None
+            if self.zero_copy:
+                completed = self._copy_in_kernel(src)
+            if completed is None:
+                completed = self._copy_with_ring(src)
+            _fadvise(src.fileno(), 0, 0, "POSIX_FADV_DONTNEED")
+        finally:
+            src.close()
+        if completed:
+            if self.block_map:
+                fill_gaps(self.target, self.block_map.gaps(), self.gaps)
+            self._meter.update(self.written, True)
+        return completed
+
+    def _run_compressed(self) -> bool:
+        # Sizes are unknown until the end, progress goes by how much of the compressed file has been read
+        self.method = "ring, decompressing"
+        self._extents = None
+        src = DecompressedStream(self.source)
+        try:
+            self.total_size = src.size()
+            self._meter = ProgressMeter(self.total_size, self._progress, lambda: src.consumed, lambda: src.stages(self.written, self.write_time))
+            completed = self._copy_with_ring(src)
+        finally:
+            src.close()
+        if completed:
+            self._meter.update(self.written, True)
+        return completed
+
+    def _copy_in_kernel(self, src) -> Optional[bool]:
+        """
+        Returns None if neither copy_file_range nor sendfile work with these files.
+        """
+        dst = os.open(self.target, os.O_WRONLY)
+        try:
+            for method in ("copy_file_range", "sendfile"):
+                if not hasattr(os, method):
+                    continue
+                try:
+                    return self._copy_in_kernel_with(method, src.fileno(), dst)
+                except OSError as e:
+                    # Only possible on the very first call, before anything has been written
+                    if self.written == 0 and e.errno in (errno.EINVAL, errno.ENOSYS, errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP):
+                        logging.debug(f"{method} not supported from {self.source} to {self.target}: {e}")
+                        continue
+                    raise
+            return None
+        finally:
+            os.close(dst)
+
+    def _copy_in_kernel_with(self, method: str, src: int, dst: int) -> bool:
+        self.method = method
+        dropped = 0
+        for start, length in self._extents:
+            position = start
+            while position < start + length:
+                if self._should_stop():
+                    self.stopped = True
+                    return False
+                count = min(self.block_size, start + length - position)
+                if method == "copy_file_range":
+                    done = os.copy_file_range(src, dst, count, position, position)
+                else:
+                    # sendfile writes at the current position of the output
+                    os.lseek(dst, position, os.SEEK_SET)
+                    done = os.sendfile(dst, src, position, count)
+                if done == 0:
+                    raise OSError(errno.EIO, f"{self.source} is shorter than expected")
+                _fadvise(src, position, done, "POSIX_FADV_DONTNEED")
+                position += done
+                self.written += done
+                if self.written - dropped >= self.DROP_CACHE_EVERY:
+                    # Dirty pages cannot be dropped, write them out first
+                    os.fdatasync(dst)
+                    _fadvise(dst, 0, 0, "POSIX_FADV_DONTNEED")
+                    dropped = self.written
+                self._meter.update(self.written)
+        os.fdatasync(dst)
+        _fadvise(dst, 0, 0, "POSIX_FADV_DONTNEED")
+        return True
+
+    def _copy_with_ring(self, src) -> bool:
+        self.method = "ring"
+        ring = BufferRing(self.RING_SLOTS, self.block_size)
+        reader = RingReader(src, ring, self._extents, self.hashes)
+        reader.start()
+        dst = TargetWriter(self.target)
+        try:
+            while True:
+                if self._should_stop():
+                    self.stopped = True
+                    return False
+                item = ring.get_filled()
+                if item is None:
+                    break
+                slot, offset, length = item
+                begin = time.monotonic()
+                dst.write(ring.views[slot], offset, length)
+                self.write_time += time.monotonic() - begin
+                ring.put_free(slot)
+                self.written += length
+                self._meter.update(self.written)
+            if reader.error:
+                raise reader.error
+            dst.flush()
+            return True
+        finally:
+            reader.stop()
+            dst.close()
+            reader.join()
+
+
+class ProgressMeter:
+    """
+    Calls progress(percent, bytes per second, stage report or None) at most once every PROGRESS_INTERVAL, and always
+    at the end.
+    """
+
+    def __init__(
+        self,
+        total_size: int,
+        progress: Optional[Callable[[float, float, Optional[str]], None]],
+        position: Optional[Callable[[], int]] = None,
+        stages: Optional[Callable[[], str]] = None,
+    ):
+        self._total_size = total_size
+        self._progress = progress
+        # Where we are in total_size, if it is not the bytes written (compressed images)
+        self._position = position
+        self._stages = stages
+        self._start = self._last_report = time.monotonic()
+        self._last_done = 0
+
+    def update(self, done: int, final: bool = False):
+        now = time.monotonic()
+        if not self._progress or (not final and now - self._last_report < PROGRESS_INTERVAL):
+            return
+        if final:
+            rate = done / (now - self._start) if now > self._start else 0.0
+        else:
+            rate = (done - self._last_done) / (now - self._last_report)
+        position = self._position() if self._position else done
+        percent = min(position / self._total_size * 100, 100.0) if self._total_size else 100.0
+        self._progress(percent, rate, self._stages() if self._stages else None)
+        self._last_report = now
+        self._last_done = done
+
+
+class TargetWriter:
+    """
+    Writes slots of a ring to a disk with O_DIRECT when possible.
+    """
+
+    def __init__(self, target: str):
+        self.target = target
+        self._fd, self._direct = open_direct(target, os.O_WRONLY)
+        self._lbs = logical_block_size(target)
+
+    def write(self, view: memoryview, offset: int, length: int):
+        aligned = length - length % self._lbs if self._direct else length
+        if aligned > 0:
+            os.pwrite(self._fd, view[:aligned], offset)
+        if aligned < length:
+            # O_DIRECT only accepts whole blocks, the tail of the image goes through the page cache
+            _write_unaligned(self.target, view[aligned:length], offset + aligned)
+
+    def flush(self):
+        os.fdatasync(self._fd)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class RingReader(threading.Thread):
+    """
+    Fills a BufferRing from a file object with readinto, in order, until EOF.
+    If hashes is a list, (offset, length, digest) of each slot is appended to it before the slot is handed over.
+    """
+
+    def __init__(self, src, ring: BufferRing, extents: Optional[List[tuple]], hashes: Optional[List[tuple]] = None):
+        threading.Thread.__init__(self, daemon=True)
+        self._src = src
+        self._ring = ring
+        self._extents = extents
+        self._hashes = hashes
+        self._go = True
+        self.error: Optional[BaseException] = None
+
+    def stop(self):
+        self._go = False
+        # Unblock the reader if it is waiting for a free slot
+        self._ring.put_free(0)
+
+    def _get_free(self) -> Optional[int]:
+        slot = self._ring.get_free()
+        return slot if self._go else None
+
+    def run(self):
+        try:
+            for slot, offset, length in _read_extents(self._src, self._extents, self._ring.views, self._get_free):
+                if self._hashes is not None:
+                    self._hashes.append((offset, length, chunk_digest(self._ring.views[slot][:length])))
+                self._ring.put_filled((slot, offset, length))
+        except BaseException as e:
+            self.error = e
+        finally:
+            self._ring.put_filled(None)
+
+
+class FanOut:
+    """
+    Write one image to many disks reading it only once.
+
+    A single reader thread fills a ring of aligned slots, every target has its own writer (the thread that calls
+    write_to) that goes through the slots in order. A slot is reused only when every writer is done with it, so a
+    slow disk holds back the others by at most the size of the ring. A writer that fails or is stopped detaches
+    and the others go on.
+    """
+
+    def __init__(
+        self,
+        source: str,
+        slot_size: int,
+        slots: int = 8,
+        block_map: Optional["BlockMap"] = None,
+        gaps: str = "none",
+        hash_chunks: bool = False,
+    ):
+        self.source = source
+        # Pieces of the image hashed by the reader, like ImageWriter does
+        self.hashes: Optional[List[tuple]] = [] if hash_chunks else None
+        self.block_map = block_map
+        self.gaps = gaps
+        # Offsets must be aligned for O_DIRECT on every target
+        self.slot_size = slot_size + -slot_size % 4096
+        self.compressed = compression_of(source) is not None
+        self._stream: Optional[DecompressedStream] = None
+        if self.compressed:
+            # Read from start to end, progress goes by the compressed size
+            self._extents = None
+            self.total_size = source_size(source)
+        else:
+            self._extents = block_map.extents() if block_map else [(0, source_size(source))]
+            self.total_size = sum(length for _, length in self._extents)
+        self._views = [memoryview(aligned_buffer(self.slot_size)) for _ in range(slots)]
+        self._offsets = [0] * slots
+        self._lengths = [0] * slots
+        # Writers that still have to write each slot
+        self._pending = [0] * slots
+        self._cond = threading.Condition()
+        # Slots [0, _filled) have been read, _eof is set when the reader is done
+        self._filled = 0
+        self._eof = False
+        self._error: Optional[BaseException] = None
+        self._writers: Dict[int, int] = {}
+        self._next_id = 0
+        self._reader = threading.Thread(target=self._read, name=f"fanout-{os.path.basename(source)}", daemon=True)
+
+    def add_target(self) -> int:
+        with self._cond:
+            writer_id = self._next_id
+            self._next_id += 1
+            self._writers[writer_id] = 0
+            return writer_id
+
+    def targets(self) -> int:
+        with self._cond:
+            return len(self._writers)
+
+    def start(self):
+        self._reader.start()
+
+    def write_to(
+        self,
+        writer_id: int,
+        target: str,
+        progress: Optional[Callable[[float, float, Optional[str]], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+        hashes: Optional[List[tuple]] = None,
+    ) -> bool:
+        """
+        Returns True if the whole image has been written, False if stopped. I/O errors, including the reader's, are raised.
+        If the FanOut hashes chunks, they are added to hashes once everything has been written.
+        """
+        should_stop = should_stop or (lambda: False)
+        written = 0
+        write_time = 0.0
+        if self.compressed:
+            meter = ProgressMeter(self.total_size, progress, self._consumed, lambda: self._stream.stages(written, write_time) if self._stream else "")
+        else:
+            meter = ProgressMeter(self.total_size, progress)
+        dst = None
+        try:
+            dst = TargetWriter(target)
+            while True:
+                if should_stop():
+                    return False
+                sequence = self._writers[writer_id]
+                with self._cond:
+                    while sequence >= self._filled and not self._eof:
+                        self._cond.wait()
+                    if sequence >= self._filled:
+                        if self._error:
+                            raise self._error
+                        break
+                slot = sequence % len(self._views)
+                length = self._lengths[slot]
+                begin = time.monotonic()
+                dst.write(self._views[slot], self._offsets[slot], length)
+                write_time += time.monotonic() - begin
+                written += length
+                with self._cond:
+                    self._writers[writer_id] = sequence + 1
+                    self._pending[slot] -= 1
+                    if self._pending[slot] == 0:
+                        self._cond.notify_all()
+                meter.update(written)
+            dst.flush()
+            if self.block_map:
+                fill_gaps(target, self.block_map.gaps(), self.gaps)
+            if hashes is not None and self.hashes is not None:
+                hashes.extend(self.hashes)
+            meter.update(written, True)
+            return True
+        finally:
+            self._detach(writer_id)
+            if dst:
+                dst.close()
+
+    def _consumed(self) -> int:
+        stream = self._stream
+        return stream.consumed if stream else 0
+
+    def _detach(self, writer_id: int):
+        with self._cond:
+            sequence = self._writers.pop(writer_id, None)
+            if sequence is None:
+                return
+            # Release every slot this writer did not get to
+            for unwritten in range(sequence, self._filled):
+                self._pending[unwritten % len(self._views)] -= 1
+            self._cond.notify_all()
+
+    def _wait_free_slot(self) -> Optional[int]:
+        slot = self._filled % len(self._views)
+        with self._cond:
+            while self._pending[slot] > 0:
+                self._cond.wait()
+            if len(self._writers) == 0:
+                # Everyone gave up
+                return None
+        return slot
+
+    def _read(self):
+        src = None
+        try:
+            if self.compressed:
+                src = self._stream = DecompressedStream(self.source)
+            else:
+                src = open(self.source, "rb", buffering=0)
+                _fadvise(src.fileno(), 0, 0, "POSIX_FADV_SEQUENTIAL")
+            for slot, offset, length in _read_extents(src, self._extents, self._views, self._wait_free_slot):
+                if not self.compressed:
+                    # Already in every writer's hands, the page cache copy is not needed anymore
+                    _fadvise(src.fileno(), offset, length, "POSIX_FADV_DONTNEED")
+                if self.hashes is not None:
+                    self.hashes.append((offset, length, chunk_digest(self._views[slot][:length])))
+                with self._cond:
+                    self._offsets[slot] = offset
+                    self._lengths[slot] = length
+                    self._pending[slot] = len(self._writers)
+                    self._filled += 1
+                    self._cond.notify_all()
+        except BaseException as e:
+            logging.warning(f"Reading {self.source} failed", exc_info=e)
+            self._error = e
+        finally:
+            if src:
+                src.close()
+            with self._cond:
+                self._eof = True
+                self._cond.notify_all()
+
+
+class DecompressedStream:
+    """
+    A compressed image, read through an external decompressor (see DECOMPRESSORS).
+
+    The decompressor runs in its own process, so it uses other cores while basilico writes to the disk. A feeder
+    thread reads the compressed file and pipes it in, counting how much has been consumed. readinto reads the
+    decompressed output, like a file opened with buffering=0.
+    """
+
+    FEED_SIZE = 1024 * 1024
+
+    def __init__(self, path: str):
+        self.path = path
+        self.command = decompressor_for(path)
+        if self.command is None:
+            raise OSError(errno.ENOENT, f"No decompressor installed for {path}")
+        # Compressed bytes read, decompressed bytes returned, seconds spent reading and waiting for the decompressor
+        self.consumed = 0
+        self.produced = 0
+        self.read_time = 0.0
+        self.output_wait = 0.0
+        self._error: Optional[BaseException] = None
+        self._go = True
+        self._src = open(path, "rb", buffering=0)
+        _fadvise(self._src.fileno(), 0, 0, "POSIX_FADV_SEQUENTIAL")
+        try:
+            self._process = subprocess.Popen(self.command, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0)
+        except OSError:
+            self._src.close()
+            raise
+        self._feeder = threading.Thread(target=self._feed, name=f"feed-{os.path.basename(path)}", daemon=True)
+        self._feeder.start()
+
+    def size(self) -> int:
+        return os.fstat(self._src.fileno()).st_size
+
+    def readinto(self, view: memoryview) -> int:
+        begin = time.monotonic()
+        read = self._process.stdout.readinto(view)
+        self.output_wait += time.monotonic() - begin
+        if not read:
+            self._finish()
+            return 0
+        self.produced += read
+        return read
+
+    def stages(self, written: int, write_time: float) -> str:
+        """
+        Throughput of each stage while it was busy, and the slowest one: the others are waiting for it.
+        """
+        # While the source is being read the decompressor is starved, that is not decompression time
+        decompress_time = max(self.output_wait - self.read_time, 0.0)
+        busy = {"read": self.read_time, "decompression": decompress_time, "write": write_time}
+        bottleneck = max(busy, key=busy.get)
+        return (
+            f"read {_stage_rate(self.consumed, self.read_time)}, decompression {_stage_rate(self.produced, decompress_time)}, "
+            f"write {_stage_rate(written, write_time)}, bottleneck: {bottleneck}"
+        )
+
+    def close(self):
+        self._go = False
+        if self._process.poll() is None:
+            self._process.kill()
+        self._process.wait()
+        self._process.stdout.close()
+        self._feeder.join()
+        self._src.close()
+
+    def _feed(self):
+        try:
+            while self._go:
+                begin = time.monotonic()
+                data = self._src.read(self.FEED_SIZE)
+                self.read_time += time.monotonic() - begin
+                if not data:
+                    break
+                view = memoryview(data)
+                while view:
+                    # Unbuffered pipes may take less than asked
+                    view = view[self._process.stdin.write(view) :]
+                _fadvise(self._src.fileno(), self.consumed, len(data), "POSIX_FADV_DONTNEED")
+                self.consumed += len(data)
+        except BrokenPipeError:
+            # The decompressor is gone, its exit code tells why
+            pass
+        except BaseException as e:
+            self._error = e
+        finally:
+            try:
+                self._process.stdin.close()
+            except OSError:
+                pass
+
+    def _finish(self):
+        self._feeder.join()
+        if self._error:
+            raise self._error
+        code = self._process.wait()
+        if code != 0:
+            raise OSError(errno.EIO, f"{self.command[0]} failed on {self.path} with exit code {code}")
+
+
+class ReadBackVerifier:
+    """
+    Read back what has been written to a disk and compare it with the hashes taken while writing.
+
+    A reader thread does large sequential reads with O_DIRECT (the page cache must not answer for the disk) into a
+    ring, the calling thread hashes them, so reading and hashing overlap. Pieces that do not match are merged into
+    regions, to tell where the disk is wrong and not just that it is.
+    """
+
+    RING_SLOTS = 4
+
+    def __init__(
+        self,
+        target: str,
+        hashes: List[tuple],
+        progress: Optional[Callable[[float, float, Optional[str]], None]] = None,
+        should_stop: Optional[Callable[[], bool]] = None,
+    ):
+        self.target = target
+        self.hashes = hashes
+        self._progress = progress
+        self._should_stop = should_stop or (lambda: False)
+        self._lbs = logical_block_size(target)
+        # Room for the longest piece, rounded up to whole blocks for O_DIRECT
+        longest = max((length for _, length, _ in hashes), default=0)
+        self.slot_size = max(longest + -longest % 4096, 4096)
+        self.verified = 0
+        self.stopped = False
+        self._go = True
+        self._error: Optional[BaseException] = None
+
+    def run(self) -> List[tuple]:
+        """
+        Returns the (offset, length) regions that differ, an empty list if everything matches. I/O errors are raised.
+        """
+        ring = BufferRing(self.RING_SLOTS, self.slot_size)
+        meter = ProgressMeter(sum(length for _, length, _ in self.hashes), self._progress)
+        reader = threading.Thread(target=self._read, args=(ring,), name=f"verify-{sysfs_block_name(self.target)}", daemon=True)
+        reader.start()
+        mismatches = []
+        try:
+            while True:
+                if self._should_stop():
+                    self.stopped = True
+                    break
+                item = ring.get_filled()
+                if item is None:
+                    break
+                slot, index = item
+                offset, length, digest = self.hashes[index]
+                if chunk_digest(ring.views[slot][:length]) != digest:
+                    logging.warning(f"{self.target} differs from the image between {offset} and {offset + length}")
+                    if mismatches and mismatches[-1][0] + mismatches[-1][1] == offset:
+                        mismatches[-1] = (mismatches[-1][0], mismatches[-1][1] + length)
+                    else:
+                        mismatches.append((offset, length))
+                ring.put_free(slot)
+                self.verified += length
+                meter.update(self.verified)
+            if self._error:
+                raise self._error
+        finally:
+            self._go = False
+            ring.put_free(0)
+            reader.join()
+        if not self.stopped:
+            meter.update(self.verified, True)
+        return mismatches
+
+    def _read(self, ring: BufferRing):
+        fd, direct = open_direct(self.target, os.O_RDONLY)
+        buffered = os.open(self.target, os.O_RDONLY)
+        try:
+            # Pages cached while writing the unaligned parts would hide what is on the disk
+            _fadvise(buffered, 0, 0, "POSIX_FADV_DONTNEED")
+            for index, (offset, length, _) in enumerate(self.hashes):
+                slot = ring.get_free()
+                if not self._go:
+                    return
+                view = ring.views[slot]
+                if direct and offset % self._lbs == 0:
+                    read = _preadv_full(fd, view[: length + -length % self._lbs], offset, length)
+                else:
+                    read = _preadv_full(buffered, view[:length], offset, length)
+                if read < length:
+                    raise OSError(errno.EIO, f"{self.target} ended at {offset + read} bytes, expected more data")
+                ring.put_filled((slot, index))
+        except BaseException as e:
+            self._error = e
+        finally:
+            os.close(fd)
+            os.close(buffered)
+            ring.put_filled(None)
+
+
+class BlockMap:
+    """
+    Which blocks of an image contain data, in the bmaptool format (version 2.0), stored next to the image as
+    <image>.bmap. utils/make_bmap.py generates it by looking at the partitions and filesystems in the image.
+    """
+
+    VERSION = "2.0"
+
+    def __init__(self, image_size: int, block_size: int, ranges: List[tuple]):
+        self.image_size = image_size
+        self.block_size = block_size
+        # Inclusive (first block, last block), sorted and not overlapping
+        self.ranges = ranges
+
+    @staticmethod
+    def sidecar_path(image: str) -> str:
+        return image + ".bmap"
+
+    @classmethod
+    def for_image(cls, image: str) -> Optional["BlockMap"]:
+        """
+        Load the block map of an image, if there is one and it matches the image.
+        """
+        path = cls.sidecar_path(image)
+        if not os.path.isfile(path):
+            return None
+        try:
+            block_map = cls.load(path)
+        except (OSError, ValueError, ElementTree.ParseError) as e:
+            logging.warning(f"Ignoring invalid block map {path}: {e}")
+            return None
+        if block_map.image_size != source_size(image):
+            logging.warning(f"Ignoring block map {path}: it is for an image of {block_map.image_size} bytes")
+            return None
+        return block_map
+
+    @classmethod
+    def load(cls, path: str) -> "BlockMap":
+        root = ElementTree.parse(path).getroot()
+        if root.tag != "bmap":
+            raise ValueError("not a bmap file")
+        image_size = int(root.findtext("ImageSize").strip())
+        block_size = int(root.findtext("BlockSize").strip())
+        ranges = []
+        for element in root.find("BlockMap").findall("Range"):
+            first, _, last = element.text.strip().partition("-")
+            ranges.append((int(first), int(last or first)))
+        ranges.sort()
+        return cls(image_size, block_size, ranges)
+
+    def save(self, path: str, image: str):
+        """
+        Write the block map, with the sha256 checksums bmaptool wants. image is read to compute them.
+        """
+        lines = [
+            '<?xml version="1.0" ?>',
+            f'<bmap version="{self.VERSION}">',
+            f"    <ImageSize> {self.image_size} </ImageSize>",
+            f"    <BlockSize> {self.block_size} </BlockSize>",
+            f"    <BlocksCount> {-(-self.image_size // self.block_size)} </BlocksCount>",
+            f"    <MappedBlocksCount> {sum(last - first + 1 for first, last in self.ranges)} </MappedBlocksCount>",
+            "    <ChecksumType> sha256 </ChecksumType>",
+            f"    <BmapFileChecksum> {'0' * 64} </BmapFileChecksum>",
+            "    <BlockMap>",
+        ]
+        with open(image, "rb", buffering=0) as f:
+            for first, last in self.ranges:
+                text = str(first) if first == last else f"{first}-{last}"
+                lines.append(f'        <Range chksum="{self._checksum(f, first, last)}"> {text} </Range>')
+        lines += ["    </BlockMap>", "</bmap>", ""]
+        content = "\n".join(lines)
+        # The checksum of the file is computed with the checksum field set to zeros
+        content = content.replace("0" * 64, hashlib.sha256(content.encode("utf-8")).hexdigest(), 1)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def _checksum(self, f, first: int, last: int) -> str:
+        digest = hashlib.sha256()
+        buffer = bytearray(DEFAULT_CHUNK_SIZE)
+        view = memoryview(buffer)
+        start, end = self._range_bytes(first, last)
+        f.seek(start)
+        while start < end:
+            read = f.readinto(view[: min(len(view), end - start)])
+            if not read:
+                break
+            digest.update(view[:read])
+            start += read
+        return digest.hexdigest()
+
+    def _range_bytes(self, first: int, last: int) -> (int, int):
+        return first * self.block_size, min((last + 1) * self.block_size, self.image_size)
+
+    def extents(self) -> List[tuple]:
+        """
+        Mapped parts of the image as (offset, length) in bytes.
+        """
+        result = []
+        for first, last in self.ranges:
+            start, end = self._range_bytes(first, last)
+            if end > start:
+                result.append((start, end - start))
+        return result
+
+    def gaps(self) -> List[tuple]:
+        """
+        Unmapped parts of the image as (offset, length) in bytes.
+        """
+        result = []
+        position = 0
+        for start, length in self.extents():
+            if start > position:
+                result.append((position, start - position))
+            position = start + length
+        if position < self.image_size:
+            result.append((position, self.image_size - position))
+        return result
+
+
+def fill_gaps(target: str, gaps: List[tuple], mode: str):
+    """
+    Take care of the parts of the disk that the image does not map: "discard" them (fast on SSDs, contents
+    are undefined afterwards), "zero" them (BLKZEROOUT, the disk does it if it can) or leave them as they are ("none").
+    """
+    if mode not in ("discard", "zero") or not gaps:
+        return
+    if not stat.S_ISBLK(os.stat(target).st_mode):
+        logging.debug(f"{target} is not a block device, not filling gaps")
+        return
+    request = BLKDISCARD if mode == "discard" else BLKZEROOUT
+    fd = os.open(target, os.O_WRONLY)
+    try:
+        for start, length in gaps:
+            try:
+                fcntl.ioctl(fd, request, struct.pack("QQ", start, length))
+            except OSError as e:
+                if e.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL):
+                    logging.info(f"{target} does not support {mode}, leaving gaps as they are")
+                    return
+                raise
+    finally:
+        os.close(fd)
+
+
+def compression_of(path: str) -> Optional[str]:
+    """
+    The compressed image extension of path (e.g. ".img.xz"), None for raw images.
+    """
+    for extension in DECOMPRESSORS:
+        if path.endswith(extension):
+            return extension
+    return None
+
+
+def decompressor_for(path: str) -> Optional[tuple]:
+    for command in DECOMPRESSORS.get(compression_of(path), ()):
+        if shutil.which(command[0]):
+            return command
+    return None
+
+
+def chunk_digest(data) -> bytes:
+    # blake2b is faster than sha256 without hardware support, and releases the GIL like every hashlib function
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+def _stage_rate(done: int, seconds: float) -> str:
+    return format_rate(done / seconds) if seconds > 0 else "-"
+
+
+def source_size(path: str) -> int:
+    mode = os.stat(path).st_mode
+    if stat.S_ISBLK(mode) or stat.S_ISCHR(mode):
+        with open(path, "rb") as f:
+            return f.seek(0, 2)
+    return os.path.getsize(path)
+
+
+def _read_extents(src, extents: Optional[List[tuple]], views: List[memoryview], get_slot: Callable[[], Optional[int]]):
+    """
+    Read the extents into the slots returned by get_slot, yields (slot, offset, length) for each one filled.
+    Stops early if get_slot returns None, a short image is an error.
+    With no extents the source is read from start to end, without seeking: it may be a DecompressedStream.
+    """
+    if extents is None:
+        position = 0
+        while True:
+            slot = get_slot()
+            if slot is None:
+                return
+            read = _readinto_full(src, views[slot])
+            if read == 0:
+                return
+            yield slot, position, read
+            position += read
+    for start, length in extents:
+        position = start
+        while position < start + length:
+            slot = get_slot()
+            if slot is None:
+                return
+            view = views[slot]
+            src.seek(position)
+            read = _readinto_full(src, view[: min(len(view), start + length - position)])
+            if read == 0:
+                raise OSError(errno.EIO, f"Image ended at {position} bytes, expected more data")
+            yield slot, position, read
+            position += read
+
+
+def _readinto_full(src, view: memoryview) -> int:
+    # readinto may return less than asked (pipes, decompressors), keep going until the slot is full or EOF
+    total = 0
+    while total < len(view):
+        n = src.readinto(view[total:])
+        if not n:
+            break
+        total += n
+    return total
+
+
+def _preadv_full(fd: int, view: memoryview, offset: int, needed: int) -> int:
+    # Stop at EOF or when at least needed bytes are there, view may be longer than that for O_DIRECT
+    total = 0
+    while total < needed:
+        n = os.preadv(fd, [view[total:]], offset + total)
+        if n == 0:
+            break
+        total += n
+    return total
+
+
+def _write_unaligned(path: str, data: memoryview, offset: int):
+    fd = os.open(path, os.O_WRONLY)
+    try:
+        os.pwrite(fd, data, offset)
+        os.fdatasync(fd)
+    finally:
+        os.close(fd)
+
+
+def _fadvise(fd: int, offset: int, length: int, advice: str):
+    # Only a hint, not available everywhere
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(fd, offset, length, getattr(os, advice))
+        except OSError:
+            pass
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+Catalogue of the system images that cannolo can write, so that list_iso does not go through the whole directory
+every time and clients get more than a file name.
+
+Directories are refreshed by comparing size, mtime and inode of each file with what is already known: files that
+did not change keep their format and hash, new and modified ones are hashed by a background thread. Everything is
+saved to a JSON file, so restarting the server does not mean hashing many GB of images again.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import queue
+import threading
+from typing import Optional, Callable, Dict, List, Set
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+# Files with other extensions are not listed at all
+IMAGE_EXTENSIONS = (".iso", ".img", ".img.gz", ".img.xz", ".img.zst")
+# Magic bytes at the start of the file
+MAGIC_NUMBERS = (
+    (b"\x1f\x8b", "img.gz"),
+    (b"\xfd7zXZ\x00", "img.xz"),
+    (b"\x28\xb5\x2f\xfd", "img.zst"),
+)
+# ISO 9660 primary volume descriptor, hybrid ISOs also have an MBR so this is checked first
+ISO_MAGIC_OFFSET = 0x8001
+ISO_MAGIC = b"CD001"
+
+
+def detect_format(path: str) -> str:
+    """
+    What the file contains according to its first bytes: iso, img, img.gz, img.xz or img.zst.
+    Raw images without a partition table cannot be told apart from garbage, those are "img" if the extension says so,
+    "unknown" otherwise.
+    """
+    with open(path, "rb") as f:
+        head = f.read(512)
+        for magic, name in MAGIC_NUMBERS:
+            if head.startswith(magic):
+                return name
+        f.seek(ISO_MAGIC_OFFSET)
+        if f.read(len(ISO_MAGIC)) == ISO_MAGIC:
+            return "iso"
+    if len(head) == 512 and head[510:512] == b"\x55\xaa":
+        return "img"
+    return "img" if path.endswith(".img") else "unknown"
+
+
+def file_hash(path: str, should_stop: Callable[[], bool]) -> Optional[str]:
+    """
+    sha256 of a file, None if should_stop returned True before the end.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb", buffering=0) as f:
+        view = memoryview(bytearray(HASH_CHUNK_SIZE))
+        position = 0
+        while not should_stop():
+            read = f.readinto(view)
+            if not read:
+                break
+            digest.update(view[:read])
+            # Hashing a whole image should not evict everything else from the page cache
+            os.posix_fadvise(f.fileno(), position, read, os.POSIX_FADV_DONTNEED)
+            position += read
+        else:
+            return None
+    return digest.hexdigest()
+
+
+class ImageCatalogue:
+    """
+    Images in every directory that has been asked for (or listed in IMAGE_DIRS), with size, mtime, format and
+    sha256. The hash is None until the background thread gets to it.
+    """
+
+    def __init__(self, store_path: Optional[str], scan_interval: float = 60.0):
+        self._store_path = store_path
+        self._scan_interval = scan_interval
+        self._lock = threading.Lock()
+        # Absolute path -> entry
+        self._images: Dict[str, dict] = {}
+        self._directories: Set[str] = set()
+        self._to_hash = queue.Queue()
+        self._stop = threading.Event()
+        self._threads: List[threading.Thread] = []
+        self._load()
+
+    def start(self):
+        for target, name in ((self._hash_forever, "catalogue-hash"), (self._scan_forever, "catalogue-scan")):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        # Images whose hash was not done before the last shutdown
+        with self._lock:
+            for path, entry in self._images.items():
+                if entry["hash"] is None:
+                    self._to_hash.put(path)
+
+    def stop(self):
+        self._stop.set()
+        self._to_hash.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def watch(self, directory: str):
+        with self._lock:
+            self._directories.add(os.path.realpath(directory))
+
+    def list(self, directory: str) -> List[dict]:
+        """
+        Images in a directory, sorted by name. The directory is refreshed first, which costs a stat per file.
+        OSError is raised if the directory cannot be read.
+        """
+        directory = os.path.realpath(directory)
+        self.refresh(directory)
+        with self._lock:
+            self._directories.add(directory)
+            images = [self._public(entry) for entry in self._images.values() if entry["directory"] == directory]
+        return sorted(images, key=lambda image: image["name"])
+
+    def hash_of(self, path: str) -> Optional[str]:
+        """
+        sha256 of an image, if it has been computed and the file did not change since.
+        """
+        path = os.path.realpath(path)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        with self._lock:
+            entry = self._images.get(path)
+            if entry is None or not self._same_file(entry, st):
+                return None
+            return entry["hash"]
+
+    def refresh(self, directory: str):
+        found = {}
+        with os.scandir(directory) as it:
+            for dir_entry in it:
+                if dir_entry.name.startswith(".") or not dir_entry.name.endswith(IMAGE_EXTENSIONS):
+                    continue
+                try:
+                    if dir_entry.is_file():
+                        found[os.path.join(directory, dir_entry.name)] = dir_entry.stat()
+                except OSError:
+                    # Deleted while scanning
+                    continue
+
+        with self._lock:
+            gone = [path for path, entry in self._images.items() if entry["directory"] == directory and path not in found]
+            for path in gone:
+                del self._images[path]
+            new = {path: st for path, st in found.items() if path not in self._images or not self._same_file(self._images[path], st)}
+        entries = {}
+        for path, st in new.items():
+            # Only new and modified files are opened
+            try:
+                image_format = detect_format(path)
+            except OSError as e:
+                logging.warning(f"Cannot read image {path}: {e}")
+                continue
+            entries[path] = {
+                "path": path,
+                "name": os.path.basename(path),
+                "directory": directory,
+                "size": st.st_size,
+                "mtime_ns": st.st_mtime_ns,
+                "inode": st.st_ino,
+                "format": image_format,
+                "hash": None,
+            }
+        with self._lock:
+            self._images.update(entries)
+        for path in entries:
+            self._to_hash.put(path)
+        if gone or entries:
+            self._save()
+
+    def _hash_forever(self):
+        while True:
+            path = self._to_hash.get()
+            if path is None or self._stop.is_set():
+                return
+            with self._lock:
+                entry = self._images.get(path)
+                if entry is None or entry["hash"] is not None:
+                    continue
+            try:
+                st = os.stat(path)
+                if not self._same_file(entry, st):
+                    # Will be picked up by the next refresh
+                    continue
+                logging.debug(f"Hashing image {path}")
+                digest = file_hash(path, self._stop.is_set)
+                if digest is None:
+                    return
+                st = os.stat(path)
+            except OSError as e:
+                logging.warning(f"Cannot hash image {path}: {e}")
+                continue
+            with self._lock:
+                # Still being copied in the directory, or replaced while hashing
+                if self._images.get(path) is not entry or not self._same_file(entry, st):
+                    continue
+                entry["hash"] = digest
+            logging.info(f"Image {path} hashed: {digest}")
+            self._save()
+
+    def _scan_forever(self):
+        while not self._stop.wait(self._scan_interval):
+            with self._lock:
+                directories = list(self._directories)
+            for directory in directories:
+                try:
+                    self.refresh(directory)
+                except OSError as e:
+                    logging.debug(f"Cannot scan image directory {directory}: {e}")
+
+    @staticmethod
+    def _same_file(entry: dict, st: os.stat_result) -> bool:
+        return entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns and entry["inode"] == st.st_ino
+
+    @staticmethod
+    def _public(entry: dict) -> dict:
+        return {
+            "path": entry["path"],
+            "name": entry["name"],
+            "size": entry["size"],
+            "mtime": entry["mtime_ns"] // 1_000_000_000,
+            "format": entry["format"],
+            "hash": entry["hash"],
+        }
+
+    def _load(self):
+        if not self._store_path:
+            return
+        try:
+            with open(self._store_path, "r") as f:
+                stored = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring image catalogue {self._store_path}: {e}")
+            return
+        for entry in stored.get("images", []):
+            self._images[entry["path"]] = entry
+        self._directories.update(stored.get("directories", []))
+
+    def _save(self):
+        if not self._store_path:
+            return
+        with self._lock:
+            stored = {"directories": sorted(self._directories), "images": list(self._images.values())}
+            temporary = f"{self._store_path}.tmp"
+            try:
+                os.makedirs(os.path.dirname(self._store_path), exist_ok=True)
+                with open(temporary, "w") as f:
+                    json.dump(stored, f, indent=1)
+                os.replace(temporary, self._store_path)
+            except OSError as e:
+                logging.warning(f"Cannot save image catalogue to {self._store_path}: {e}")
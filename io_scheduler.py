@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""
+Decide when long jobs (erase, imaging) can start, based on what the disks share on the way to the CPU.
+
+16 disks behind the same USB hub or SAS expander do not go 16 times faster if erased at once, they split the
+bandwidth of the link and every job takes longer. Links are found by walking up /sys/block/*/device: the controller
+(the closest PCI device), USB buses and hubs and SAS expanders. Each link has a budget of jobs and of bandwidth,
+and a job starts only when every link on its path has room for it. Jobs that do not fit wait, and jobs behind other
+links can overtake them. When room frees up, waiting jobs are considered by priority, then in arrival order.
+"""
+
+import logging
+import os
+import re
+import threading
+from typing import Optional, Callable, Dict, List
+
+SYS_BLOCK = "/sys/block"
+SYS_DEVICES = "/sys/devices/"
+PCI_DEVICE = re.compile(r"^[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-7]$")
+USB_BUS = re.compile(r"^usb\d+$")
+USB_DEVICE = re.compile(r"^\d+-\d+(\.\d+)*$")
+SAS_EXPANDER = re.compile(r"^expander-\d+:\d+$")
+USB_HUB_CLASS = "09"
+# What is left of the nominal rate after protocol overhead, roughly
+USB_EFFICIENCY = 0.8
+# PCIe GT/s to bytes per second per lane, after line encoding
+PCIE_LANE_RATES = {"2.5": 250e6, "5.0": 500e6, "8.0": 985e6, "16.0": 1969e6, "32.0": 3938e6}
+
+
+class Link:
+    def __init__(self, link_id: str, name: str, bandwidth: Optional[float]):
+        # Path under /sys/devices, unique
+        self.id = link_id
+        # Short name for humans and for IO_LINK_BANDWIDTH
+        self.name = name
+        # Bytes per second, None if unknown
+        self.bandwidth = bandwidth
+        self.jobs = 0
+        self.used = 0.0
+
+
+def shared_links(dev: str) -> List[Link]:
+    """
+    Links that a disk shares with other disks, from the closest to the CPU to the closest to the disk.
+    Empty for virtual devices and anything that is not in sysfs.
+    """
+    name = os.path.basename(os.path.realpath(dev))
+    device = os.path.realpath(f"{SYS_BLOCK}/{name}/device")
+    links = []
+    controller_found = False
+    while device.startswith(SYS_DEVICES):
+        base = os.path.basename(device)
+        link_id = device[len(SYS_DEVICES) :]
+        if PCI_DEVICE.match(base):
+            # Only the controller, root ports and bridges above it are shared by even more disks and rarely the limit
+            if not controller_found:
+                links.append(Link(link_id, base, _pcie_bandwidth(device)))
+                controller_found = True
+        elif USB_BUS.match(base) or (USB_DEVICE.match(base) and _read(f"{device}/bDeviceClass") == USB_HUB_CLASS):
+            links.append(Link(link_id, base, _usb_bandwidth(device)))
+        elif SAS_EXPANDER.match(base):
+            links.append(Link(link_id, base, None))
+        device = os.path.dirname(device)
+    links.reverse()
+    return links
+
+
+class IoScheduler:
+    """
+    Admits jobs on their links. request either admits a job right away (returns True) or keeps it and calls its
+    start function later, from the thread that calls release for a job that frees up room.
+    """
+
+    def __init__(self, jobs_per_link: int = 0, bandwidth_overrides: Optional[Dict[str, float]] = None):
+        # 0 means no limit on the number of jobs, only on bandwidth
+        self._jobs_per_link = jobs_per_link
+        self._bandwidth_overrides = bandwidth_overrides or {}
+        self._lock = threading.Lock()
+        self._links: Dict[str, Link] = {}
+        # Job -> (its links, its bandwidth)
+        self._running: Dict[object, tuple] = {}
+        # (job, links, bandwidth, start function, priority), in arrival order
+        self._waiting: List[tuple] = []
+
+    def request(self, job, dev: str, bandwidth: float, start: Callable[[], None], priority: int = 0) -> bool:
+        """
+        Lower priority values go first.
+        """
+        links = self._links_of(dev)
+        with self._lock:
+            if self._fits(links, bandwidth):
+                self._take(job, links, bandwidth)
+                return True
+            self._waiting.append((job, links, bandwidth, start, priority))
+            busy = ", ".join(link.name for link in links if not self._fits([link], bandwidth))
+        logging.info(f"Job on {dev} waits for room on {busy}")
+        return False
+
+    def withdraw(self, job) -> bool:
+        """
+        Forget a waiting job, returns False if it was not waiting.
+        """
+        with self._lock:
+            for i, waiting in enumerate(self._waiting):
+                if waiting[0] is job:
+                    del self._waiting[i]
+                    return True
+        return False
+
+    def release(self, job):
+        """
+        The job is done, start whatever fits now. Does nothing if the job was never admitted.
+        """
+        to_start = []
+        with self._lock:
+            held = self._running.pop(job, None)
+            if held is None:
+                return
+            links, bandwidth = held
+            for link in links:
+                link.jobs -= 1
+                link.used -= bandwidth
+            still_waiting = []
+            # Sorting is stable, same priority is still first come first served
+            for waiting in sorted(self._waiting, key=lambda w: w[4]):
+                other_job, other_links, other_bandwidth, start, _ = waiting
+                if self._fits(other_links, other_bandwidth):
+                    self._take(other_job, other_links, other_bandwidth)
+                    to_start.append(start)
+                else:
+                    still_waiting.append(waiting)
+            self._waiting = still_waiting
+        for start in to_start:
+            # noinspection PyBroadException
+            try:
+                start()
+            except BaseException as e:
+                logging.error("Exception while starting a job that was waiting for its links", exc_info=e)
+
+    def _links_of(self, dev: str) -> List[Link]:
+        links = []
+        for found in shared_links(dev):
+            with self._lock:
+                link = self._links.get(found.id)
+                if link is None:
+                    # Found for the first time, counters live in this one from now on
+                    link = self._links[found.id] = found
+                    if link.name in self._bandwidth_overrides:
+                        link.bandwidth = self._bandwidth_overrides[link.name]
+                    logging.debug(f"Link {link.name}: {'unknown' if link.bandwidth is None else f'{link.bandwidth / 1e6:.0f} MB/s'}")
+            links.append(link)
+        return links
+
+    def _fits(self, links: List[Link], bandwidth: float) -> bool:
+        for link in links:
+            if self._jobs_per_link > 0 and link.jobs >= self._jobs_per_link:
+                return False
+            # A job always fits on an idle link, even if it is faster than the link
+            if link.bandwidth is not None and link.jobs > 0 and link.used + bandwidth > link.bandwidth:
+                return False
+        return True
+
+    def _take(self, job, links: List[Link], bandwidth: float):
+        for link in links:
+            link.jobs += 1
+            link.used += bandwidth
+        self._running[job] = (links, bandwidth)
+
+
+def _usb_bandwidth(device: str) -> Optional[float]:
+    # Mbit/s: 12, 480, 5000, 10000, ...
+    speed = _read(f"{device}/speed")
+    try:
+        return float(speed) * 1e6 / 8 * USB_EFFICIENCY
+    except (TypeError, ValueError):
+        return None
+
+
+def _pcie_bandwidth(device: str) -> Optional[float]:
+    # e.g. "8.0 GT/s PCIe" and "4"
+    speed = _read(f"{device}/current_link_speed")
+    width = _read(f"{device}/current_link_width")
+    if not speed or not width:
+        return None
+    lane_rate = PCIE_LANE_RATES.get(speed.split(" ")[0])
+    try:
+        return lane_rate * int(width) if lane_rate else None
+    except ValueError:
+        return None
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
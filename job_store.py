@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""
+Every queued job, past and present, in a SQLite database: the queue in memory only has what is still there, the
+store has the history too and survives restarts.
+
+Jobs are identified by a number that only goes up, and disks by serial number and WWN as well as path, since the
+same path is a different disk after a swap.
+
+Erase checkpoints live here too, keyed by serial number and WWN, so an erase can continue where it stopped even
+after a restart or with the disk on another port.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional, List
+
+QUEUED = "queued"
+RUNNING = "running"
+FINISHED = "finished"
+FAILED = "failed"
+STOPPED = "stopped"
+# Queued or running when basilico stopped
+INTERRUPTED = "interrupted"
+
+
+class JobStore:
+    def __init__(self, db_path: str):
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            # Fewer fsyncs, a crash may lose the last transitions but not corrupt the database
+            self._db.execute("PRAGMA journal_mode = WAL")
+            self._db.execute("PRAGMA synchronous = NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                # AUTOINCREMENT: ids are never reused, even after deleting the last ones
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                "command TEXT NOT NULL, "
+                "args TEXT NOT NULL, "
+                "target TEXT NOT NULL, "
+                "serial TEXT, "
+                "wwn TEXT, "
+                "code TEXT, "
+                "state TEXT NOT NULL, "
+                "error INTEGER NOT NULL DEFAULT 0, "
+                "text TEXT, "
+                "created REAL NOT NULL, "
+                "started REAL, "
+                "finished REAL, "
+                # Removed from the queue by a client, still part of the history
+                "removed INTEGER NOT NULL DEFAULT 0)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS jobs_serial ON jobs (serial, id)")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS erase_checkpoints ("
+                # Empty strings rather than NULL, or the primary key would not be unique
+                "serial TEXT NOT NULL, "
+                "wwn TEXT NOT NULL, "
+                "state TEXT NOT NULL, "
+                "updated REAL NOT NULL, "
+                "PRIMARY KEY (serial, wwn))"
+            )
+            interrupted = self._db.execute(
+                "UPDATE jobs SET state = ?, finished = ? WHERE state IN (?, ?)", (INTERRUPTED, time.time(), QUEUED, RUNNING)
+            ).rowcount
+        if interrupted:
+            logging.warning(f"{interrupted} jobs were interrupted by the last shutdown")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def add(self, command: str, args: str, target: str, serial: Optional[str], wwn: Optional[str], code: Optional[str]) -> int:
+        with self._lock, self._db:
+            return self._db.execute(
+                "INSERT INTO jobs (command, args, target, serial, wwn, code, state, text, created) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (command, args, target, serial, wwn, code, QUEUED, "Queued", time.time()),
+            ).lastrowid
+
+    def started(self, job_id: int, text: Optional[str]):
+        self._update(job_id, "state = ?, text = COALESCE(?, text), started = ?", (RUNNING, text, time.time()))
+
+    def finished(self, job_id: int, state: str, text: Optional[str]):
+        self._update(job_id, "state = ?, text = COALESCE(?, text), finished = ?", (state, text, time.time()))
+
+    def failed(self, job_id: int, text: Optional[str]):
+        """
+        Something went wrong, but the job goes on.
+        """
+        self._update(job_id, "error = 1, text = COALESCE(?, text)", (text,))
+
+    def removed(self, job_id: int):
+        self._update(job_id, "removed = 1", ())
+
+    def history(self, before: Optional[int] = None, limit: int = 50, serial: Optional[str] = None) -> List[dict]:
+        """
+        Most recent jobs first, only those with an id lower than before if set. Pass the last id of a page as before
+        to get the next one.
+        """
+        conditions = []
+        params = []
+        if before is not None:
+            conditions.append("id < ?")
+            params.append(before)
+        if serial is not None:
+            conditions.append("serial = ?")
+            params.append(serial)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        with self._lock:
+            rows = self._db.execute(f"SELECT * FROM jobs {where} ORDER BY id DESC LIMIT ?", (*params, limit)).fetchall()
+        return [self._job(row) for row in rows]
+
+    def interrupted(self) -> List[dict]:
+        """
+        Jobs that were queued or running when basilico stopped (this time or before) and that no client has removed,
+        oldest first: what is left of the queue.
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM jobs WHERE state = ? AND removed = 0 ORDER BY id", (INTERRUPTED,)).fetchall()
+        return [self._job(row) for row in rows]
+
+    @staticmethod
+    def _job(row: sqlite3.Row) -> dict:
+        return {
+            "id": str(row["id"]),
+            "command": row["command"],
+            "args": row["args"],
+            "target": row["target"],
+            "serial": row["serial"],
+            "wwn": row["wwn"],
+            "code": row["code"],
+            "state": row["state"],
+            "error": bool(row["error"]),
+            "text": row["text"],
+            "created": row["created"],
+            "started": row["started"],
+            "finished": row["finished"],
+            "removed": bool(row["removed"]),
+        }
+
+    def save_checkpoint(self, serial: Optional[str], wwn: Optional[str], state: dict):
+        with self._lock, self._db:
+            self._db.execute(
+                "INSERT OR REPLACE INTO erase_checkpoints (serial, wwn, state, updated) VALUES (?, ?, ?, ?)",
+                (serial or "", wwn or "", json.dumps(state), time.time()),
+            )
+
+    def checkpoint(self, serial: Optional[str], wwn: Optional[str]) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute("SELECT state FROM erase_checkpoints WHERE serial = ? AND wwn = ?", (serial or "", wwn or "")).fetchone()
+        return None if row is None else json.loads(row["state"])
+
+    def clear_checkpoint(self, serial: Optional[str], wwn: Optional[str]):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM erase_checkpoints WHERE serial = ? AND wwn = ?", (serial or "", wwn or ""))
+
+    def _update(self, job_id: int, assignments: str, params: tuple):
+        # noinspection PyBroadException
+        try:
+            with self._lock, self._db:
+                self._db.execute(f"UPDATE jobs SET {assignments} WHERE id = ?", (*params, job_id))
+        except sqlite3.Error as e:
+            # The job itself is fine, only its history is not
+            logging.warning(f"Cannot save state of job {job_id}: {e}")
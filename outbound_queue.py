@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+"""
+Messages from job threads to clients, handed to the reactor in batches.
+
+Calling reactor.callFromThread for every message takes a lock and wakes up the reactor every time, and with many
+jobs sending progress the reactor does little else. Here threads only append to a list: the first message of a
+batch schedules a drain, the ones that arrive before it runs are sent with it, and each client gets all of its
+messages in a single write, in the order they were queued.
+
+Messages are encoded once for all clients that use the same protocol (text lines or binary frames), by the thread
+that queues them.
+
+Clients that do not read fast enough (Twisted pauses them as producers) get a Backlog instead: only the latest
+state of each job is kept for them, intermediate progress is dropped.
+"""
+
+import itertools
+import json
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+from binary_protocol import encode_frame
+
+
+class Message:
+    """
+    A command and its param, encoded at most once for each protocol.
+    """
+
+    __slots__ = ("cmd", "param", "_line", "_frame")
+
+    def __init__(self, cmd: str, param=None):
+        self.cmd = cmd
+        self.param = param
+        self._line: Optional[bytes] = None
+        self._frame: Optional[bytes] = None
+
+    def encoded(self, binary: bool) -> bytes:
+        """
+        A frame, or a line without delimiter. Encoding twice at the same time from two threads is harmless.
+        """
+        if binary:
+            if self._frame is None:
+                self._frame = encode_frame(self.cmd, self.param)
+            return self._frame
+        if self._line is None:
+            line = self.cmd if self.param is None else f"{self.cmd} {json.dumps(self.param, separators=(',', ':'), indent=None)}"
+            self._line = line.encode("utf-8")
+        return self._line
+
+
+class OutboundQueue:
+    def __init__(self, call_from_thread: Callable):
+        self._call_from_thread = call_from_thread
+        self._lock = threading.Lock()
+        # (targets, message), targets must have a binary attribute and a send_messages method
+        self._pending: List[tuple] = []
+        self._scheduled = False
+        # When the oldest message in _pending was queued
+        self._oldest = 0.0
+        self._max_depth = 0
+        self._batches = 0
+        self._messages = 0
+        self._bytes = 0
+        self._last_latency = 0.0
+        self._max_latency = 0.0
+        self._total_latency = 0.0
+        self._slow_clients = 0
+        self._dropped = 0
+        self._disconnected = 0
+
+    def put(self, targets: list, message: Message):
+        """
+        Queue a message for some clients, from any thread. Never blocks on the reactor.
+        """
+        # Here and not in the reactor, which has enough to do
+        for binary in {target.binary for target in targets}:
+            message.encoded(binary)
+        with self._lock:
+            self._pending.append((targets, message))
+            self._max_depth = max(self._max_depth, len(self._pending))
+            if self._scheduled:
+                return
+            self._scheduled = True
+            self._oldest = time.monotonic()
+        self._call_from_thread(self._drain)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "depth": len(self._pending),
+                "max_depth": self._max_depth,
+                "batches": self._batches,
+                "messages": self._messages,
+                "bytes": self._bytes,
+                # Seconds from the first message of a batch to when the reactor sent it
+                "last_latency": self._last_latency,
+                "max_latency": self._max_latency,
+                "mean_latency": self._total_latency / self._batches if self._batches else 0.0,
+                # Clients that are not reading right now
+                "slow_clients": self._slow_clients,
+                # Queue updates for slow clients that were replaced by newer ones
+                "dropped": self._dropped,
+                # Slow clients that were behind for too long
+                "disconnected": self._disconnected,
+            }
+
+    def client_paused(self):
+        with self._lock:
+            self._slow_clients += 1
+
+    def client_resumed(self, dropped: int):
+        with self._lock:
+            self._slow_clients -= 1
+            self._dropped += dropped
+
+    def client_disconnected(self, dropped: int):
+        with self._lock:
+            self._slow_clients -= 1
+            self._dropped += dropped
+            self._disconnected += 1
+
+    def _drain(self):
+        # In the reactor thread
+        with self._lock:
+            pending = self._pending
+            self._pending = []
+            self._scheduled = False
+            latency = time.monotonic() - self._oldest
+            self._batches += 1
+            self._messages += len(pending)
+            self._bytes += sum(len(message.encoded(target.binary)) for targets, message in pending for target in targets)
+            self._last_latency = latency
+            self._max_latency = max(self._max_latency, latency)
+            self._total_latency += latency
+        # Dicts are ordered, so are the messages of each target
+        messages: Dict[object, List[Message]] = {}
+        for targets, message in pending:
+            for target in targets:
+                messages.setdefault(target, []).append(message)
+        for target, target_messages in messages.items():
+            target.send_messages(target_messages)
+
+
+class Backlog:
+    """
+    Messages for a client that is not reading, in order. queue_status updates of the same job are merged into the
+    first one, which works both for whole jobs and for changes only, and dropped if the job is removed.
+    """
+
+    def __init__(self):
+        # Job id or a counter -> a message, or the job so far
+        self._messages: Dict[object, object] = {}
+        self._counter = itertools.count()
+        self.dropped = 0
+
+    def __len__(self):
+        return len(self._messages)
+
+    def add(self, message: Message):
+        if message.cmd in ("queue_status", "remove") and isinstance(message.param, dict) and "id" in message.param:
+            key = ("job", message.param["id"])
+            held = self._messages.get(key)
+            if message.cmd == "remove":
+                if held is not None:
+                    del self._messages[key]
+                    self.dropped += 1
+            elif held is None:
+                self._messages[key] = message
+                return
+            else:
+                if isinstance(held, Message):
+                    # The param is shared with other clients, merge into a copy
+                    held = self._messages[key] = dict(held.param)
+                held.update(message.param)
+                self.dropped += 1
+                return
+        self._messages[next(self._counter)] = message
+
+    def messages(self) -> List[Message]:
+        return [held if isinstance(held, Message) else Message("queue_status", held) for held in self._messages.values()]
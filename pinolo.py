@@ -72,6 +72,8 @@ class PinoloMainWindow(QMainWindow, Ui_MainWindow):
 
         # Handlers
         self.dialogs = []
+        # Tarallo code -> state of its feature updates on the server
+        self.tarallo_outbox = {}
         self.select_system_dialog: SelectSystemDialog = None
 
         # Set icons
@@ -107,12 +109,26 @@ class PinoloMainWindow(QMainWindow, Ui_MainWindow):
         self.queueTableView.setItemDelegateForColumn(QUEUE_TABLE_PROGRESS, delegate)
         delegate = QueueStatusIconDelegate(self.queueTableView)
         self.queueTableView.setItemDelegateForColumn(QUEUE_TABLE_STATUS, delegate)
-        self.queueTableView.addActions([self.actionStop, self.actionRemove, self.actionRemove_All, self.actionRemove_completed, self.actionRemove_Queued])
+        self.queueTableView.addActions(
+            [
+                self.actionStop,
+                self.actionRemove,
+                self.actionRemove_All,
+                self.actionRemove_completed,
+                self.actionRemove_Queued,
+                self.actionMove_to_Front,
+                self.actionMove_Up,
+                self.actionMove_Down,
+            ]
+        )
         self.actionStop.triggered.connect(self.queue_stop)
         self.actionRemove.triggered.connect(self.queue_remove)
         self.actionRemove_All.triggered.connect(self.queue_clear)
         self.actionRemove_completed.triggered.connect(self.queue_clear_completed)
         self.actionRemove_Queued.triggered.connect(self.queue_clear_queued)
+        self.actionMove_to_Front.triggered.connect(lambda: self.queue_move("first"))
+        self.actionMove_Up.triggered.connect(lambda: self.queue_move("up"))
+        self.actionMove_Down.triggered.connect(lambda: self.queue_move("down"))
 
         # Buttons
         self.standardProcedureButton.clicked.connect(self.standard_procedure)
@@ -231,6 +247,14 @@ class PinoloMainWindow(QMainWindow, Ui_MainWindow):
             self.send_command(f"remove {pid}")
         self.queueTableViewModel.remove_row(rows)
 
+    def queue_move(self, where: str):
+        """This function set the "move" buttons behaviour on the queue table
+        context menu. Jobs only move within the queue of their drive, running ones stay where they are."""
+        rows = self.queueTableView.selectionModel().selectedRows()
+        for index in rows:
+            pid = self.queueTableViewModel.get_pid(index)
+            self.send_command(f"move {pid} {where}")
+
     def queue_clear(self):
         """This function set the "remove all" button behaviour on the queue table
         context menu."""
@@ -262,6 +286,7 @@ class PinoloMainWindow(QMainWindow, Ui_MainWindow):
 
         drives = self.drivesTableViewModel.get_selected_drives(rows)
 
+        to_upload = []
         for drive in drives:
             if not standard_procedure:
                 if drive.tarallo_id is not None:
@@ -274,14 +299,19 @@ class PinoloMainWindow(QMainWindow, Ui_MainWindow):
             else:
                 if drive.tarallo_id != "":
                     continue
+            to_upload.append(drive.name)
 
-            location, ok = tarallo_location_dialog(f"Please, set the Tarallo location of drive {drive.name}.\n" f"Leave blank to avoid upload to Tarallo")
+        if len(to_upload) == 0:
+            return
+        drive_names = f"drive {to_upload[0]}" if len(to_upload) == 1 else f"drives {', '.join(to_upload)}"
+        location, ok = tarallo_location_dialog(f"Please, set the Tarallo location of {drive_names}.\n" f"Leave blank to avoid upload to Tarallo")
 
-            # If no location is provided or cancel is selected, stop the operation
-            if not ok or location is None or location == "":
-                continue
+        # If no location is provided or cancel is selected, stop the operation
+        if not ok or location is None or location == "":
+            return
 
-            self.send_command(f"queued_upload_to_tarallo {drive.name} {location}")
+        # All of them at once, the server uploads them in parallel
+        self.send_command(f"upload_to_tarallo_bulk {location} {' '.join(to_upload)}")
 
     def sleep(self):
         """This function send to the server a queued_sleep command.
@@ -367,9 +397,13 @@ class PinoloMainWindow(QMainWindow, Ui_MainWindow):
             # TODO: check if this works properly
             if drive.smart_data is None:
                 continue
-            smart_dialog = SmartDialog(self, drive.name, drive.smart_data)
-            smart_dialog.close_signal.connect(self._remove_dialog_handler)
-            self.dialogs.append(smart_dialog)
+            # Only the summary comes with smartctl, the dialog opens when the rest arrives
+            self.send_command(f"smartctl_detail {drive.name}")
+
+    def open_smart_dialog(self, smart_detail: dict):
+        smart_dialog = SmartDialog(self, smart_detail["disk"], smart_detail)
+        smart_dialog.close_signal.connect(self._remove_dialog_handler)
+        self.dialogs.append(smart_dialog)
 
     # BUTTONS CALLBACKS
     def refresh(self):
@@ -417,6 +451,11 @@ class PinoloMainWindow(QMainWindow, Ui_MainWindow):
             if critical_dialog(message, dialog_type="yes_no") != QMessageBox.Yes:
                 return
         for drive in drives:
+            if drive.erase_checkpoint is not None:
+                message = f"The erase of {drive.name} stopped at {drive.erase_checkpoint:.1f}%.\nDo you want to resume it from there?"
+                if warning_dialog(message, dialog_type="yes_no") == QMessageBox.Yes:
+                    self.send_command(f"queued_badblocks {drive.name} resume")
+                    continue
             self.send_command(f"queued_badblocks {drive.name}")
 
     def smart_check(self):
@@ -477,6 +516,19 @@ class PinoloMainWindow(QMainWindow, Ui_MainWindow):
     def _clear_tables(self):
         self.drivesTableViewModel.clear()
         self.queueTableViewModel.clear()
+        self.tarallo_outbox.clear()
+
+    def _update_tarallo_outbox(self, entries: list):
+        for entry in entries:
+            self.tarallo_outbox[entry["code"]] = entry
+        pending = [code for code, entry in self.tarallo_outbox.items() if entry["state"] == "pending"]
+        failed = [code for code, entry in self.tarallo_outbox.items() if entry["state"] == "failed"]
+        if failed:
+            self.statusbar.showMessage(f"⚠ Tarallo update failed for {', '.join(failed)}, {len(pending)} pending")
+        elif pending:
+            self.statusbar.showMessage(f"{len(pending)} Tarallo updates pending")
+        elif entries:
+            self.statusbar.showMessage("Tarallo is up to date")
 
     def _decorate_disk(self, item: QTableWidgetItem, something_in_progress: bool):
         if something_in_progress:
@@ -496,8 +548,8 @@ class PinoloMainWindow(QMainWindow, Ui_MainWindow):
     def _remove_dialog_handler(self, dialog: QDialog):
         self.dialogs.remove(dialog)
 
-    @pyqtSlot(str, str)
-    def gui_update(self, command: str, command_data: str):
+    @pyqtSlot(str, object)
+    def gui_update(self, command: str, command_data: Union[str, dict, list]):
         """
         This function gets all the server responses and update, if possible, the UI.
 
@@ -508,7 +560,8 @@ class PinoloMainWindow(QMainWindow, Ui_MainWindow):
             queue_status --> Information about badblocks process
 
         """
-        if len(command_data) > 0:
+        # Binary frames are already decoded
+        if isinstance(command_data, str) and len(command_data) > 0:
             try:
                 command_data = json.loads(command_data)
                 command_data: Union[dict, list]
@@ -533,9 +586,20 @@ class PinoloMainWindow(QMainWindow, Ui_MainWindow):
                 else:
                     self.drivesTableViewModel.load_data(command_data)
 
+            case "disk_added":
+                self.drivesTableViewModel.add_drive(command_data)
+
+            case "disk_removed":
+                self.drivesTableViewModel.remove_drive(command_data["path"])
+
+            case "disk_changed":
+                self.drivesTableViewModel.change_drive(command_data)
+
             case "smartctl" | "queued_smartctl":
                 self.drivesTableViewModel.store_smart_data(command_data)
-                # self.smart_results[command_data["disk"]] = {"output": command_data["output"], "status": command_data["status"]}
+
+            case "smartctl_detail":
+                self.open_smart_dialog(command_data)
 
             case "connection_failed":
                 self.statusbar.showMessage(f"⚠ Connection failed. Check settings and try to reconnect.")
@@ -549,11 +613,17 @@ class PinoloMainWindow(QMainWindow, Ui_MainWindow):
             case "connection_made":
                 self.statusbar.showMessage(f"Connected to {command_data['host']}:{command_data['port']}")
                 self.connection_factory.protocol_instance.send_msg("get_disks")
+                # Only what changed in each job from now on, update merges it
+                self.connection_factory.protocol_instance.send_msg("queue_deltas")
                 self.connection_factory.protocol_instance.send_msg("get_queue")
+                self.connection_factory.protocol_instance.send_msg("tarallo_outbox")
 
             case "list_iso":
                 self.select_system_dialog.load_images(command_data)
 
+            case "tarallo_outbox":
+                self._update_tarallo_outbox(command_data)
+
             case "error":
                 message = f"{command_data['message']}"
                 if "command" in command_data:
@@ -591,6 +661,9 @@ class Job:
         self.type = self._format_process_type(command_data["command"])
         self.status = self._parse_status(command_data)
         self.progress: float = command_data["percentage"]
+        # Place in the queue of the drive (0 is running or next) and priority, older servers do not send them
+        self.position = command_data.get("position")
+        self.priority = command_data.get("priority")
 
         self.status_icon = None
 
@@ -598,11 +671,22 @@ class Job:
         self.eta = None
         self.start_time = time.time()
 
+        # Everything the server sent so far, updates may have only the fields that changed
+        self.data = dict(command_data)
+
     def update(self, command_data: dict):
-        self.status = self._parse_status(command_data)
-        self.progress = command_data["percentage"]
+        self.data.update(command_data)
+        self.status = self._parse_status(self.data)
+        self.progress = self.data["percentage"]
+        self.position = self.data.get("position")
+        self.priority = self.data.get("priority")
         self._update_eta()
 
+    def describe(self) -> str:
+        if self.status != "pending" or self.position is None:
+            return self.type
+        return f"{self.type} (#{self.position}, {self.priority})"
+
     def _update_eta(self):
         elapsed_time = time.time() - self.start_time
         if 0 < self.progress < 100:
@@ -674,7 +758,7 @@ class QueueTableModel(QAbstractTableModel):
                     case "Drive":
                         return job.drive
                     case "Process":
-                        return job.type
+                        return job.describe()
                     case "Status":
                         return job.status
                     case "Eta":
@@ -696,6 +780,9 @@ class QueueTableModel(QAbstractTableModel):
 
         # create row if job does not exist
         if found_job_idx is None:
+            if "target" not in command_data:
+                # Changes to a job that was removed here, nothing to apply them to
+                return
             new_job = Job(command_data)
             self._insert_row(new_job)
 
@@ -824,12 +911,15 @@ class Drive:
         self.smart_data = None
         self.status = "warning" if self.mounted else None
         self.tarallo_id = drive_data["code"]
+        # Percentage where the last erase stopped, None if there is nothing to resume
+        self.erase_checkpoint = drive_data.get("erase_checkpoint")
 
     def update(self, drive_data: dict):
         self.mounted = True if drive_data["mountpoint"] else False
         self.mountpoints = drive_data["mountpoint"] if self.mounted else None
         self.status = "warning" if self.mounted else None
         self.tarallo_id = drive_data["code"]
+        self.erase_checkpoint = drive_data.get("erase_checkpoint")
 
 
 class DrivesTableModel(QAbstractTableModel):
@@ -890,6 +980,30 @@ class DrivesTableModel(QAbstractTableModel):
                     drive.update(drive_data)
                     continue
 
+    def add_drive(self, drive_data: dict):
+        # The server may send it again after a reconnection
+        self.remove_drive(drive_data["path"])
+        self.beginInsertRows(QModelIndex(), len(self.drives), len(self.drives))
+        self.drives.append(Drive(drive_data))
+        self.endInsertRows()
+        self._resize_columns()
+
+    def remove_drive(self, path: str):
+        for row, drive in enumerate(self.drives):
+            if drive.name == path:
+                self.beginRemoveRows(QModelIndex(), row, row)
+                del self.drives[row]
+                self.endRemoveRows()
+                return
+
+    def change_drive(self, drive_data: dict):
+        for row, drive in enumerate(self.drives):
+            if drive.name == drive_data["path"]:
+                drive.update(drive_data)
+                self.dataChanged.emit(self.index(row, 0), self.index(row, self.columnCount() - 1))
+                return
+        self.add_drive(drive_data)
+
     def get_selected_drives(self, rows: List[QModelIndex]) -> List[Drive]:
         if rows is None:
             return None
@@ -901,7 +1015,7 @@ class DrivesTableModel(QAbstractTableModel):
     def store_smart_data(self, command_data: dict):
         for drive in self.drives:
             if drive.name == command_data["disk"]:
-                drive.smart_data = {"output": command_data["output"], "status": command_data["status"]}
+                drive.smart_data = {key: command_data[key] for key in ("status", "failing_now", "attributes")}
 
     def _resize_columns(self):
         for column in range(3):
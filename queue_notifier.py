@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+"""
+Queue updates for clients, coalesced: the latest state of each job is kept and sent at most once per interval.
+
+Progress ticks arrive many times per second per disk, and clients only need to see the last one. Everything else
+(a job is queued, starts, finishes, fails, stops, moves) is sent at once, together with any progress that was
+waiting, so clients never miss the final state of a job and see every job in the order it changed.
+
+Clients that ask for it get only the fields that changed since the last update they received, plus the id. The
+others get the whole job every time, as before.
+"""
+
+import logging
+import threading
+from typing import Optional, Callable, Dict, List, Iterable
+
+# Called with (clients, command, param), param is encoded once for all of them
+SendFunction = Callable[[List[int], str, object], None]
+
+
+class QueueNotifier:
+    def __init__(self, send: SendFunction, clients: Callable[[], List[int]], interval: float = 0.5):
+        self._send = send
+        self._clients = clients
+        # 0 sends every update at once
+        self._interval = interval
+        self._lock = threading.Lock()
+        # Job id -> what it looks like now
+        self._latest: Dict[str, dict] = {}
+        # Job ids with updates that have not been sent, in the order they changed (dicts are ordered, sets are not)
+        self._dirty: Dict[str, None] = {}
+        # Client -> job id -> what the client has, only for clients that receive the changes alone
+        self._sent: Dict[int, Dict[str, dict]] = {}
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        if self._interval > 0:
+            self._thread = threading.Thread(target=self._flush_forever, name="queue-notifier", daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        self.flush()
+
+    def update(self, state: dict, now: bool = False):
+        """
+        A job has changed, state is all of it and must not be modified afterwards. now sends it (and anything
+        still waiting for that job) right away.
+        """
+        job_id = state["id"]
+        with self._lock:
+            self._latest[job_id] = state
+            if now or self._interval <= 0:
+                self._dirty.pop(job_id, None)
+                self._flush_job(job_id)
+                return
+            self._dirty[job_id] = None
+        self._wake.set()
+
+    def remove(self, job_id: str):
+        """
+        The job is gone, clients are told to remove it and pending updates are dropped.
+        """
+        with self._lock:
+            self._forget(job_id)
+            self._send(self._clients(), "remove", {"id": job_id})
+
+    def forget(self, job_id: str):
+        """
+        Like remove, but clients have already removed the job on their own.
+        """
+        with self._lock:
+            self._forget(job_id)
+
+    def send_queue(self, client: int, cmd: str, job_ids: Iterable[str]):
+        """
+        Send these jobs to a client as a list, whole: from now on it receives only the changes, if it asked for them.
+        """
+        with self._lock:
+            param = [self._latest[job_id] for job_id in job_ids if job_id in self._latest]
+            self._send([client], cmd, param)
+            sent = self._sent.get(client)
+            if sent is not None:
+                for state in param:
+                    sent[state["id"]] = state
+
+    def send_changes_only(self, client: int, enabled: bool = True):
+        with self._lock:
+            if not enabled:
+                self._sent.pop(client, None)
+            elif client not in self._sent:
+                # Each job is sent whole the first time
+                self._sent[client] = {}
+
+    def client_gone(self, client: int):
+        with self._lock:
+            self._sent.pop(client, None)
+
+    def flush(self):
+        with self._lock:
+            dirty = self._dirty
+            self._dirty = {}
+            for job_id in dirty:
+                self._flush_job(job_id)
+
+    def _flush_forever(self):
+        while not self._stopping.is_set():
+            self._wake.wait()
+            self._wake.clear()
+            # Let more updates pile up, unless it is time to stop
+            self._stopping.wait(self._interval)
+            # noinspection PyBroadException
+            try:
+                self.flush()
+            except BaseException as e:
+                logging.error("Exception while sending queue updates", exc_info=e)
+
+    def _flush_job(self, job_id: str):
+        # Called with the lock held: updates leave in the same order as they were flushed
+        state = self._latest.get(job_id)
+        if state is None:
+            return
+        whole = []
+        # Clients that have the same state of the job get the same changes: id of that state -> (it, clients)
+        changes: Dict[int, tuple] = {}
+        for client in self._clients():
+            sent = self._sent.get(client)
+            before = None if sent is None else sent.get(job_id)
+            if sent is not None:
+                sent[job_id] = state
+            if before is None:
+                whole.append(client)
+            elif before is not state:
+                changes.setdefault(id(before), (before, []))[1].append(client)
+        if whole:
+            self._send(whole, "queue_status", state)
+        for before, clients in changes.values():
+            param = {key: value for key, value in state.items() if before.get(key) != value}
+            if param:
+                param["id"] = state["id"]
+                self._send(clients, "queue_status", param)
+
+    def _forget(self, job_id: str):
+        self._latest.pop(job_id, None)
+        self._dirty.pop(job_id, None)
+        for sent in self._sent.values():
+            sent.pop(job_id, None)
@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+"""
+List disks by reading /sys and /proc directly: the same records that get_disks_linux builds from lsblk, without a
+fork and exec every time.
+
+Like lsblk, model, serial, WWN and partition types come from the udev database when it has them, and from sysfs
+otherwise.
+"""
+
+import os
+import re
+import struct
+from typing import Optional, Dict, List
+
+# Loop devices, software RAID, CD/DVD drives and network block devices, same as "lsblk --exclude 7,9,11,43"
+# See: https://www.kernel.org/doc/Documentation/admin-guide/devices.txt
+EXCLUDED_MAJORS = {7, 9, 11, 43}
+SYS_BLOCK = "/sys/block"
+SYS_CLASS_BLOCK = "/sys/class/block"
+UDEV_DATA = "/run/udev/data"
+MOUNTINFO = "/proc/self/mountinfo"
+SWAPS = "/proc/swaps"
+SECTOR_SIZE = 512
+
+
+def get_disks_sysfs(path: Optional[str] = None) -> list:
+    """
+    Every disk (or only the one at path) with path, vendor, model, serial, wwn, hotplug, rota, size, partitions,
+    mountpoint_map and mountpoint, like get_disks_linux. Empty disks (e.g. card readers without a card) are skipped.
+    """
+    if path:
+        names = [os.path.basename(os.path.realpath(path))]
+    else:
+        try:
+            names = sorted(os.listdir(SYS_BLOCK))
+        except OSError:
+            return []
+    mounts = read_mounts()
+
+    result = []
+    for name in names:
+        sysfs = f"{SYS_BLOCK}/{name}"
+        devno = _read(f"{sysfs}/dev")
+        if devno is None or int(devno.split(":")[0]) in EXCLUDED_MAJORS:
+            continue
+        if _is_mapped(sysfs):
+            # LVM volumes, LUKS containers and the like: lsblk only shows them under the disks they are on
+            continue
+        size = _read_int(f"{sysfs}/size") * SECTOR_SIZE
+        if size == 0:
+            continue
+        udev = read_udev_properties(devno)
+
+        mountpoint_map = {}
+        _find_mounts(sysfs, name, devno, mounts, mountpoint_map)
+        partitions = _partitions(sysfs, name, mounts)
+        if any(partition["parttype"] is None for partition in partitions):
+            table = partition_types_from_table(f"/dev/{name}")
+            for partition in partitions:
+                if partition["parttype"] is None:
+                    partition["parttype"] = table.get(partition["partn"])
+
+        result.append(
+            {
+                "path": f"/dev/{name}",
+                "vendor": _read(f"{sysfs}/device/vendor") or None,
+                "model": _udev_string(udev, "ID_MODEL_ENC", "ID_MODEL") or _read(f"{sysfs}/device/model") or None,
+                "serial": udev.get("ID_SCSI_SERIAL") or udev.get("ID_SERIAL_SHORT") or _read(f"{sysfs}/device/serial") or None,
+                "wwn": udev.get("ID_WWN_WITH_EXTENSION") or udev.get("ID_WWN") or _read(f"{sysfs}/device/wwid") or _read(f"{sysfs}/wwid") or None,
+                "hotplug": is_hotplug(sysfs),
+                "rota": _read(f"{sysfs}/queue/rotational") == "1",
+                # List of filesystem directories
+                "mountpoint": list(mountpoint_map.values()),
+                "size": size,
+                "partitions": partitions,
+                # List of partition names (/dev/sda1) to filesystem directories
+                "mountpoint_map": mountpoint_map,
+            }
+        )
+    return result
+
+
+def read_mounts() -> Dict[str, str]:
+    """
+    "major:minor" to where it is mounted, "[SWAP]" for swap, like the MOUNTPOINT column of lsblk.
+    """
+    mounts = {}
+    try:
+        with open(MOUNTINFO, "r") as f:
+            for line in f:
+                fields = line.split(" ", 5)
+                # The first mount wins, as in lsblk
+                mounts.setdefault(fields[2], _unescape_mountinfo(fields[4]))
+    except OSError:
+        pass
+    try:
+        with open(SWAPS, "r") as f:
+            for line in f.readlines()[1:]:
+                try:
+                    rdev = os.stat(_unescape_mountinfo(line.split()[0])).st_rdev
+                except (OSError, IndexError):
+                    continue
+                mounts[f"{os.major(rdev)}:{os.minor(rdev)}"] = "[SWAP]"
+    except OSError:
+        pass
+    return mounts
+
+
+def read_udev_properties(devno: str) -> Dict[str, str]:
+    properties = {}
+    try:
+        with open(f"{UDEV_DATA}/b{devno}", "r", errors="replace") as f:
+            for line in f:
+                if line.startswith("E:"):
+                    key, _, value = line[2:].rstrip("\n").partition("=")
+                    properties[key] = value
+    except OSError:
+        pass
+    return properties
+
+
+def is_hotplug(sysfs: str) -> bool:
+    """
+    Same logic as lsblk: removable media, or a device somewhere up the chain that the kernel says is removable
+    (e.g. the USB port a bridge is plugged in).
+    """
+    if _read(f"{sysfs}/removable") == "1":
+        return True
+    device = os.path.realpath(f"{sysfs}/device")
+    while device.startswith("/sys/devices/"):
+        removable = _read(f"{device}/removable")
+        if removable == "removable":
+            return True
+        if removable == "fixed":
+            return False
+        device = os.path.dirname(device)
+    return False
+
+
+def partition_types_from_table(dev: str) -> Dict[int, str]:
+    """
+    Partition number to type ("0x83" for MBR, lowercase GUID for GPT) from the partition table on the disk, for
+    when udev does not know yet (e.g. right after cannolo). Logical MBR partitions are not looked into.
+    """
+    try:
+        with open(dev, "rb") as f:
+            mbr = f.read(SECTOR_SIZE)
+            if len(mbr) < SECTOR_SIZE or mbr[510:512] != b"\x55\xaa":
+                return {}
+            types = {}
+            for i in range(4):
+                part_type = mbr[446 + i * 16 + 4]
+                if part_type == 0xEE:
+                    return _gpt_partition_types(f)
+                if part_type != 0:
+                    types[i + 1] = f"0x{part_type:x}"
+            return types
+    except OSError:
+        return {}
+
+
+def _gpt_partition_types(f) -> Dict[int, str]:
+    f.seek(SECTOR_SIZE)
+    header = f.read(92)
+    if header[0:8] != b"EFI PART":
+        return {}
+    entries_lba, entries_count, entry_size = struct.unpack_from("<QII", header, 72)
+    f.seek(entries_lba * SECTOR_SIZE)
+    table = f.read(entries_count * entry_size)
+    types = {}
+    for i in range(entries_count):
+        guid = table[i * entry_size : i * entry_size + 16]
+        if len(guid) < 16 or guid == bytes(16):
+            continue
+        # The first three fields are little endian
+        a, b, c = struct.unpack_from("<IHH", guid)
+        types[i + 1] = f"{a:08x}-{b:04x}-{c:04x}-{guid[8:10].hex()}-{guid[10:16].hex()}"
+    return types
+
+
+def read_partition_number(name: str) -> Optional[int]:
+    """
+    Number of a partition (e.g. 2 for sda2 or nvme0n1p2), None if it is not a partition.
+    """
+    partn = _read(f"{SYS_CLASS_BLOCK}/{name}/partition")
+    return int(partn) if partn else None
+
+
+def _partitions(sysfs: str, name: str, mounts: Dict[str, str]) -> List[dict]:
+    partitions = []
+    for child in os.listdir(sysfs):
+        if not child.startswith(name):
+            continue
+        partn = read_partition_number(child)
+        if partn is None:
+            continue
+        devno = _read(f"{sysfs}/{child}/dev")
+        udev = read_udev_properties(devno)
+        partitions.append(
+            {
+                "path": f"/dev/{child}",
+                "partn": partn,
+                "parttype": udev.get("ID_PART_ENTRY_TYPE"),
+                "size": _read_int(f"{sysfs}/{child}/size") * SECTOR_SIZE,
+                "mountpoint": mounts.get(devno),
+            }
+        )
+    return sorted(partitions, key=lambda partition: partition["partn"])
+
+
+def _find_mounts(sysfs: str, name: str, devno: str, mounts: Dict[str, str], mountpoint_map: Dict[str, str]):
+    """
+    Mounts of a device, its partitions and whatever is stacked on them (LVM, dm-crypt), like find_mounts with lsblk.
+    """
+    if devno in mounts:
+        mountpoint_map[_device_path(name)] = mounts[devno]
+    for child in os.listdir(sysfs):
+        if child.startswith(name) and os.path.isfile(f"{sysfs}/{child}/partition"):
+            _find_mounts(f"{sysfs}/{child}", child, _read(f"{sysfs}/{child}/dev"), mounts, mountpoint_map)
+    try:
+        holders = os.listdir(f"{sysfs}/holders")
+    except OSError:
+        holders = []
+    for holder in holders:
+        holder_sysfs = f"{SYS_CLASS_BLOCK}/{holder}"
+        _find_mounts(holder_sysfs, holder, _read(f"{holder_sysfs}/dev"), mounts, mountpoint_map)
+
+
+def _is_mapped(sysfs: str) -> bool:
+    # Built on top of other block devices, e.g. by device mapper or md
+    try:
+        return len(os.listdir(f"{sysfs}/slaves")) > 0
+    except OSError:
+        return False
+
+
+def _device_path(name: str) -> str:
+    dm_name = _read(f"{SYS_CLASS_BLOCK}/{name}/dm/name")
+    return f"/dev/mapper/{dm_name}" if dm_name else f"/dev/{name}"
+
+
+def _udev_string(udev: Dict[str, str], encoded: str, plain: str) -> Optional[str]:
+    # *_ENC values have spaces and other characters as \x20, the plain ones have them replaced by underscores
+    if encoded in udev:
+        return re.sub(r"\\x([0-9a-fA-F]{2})", lambda m: chr(int(m.group(1), 16)), udev[encoded]).strip() or None
+    return udev.get(plain) or None
+
+
+def _unescape_mountinfo(path: str) -> str:
+    # Spaces, tabs, newlines and backslashes are octal escapes, e.g. \040
+    return re.sub(r"\\([0-7]{3})", lambda m: chr(int(m.group(1), 8)), path)
+
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path, "r") as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def _read_int(path: str) -> int:
+    value = _read(path)
+    return int(value) if value else 0
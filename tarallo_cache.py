@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+"""
+Serial number to Tarallo code lookups, cached and done in the background.
+
+Results are kept for a while (not found for less time than found) and saved to a JSON file, so restarting the
+server does not mean asking Tarallo about every disk again. Misses are looked up by a pool of threads, each with its
+own Tarallo session: pytarallo is not thread safe, and a session per thread keeps its connection alive.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Callable, Dict, List
+
+from pytarallo import Tarallo
+
+# Called with (codes, None) or (None, exception)
+LookupCallback = Callable[[Optional[List[str]], Optional[BaseException]], None]
+
+
+class CodeLookup:
+    """
+    Serial number to codes, from the cache or from Tarallo in the background.
+    """
+
+    def __init__(self, url: str, token: str, store_path: Optional[str], ttl: float, negative_ttl: float, workers: int):
+        self._url = url
+        self._token = token
+        self._store_path = store_path
+        self._ttl = ttl
+        self._negative_ttl = negative_ttl
+        self._lock = threading.Lock()
+        # Serial -> {"codes": [...], "time": epoch}
+        self._cache: Dict[str, dict] = {}
+        # Serial -> callbacks waiting for a lookup that is already running
+        self._waiting: Dict[str, List[LookupCallback]] = {}
+        self._local = threading.local()
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tarallo-lookup")
+        self._load()
+
+    def get(self, serial: str, callback: LookupCallback, refresh: bool = False) -> Optional[List[str]]:
+        """
+        Codes of the items with that serial number, if the cache has a fresh answer. Otherwise returns None and
+        callback is called from another thread when Tarallo answers. refresh skips the cache.
+        """
+        with self._lock:
+            if not refresh:
+                entry = self._cache.get(serial)
+                if entry is not None:
+                    ttl = self._ttl if entry["codes"] else self._negative_ttl
+                    if time.time() - entry["time"] < ttl:
+                        return entry["codes"]
+            if serial in self._waiting:
+                self._waiting[serial].append(callback)
+                return None
+            self._waiting[serial] = [callback]
+        self._pool.submit(self._lookup, serial)
+        return None
+
+    def remember(self, serial: str, codes: List[str]):
+        """
+        For items created by us, so that a "not found" in the cache does not hide them.
+        """
+        with self._lock:
+            self._cache[serial] = {"codes": codes, "time": time.time()}
+        self._save()
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def _tarallo(self) -> Tarallo.Tarallo:
+        tarallo = getattr(self._local, "tarallo", None)
+        if tarallo is None:
+            tarallo = self._local.tarallo = Tarallo.Tarallo(self._url, self._token)
+        return tarallo
+
+    def _lookup(self, serial: str):
+        codes = None
+        error = None
+        # noinspection PyBroadException
+        try:
+            codes = self._tarallo().get_codes_by_feature("sn", serial)
+        except BaseException as e:
+            # Not cached, the next request tries again
+            error = e
+        with self._lock:
+            if error is None:
+                self._cache[serial] = {"codes": codes, "time": time.time()}
+            callbacks = self._waiting.pop(serial, [])
+        if error is None:
+            self._save()
+        for callback in callbacks:
+            # noinspection PyBroadException
+            try:
+                callback(codes, error)
+            except BaseException as e:
+                logging.warning(f"Exception while handling the Tarallo lookup of {serial}", exc_info=e)
+
+    def _load(self):
+        if not self._store_path:
+            return
+        try:
+            with open(self._store_path, "r") as f:
+                self._cache = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring Tarallo cache {self._store_path}: {e}")
+
+    def _save(self):
+        if not self._store_path:
+            return
+        with self._lock:
+            temporary = f"{self._store_path}.tmp"
+            try:
+                os.makedirs(os.path.dirname(self._store_path), exist_ok=True)
+                with open(temporary, "w") as f:
+                    json.dump(self._cache, f)
+                os.replace(temporary, self._store_path)
+            except OSError as e:
+                logging.warning(f"Cannot save Tarallo cache to {self._store_path}: {e}")
@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""
+Feature updates for Tarallo, written to a SQLite database first and sent later by a background thread.
+
+Jobs do not wait for Tarallo and do not fail when it is down: updates stay in the database, survive restarts and are
+retried with exponential backoff. Updates to the same item are merged and sent in a single request.
+
+Each item is in one of these states:
+
+- pending: waiting to be sent, or to be retried after an error
+- flushed: sent
+- failed: Tarallo refused it (e.g. the item does not exist), it will not be retried
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Optional, Callable, List
+
+from pytarallo import Tarallo
+from pytarallo.Errors import ValidationError, ItemNotFoundError
+
+PENDING = "pending"
+FLUSHED = "flushed"
+FAILED = "failed"
+# Errors that will not go away by trying again
+PERMANENT_ERRORS = (ValidationError, ItemNotFoundError)
+# Sent updates are kept this long, so clients can see them
+KEEP_FLUSHED = 24 * 60 * 60
+
+
+class TaralloOutbox:
+    def __init__(
+        self,
+        url: str,
+        token: str,
+        db_path: str,
+        on_change: Optional[Callable[[dict], None]] = None,
+        min_backoff: float = 5.0,
+        max_backoff: float = 600.0,
+    ):
+        self._tarallo = Tarallo.Tarallo(url, token)
+        self._on_change = on_change
+        self._min_backoff = min_backoff
+        self._max_backoff = max_backoff
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._go = True
+        self._thread: Optional[threading.Thread] = None
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        with self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "code TEXT PRIMARY KEY, "
+                "features TEXT NOT NULL, "
+                "state TEXT NOT NULL, "
+                # Incremented by every enqueue, to tell if something arrived while sending
+                "version INTEGER NOT NULL, "
+                "attempts INTEGER NOT NULL, "
+                "next_attempt REAL NOT NULL, "
+                "last_error TEXT, "
+                "updated REAL NOT NULL)"
+            )
+
+    def start(self):
+        self._thread = threading.Thread(target=self._send_forever, name="tarallo-outbox", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._go = False
+        self._wake.set()
+        if self._thread:
+            self._thread.join()
+        self._db.close()
+
+    def enqueue(self, code: str, features: dict):
+        """
+        Features are merged with those of the same item that have not been sent yet, newer values win.
+        """
+        now = time.time()
+        with self._lock, self._db:
+            row = self._db.execute("SELECT features, state, version FROM outbox WHERE code = ?", (code,)).fetchone()
+            if row is None:
+                version = 1
+            else:
+                version = row["version"] + 1
+                if row["state"] == PENDING:
+                    features = {**json.loads(row["features"]), **features}
+            self._db.execute(
+                "INSERT OR REPLACE INTO outbox (code, features, state, version, attempts, next_attempt, last_error, updated) "
+                "VALUES (?, ?, ?, ?, 0, ?, NULL, ?)",
+                (code, json.dumps(features), PENDING, version, now, now),
+            )
+            entry = self._entry(code)
+        logging.debug(f"Queued update of {code} on tarallo: {features}")
+        self._notify(entry)
+        self._wake.set()
+
+    def entries(self) -> List[dict]:
+        with self._lock:
+            rows = self._db.execute("SELECT * FROM outbox ORDER BY updated").fetchall()
+        return [self._serialize(row) for row in rows]
+
+    def _send_forever(self):
+        while self._go:
+            self._wake.clear()
+            now = time.time()
+            with self._lock, self._db:
+                self._db.execute("DELETE FROM outbox WHERE state = ? AND updated < ?", (FLUSHED, now - KEEP_FLUSHED))
+                due = self._db.execute(
+                    "SELECT code, features, version, attempts FROM outbox WHERE state = ? AND next_attempt <= ? ORDER BY next_attempt", (PENDING, now)
+                ).fetchall()
+                later = self._db.execute("SELECT MIN(next_attempt) FROM outbox WHERE state = ?", (PENDING,)).fetchone()[0]
+            for row in due:
+                if not self._go:
+                    return
+                self._send(row["code"], json.loads(row["features"]), row["version"], row["attempts"])
+            if not due:
+                self._wake.wait(None if later is None else max(later - time.time(), 0))
+
+    def _send(self, code: str, features: dict, version: int, attempts: int):
+        error = None
+        state = FLUSHED
+        # noinspection PyBroadException
+        try:
+            if not self._tarallo.update_item_features(code, features):
+                raise RuntimeError(f"Unexpected response from tarallo: HTTP {self._tarallo.response.status_code}")
+        except PERMANENT_ERRORS as e:
+            error = e
+            state = FAILED
+        except BaseException as e:
+            error = e
+            state = PENDING
+
+        now = time.time()
+        # Some pytarallo exceptions have no message
+        message = None if error is None else str(error) or type(error).__name__
+        if state == PENDING:
+            backoff = min(self._min_backoff * 2**attempts, self._max_backoff)
+            logging.warning(f"Updating {code} on tarallo failed, retrying in {backoff:.0f} s: {message}")
+        elif state == FAILED:
+            logging.warning(f"Updating {code} on tarallo failed, giving up: {message}")
+        else:
+            backoff = 0
+            logging.debug(f"Updated {code} on tarallo: {features}")
+        with self._lock, self._db:
+            # If more features arrived in the meantime they are still pending, and they include these
+            current = self._db.execute("SELECT version FROM outbox WHERE code = ?", (code,)).fetchone()
+            if current is None or current["version"] != version:
+                return
+            if state == PENDING:
+                self._db.execute(
+                    "UPDATE outbox SET attempts = ?, next_attempt = ?, last_error = ?, updated = ? WHERE code = ?",
+                    (attempts + 1, now + backoff, message, now, code),
+                )
+            else:
+                self._db.execute(
+                    "UPDATE outbox SET state = ?, attempts = ?, last_error = ?, updated = ? WHERE code = ?",
+                    (state, attempts + 1, message, now, code),
+                )
+            entry = self._entry(code)
+        self._notify(entry)
+
+    def _entry(self, code: str) -> dict:
+        return self._serialize(self._db.execute("SELECT * FROM outbox WHERE code = ?", (code,)).fetchone())
+
+    @staticmethod
+    def _serialize(row: sqlite3.Row) -> dict:
+        return {
+            "code": row["code"],
+            "features": json.loads(row["features"]),
+            "state": row["state"],
+            "attempts": row["attempts"],
+            "last_error": row["last_error"],
+            "updated": row["updated"],
+        }
+
+    def _notify(self, entry: dict):
+        if self._on_change:
+            # noinspection PyBroadException
+            try:
+                self._on_change(entry)
+            except BaseException as e:
+                logging.warning("Exception while notifying a tarallo outbox change", exc_info=e)
@@ -196,6 +196,18 @@ class Ui_MainWindow(object):
         icon = QtGui.QIcon.fromTheme("document-open-recent")
         self.actionRemove_Queued.setIcon(icon)
         self.actionRemove_Queued.setObjectName("actionRemove_Queued")
+        self.actionMove_to_Front = QtWidgets.QAction(MainWindow)
+        icon = QtGui.QIcon.fromTheme("go-top")
+        self.actionMove_to_Front.setIcon(icon)
+        self.actionMove_to_Front.setObjectName("actionMove_to_Front")
+        self.actionMove_Up = QtWidgets.QAction(MainWindow)
+        icon = QtGui.QIcon.fromTheme("go-up")
+        self.actionMove_Up.setIcon(icon)
+        self.actionMove_Up.setObjectName("actionMove_Up")
+        self.actionMove_Down = QtWidgets.QAction(MainWindow)
+        icon = QtGui.QIcon.fromTheme("go-down")
+        self.actionMove_Down.setIcon(icon)
+        self.actionMove_Down.setObjectName("actionMove_Down")
         self.actionInfo = QtWidgets.QAction(MainWindow)
         icon = QtGui.QIcon.fromTheme("dialog-information")
         self.actionInfo.setIcon(icon)
@@ -250,6 +262,9 @@ class Ui_MainWindow(object):
         self.actionRemove_All.setText(_translate("MainWindow", "Remove All"))
         self.actionRemove_completed.setText(_translate("MainWindow", "Remove completed"))
         self.actionRemove_Queued.setText(_translate("MainWindow", "Remove Queued"))
+        self.actionMove_to_Front.setText(_translate("MainWindow", "Move to front"))
+        self.actionMove_Up.setText(_translate("MainWindow", "Move up"))
+        self.actionMove_Down.setText(_translate("MainWindow", "Move down"))
         self.actionInfo.setText(_translate("MainWindow", "Info"))
 
 
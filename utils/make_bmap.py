@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Generate the block map that cannolo uses to write only the parts of an image that contain data.
+
+The partition table (MBR or GPT) is read, ext2/3/4 partitions are mapped according to their block bitmaps,
+everything else (other filesystems, bootloader gaps, partition tables) is mapped entirely. Holes of sparse
+image files are never mapped.
+"""
+
+import argparse
+import os
+import struct
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from disk_io import BlockMap, source_size
+
+SECTOR_SIZE = 512
+EXT_MAGIC = 0xEF53
+EXT_INCOMPAT_64BIT = 0x80
+EXT_RO_COMPAT_GDT_CSUM = 0x10
+EXT_RO_COMPAT_METADATA_CSUM = 0x400
+EXT_BG_BLOCK_UNINIT = 0x2
+MBR_GPT_PROTECTIVE = 0xEE
+
+
+def read_at(f, offset: int, size: int) -> bytes:
+    f.seek(offset)
+    return f.read(size)
+
+
+def find_partitions(f, image_size: int) -> list:
+    """
+    Returns (start, end) in bytes for each partition, an empty list if there is no partition table.
+    """
+    mbr = read_at(f, 0, SECTOR_SIZE)
+    if len(mbr) < SECTOR_SIZE or mbr[510:512] != b"\x55\xaa":
+        return []
+    partitions = []
+    for i in range(4):
+        entry = mbr[446 + i * 16 : 446 + (i + 1) * 16]
+        part_type = entry[4]
+        first_lba, sectors = struct.unpack_from("<II", entry, 8)
+        if part_type == 0 or sectors == 0:
+            continue
+        if part_type == MBR_GPT_PROTECTIVE:
+            return find_gpt_partitions(f)
+        # Extended partitions are mapped as a whole, logical partitions are not looked into
+        partitions.append((first_lba * SECTOR_SIZE, min((first_lba + sectors) * SECTOR_SIZE, image_size)))
+    return partitions
+
+
+def find_gpt_partitions(f) -> list:
+    header = read_at(f, SECTOR_SIZE, 92)
+    if header[0:8] != b"EFI PART":
+        return []
+    entries_lba, entries_count, entry_size = struct.unpack_from("<QII", header, 72)
+    table = read_at(f, entries_lba * SECTOR_SIZE, entries_count * entry_size)
+    partitions = []
+    for i in range(entries_count):
+        entry = table[i * entry_size : (i + 1) * entry_size]
+        if len(entry) < 48 or entry[0:16] == bytes(16):
+            continue
+        first_lba, last_lba = struct.unpack_from("<QQ", entry, 32)
+        partitions.append((first_lba * SECTOR_SIZE, (last_lba + 1) * SECTOR_SIZE))
+    return partitions
+
+
+def ext_used_ranges(f, start: int, end: int):
+    """
+    Returns the used (start, end) byte ranges of an ext2/3/4 filesystem at start, or None if it is something else.
+    """
+    superblock = read_at(f, start + 1024, 1024)
+    if len(superblock) < 1024 or struct.unpack_from("<H", superblock, 56)[0] != EXT_MAGIC:
+        return None
+    blocks_count_lo, _, _, _, first_data_block, log_block_size, _, blocks_per_group = struct.unpack_from("<IIIIIIII", superblock, 4)
+    incompat, ro_compat = struct.unpack_from("<II", superblock, 96)
+    reserved_gdt_blocks = struct.unpack_from("<H", superblock, 206)[0]
+    block_size = 1024 << log_block_size
+    blocks_count = blocks_count_lo
+    desc_size = 32
+    if incompat & EXT_INCOMPAT_64BIT:
+        desc_size = struct.unpack_from("<H", superblock, 254)[0] or 32
+        blocks_count |= struct.unpack_from("<I", superblock, 336)[0] << 32
+    uninit_is_valid = ro_compat & (EXT_RO_COMPAT_GDT_CSUM | EXT_RO_COMPAT_METADATA_CSUM)
+
+    groups = -(-(blocks_count - first_data_block) // blocks_per_group)
+    gdt_blocks = -(-(groups * desc_size) // block_size)
+    descriptors = read_at(f, start + (first_data_block + 1) * block_size, groups * desc_size)
+
+    ranges = []
+    # Boot sector, superblock and whatever precedes the first group
+    ranges.append((start, start + (first_data_block + 1 + gdt_blocks + reserved_gdt_blocks) * block_size))
+    for group in range(groups):
+        descriptor = descriptors[group * desc_size : (group + 1) * desc_size]
+        bitmap_block = struct.unpack_from("<I", descriptor, 0)[0]
+        flags = struct.unpack_from("<H", descriptor, 18)[0]
+        if desc_size >= 64:
+            bitmap_block |= struct.unpack_from("<I", descriptor, 32)[0] << 32
+        group_first = first_data_block + group * blocks_per_group
+        group_blocks = min(blocks_per_group, blocks_count - group_first)
+
+        if uninit_is_valid and flags & EXT_BG_BLOCK_UNINIT:
+            # The bitmap is not there, only metadata can be in use: a backup superblock and descriptors at most
+            used = min(group_blocks, 1 + gdt_blocks + reserved_gdt_blocks)
+            ranges.append((start + group_first * block_size, start + (group_first + used) * block_size))
+            continue
+
+        bitmap = read_at(f, start + bitmap_block * block_size, block_size)
+        for first, last in bitmap_runs(bitmap, group_blocks):
+            ranges.append((start + (group_first + first) * block_size, start + (group_first + last) * block_size))
+    return [(a, min(b, end)) for a, b in ranges if a < end]
+
+
+def bitmap_runs(bitmap: bytes, bits: int):
+    """
+    Yields (first, last + 1) for each run of set bits, least significant bit first.
+    """
+    run_start = None
+    for byte_index in range(min(len(bitmap), -(-bits // 8))):
+        byte = bitmap[byte_index]
+        base = byte_index * 8
+        if byte == 0xFF and run_start is not None:
+            continue
+        if byte == 0 and run_start is None:
+            continue
+        for bit in range(8):
+            if base + bit >= bits:
+                break
+            if byte >> bit & 1:
+                if run_start is None:
+                    run_start = base + bit
+            elif run_start is not None:
+                yield run_start, base + bit
+                run_start = None
+    if run_start is not None:
+        yield run_start, bits
+
+
+def data_ranges(f, image_size: int) -> list:
+    """
+    Parts of the file that are not holes, the whole file if the filesystem cannot tell.
+    """
+    if not hasattr(os, "SEEK_DATA"):
+        return [(0, image_size)]
+    fd = f.fileno()
+    ranges = []
+    position = 0
+    try:
+        while position < image_size:
+            data = os.lseek(fd, position, os.SEEK_DATA)
+            hole = os.lseek(fd, data, os.SEEK_HOLE)
+            ranges.append((data, min(hole, image_size)))
+            position = hole
+    except OSError:
+        # ENXIO: no more data after position
+        pass
+    return ranges
+
+
+def intersect(a: list, b: list) -> list:
+    result = []
+    i = j = 0
+    while i < len(a) and j < len(b):
+        start = max(a[i][0], b[j][0])
+        end = min(a[i][1], b[j][1])
+        if start < end:
+            result.append((start, end))
+        if a[i][1] < b[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+def to_block_ranges(byte_ranges: list, block_size: int) -> list:
+    blocks = []
+    for start, end in sorted(byte_ranges):
+        first, last = start // block_size, (end - 1) // block_size
+        if blocks and first <= blocks[-1][1] + 1:
+            blocks[-1] = (blocks[-1][0], max(blocks[-1][1], last))
+        else:
+            blocks.append((first, last))
+    return blocks
+
+
+def main(image: str, output: str, block_size: int):
+    image_size = source_size(image)
+    with open(image, "rb") as f:
+        partitions = find_partitions(f, image_size)
+        if not partitions:
+            # Maybe it is a filesystem image
+            partitions = [(0, image_size)]
+
+        mapped = []
+        position = 0
+        for start, end in sorted(partitions):
+            if start > position:
+                mapped.append((position, start))
+            used = ext_used_ranges(f, start, end)
+            if used is None:
+                print(f"Partition at {start}: not ext2/3/4, mapped entirely")
+                mapped.append((start, end))
+            else:
+                size = sum(b - a for a, b in used)
+                print(f"Partition at {start}: ext2/3/4, {size / (end - start) * 100:.1f}% in use")
+                mapped += used
+            position = max(position, end)
+        if position < image_size:
+            mapped.append((position, image_size))
+
+        mapped = to_block_ranges(mapped, block_size)
+        mapped = [(a * block_size, min((b + 1) * block_size, image_size)) for a, b in mapped]
+        mapped = intersect(mapped, data_ranges(f, image_size))
+
+    block_map = BlockMap(image_size, block_size, to_block_ranges(mapped, block_size))
+    block_map.save(output, image)
+    mapped_size = sum(length for _, length in block_map.extents())
+    print(f"{mapped_size} of {image_size} bytes mapped ({mapped_size / image_size * 100:.1f}%), saved to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a block map for a system image, so that cannolo writes only the used blocks")
+    parser.add_argument("image", type=str, help="Path to the image")
+    parser.add_argument("-o", "--output", type=str, help="Where to save the block map, default is next to the image (<image>.bmap)")
+    parser.add_argument("-b", "--block-size", type=int, default=4096, help="Block size of the map, default 4096")
+    args = parser.parse_args()
+
+    main(args.image, args.output or BlockMap.sidecar_path(args.image), args.block_size)